@@ -1,91 +1,202 @@
+import abc
+import copy
+import functools
+import itertools
+import json
 import os
 import pickle
-from collections import namedtuple
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from .util import AbortError
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
+from .archiveindex import ArchiveIndex
+from .blobstore import BlobStore
+from .compression import open_decompressed, parse_compression, read_codec
+from .lazyresult import LazyResult
+from .profiling import PROFILE_SUFFIXES
+from .suite import collect_cases
+from .util import AbortError, host_name, print_error
 
-class Archive:
-    def __init__(self, directory):
-        self.root = os.path.abspath(directory)
-        os.makedirs(self.root, exist_ok=True)
+# version of the on-disk record that holds the metadata of a result and
+# describes where its context is stored
+STORAGE_VERSION = 1
+
+# NumPy arrays in a context that are at least this large are stored in their
+# own ".npy" blobs, and are memory-mapped when read
+SIDECAR_ARRAY_MIN_BYTES = 64 * 1024
+
+# case directories modified within this many seconds are reconciled again by
+# the next sync of the index, as files may still be added within the
+# resolution of their modification times
+INDEX_SETTLE_TIME = 2.0
 
+
+class BaseArchive(abc.ABC):
+    """
+    The selection of results shared by every kind of archive.
+
+    Archives store and read results by implementing `select`, `insert`,
+    `insert_profile` and `profile_filename`, and list them through an
+    `index` with the `select_*` methods of `ArchiveIndex`.  `location`
+    describes where the archive is, for messages, and `root` is a local
+    directory for data kept next to the archive, such as benchmarks.
+    """
+    location = None
+    root = None
+
+    @abc.abstractmethod
     def select(self, suite_id, case_id, result_id):
-        """
-        Return a single result specified
-        """
-        result_filename = self._result_filename(suite_id, case_id, result_id)
+        pass
 
-        if not os.path.isfile(result_filename):
-            return None
-        else:
-            return self.read_result(result_filename)
+    @abc.abstractmethod
+    def insert(self, result):
+        pass
+
+    @abc.abstractmethod
+    def insert_profile(self, result, profile_data):
+        pass
+
+    @abc.abstractmethod
+    def profile_filename(self, result):
+        pass
 
     def select_recent(self, suites, i, *args):
         """
         Return the most recent result of a specified case.
         *args -- suite and case ID selectors ['a', '1']
         """
-        top_directory = os.path.join(self.root, *args)
-        if not os.path.isdir(top_directory):
-            if args[1] in suites[str(args[0])].collect().keys():
+        suite_id, case_id = args
+        result_ids = self.index.select_result_ids(suite_id, case_id)
+        if not result_ids:
+            if suite_id in suites and case_id in collect_cases(suites[suite_id]).keys():
                 msg = 'The case "{}" exists within suite "{}", ' + \
                       'but has no result recorded. ' + \
                       'Please run the case or suite first.'
-                raise AbortError(msg.format(args[1], args[0]))
-            msg = "Selected case directory {} does not exist or is not a directory"
-            raise AbortError(msg.format(top_directory))
+                raise AbortError(msg.format(case_id, suite_id))
+            msg = 'Selected case "{}/{}" has no results in the archive at "{}"'
+            raise AbortError(msg.format(suite_id, case_id, self.location))
 
-        results = []
-        ResultDesc = namedtuple('ResultDesc', ('id', 'ran_on'))
-        id_to_full_result = dict()
+        recent_id = result_ids[i]
+        result = self.select(suite_id, case_id, recent_id)
+        if result is None:
+            msg = 'Result "{}/{}/{}" is indexed but missing from the archive at "{}"; ' + \
+                  'run "hdat reindex" to rebuild the index'
+            raise AbortError(msg.format(suite_id, case_id, recent_id, self.location))
+        return result
 
-        for entry in os.listdir(top_directory):
-            if not entry.startswith('.') and os.path.isfile(os.path.join(top_directory, entry)):
-                # check for ran_on timestamp as part of <timestamp>_<commit_id> result ID format
-                try:
-                    ran_on = float(entry.split('_')[0])
-                    results.append(ResultDesc(entry, ran_on))
-                except ValueError:
-                    result = self.read_result(os.path.join(top_directory, entry))
-                    ran_on = result['ran_on']
-                    id_to_full_result[entry] = result
-                    results.append(ResultDesc(entry, ran_on))
-
-        results_sorted = sorted(results, key=lambda r: r.ran_on)
-        recent_id = results_sorted[i].id
-
-        if recent_id in id_to_full_result:
-            return id_to_full_result[recent_id]
-        else:
-            return self.read_result(os.path.join(top_directory, recent_id))
+    def select_reusable(self, suite_id, case_id, commit, input_hash):
+        """
+        Return the most recent result of a case that was run at the given
+        commit with the given input hash, or None if there is no such result.
+        """
+        result_ids = self.index.select_result_ids(suite_id, case_id, commit_id=commit, input_hash=input_hash)
+        if not result_ids:
+            return None
+        return self.select(suite_id, case_id, result_ids[-1])
 
     def select_recents_suite(self, suites, *args):
         """
         Return the most recent result of each case within a specified suite.
         *args -- suite ID selector ['a']
         """
-        top_directory = os.path.join(self.root, *args)
-        cases = suites[str(*args)].collect().keys()
-        if not os.path.isdir(top_directory):
-            msg = "Selected suite directory {} does not exist or is not a directory"
-            raise AbortError(msg.format(top_directory))
+        suite_id, = args
+        cases = collect_cases(suites[suite_id]).keys()
+        recorded_cases = self.index.select_case_ids(suite_id)
+        if not recorded_cases:
+            msg = 'Selected suite "{}" has no results in the archive at "{}"'
+            raise AbortError(msg.format(suite_id, self.location))
         # catch unused cases within a suite when resultspec is an entire suite
         for case in cases:
-            if case not in os.listdir(top_directory):
+            if case not in recorded_cases:
                 msg = 'The case "{}" exists within suite "{}", ' + \
                       'but has no result recorded. ' + \
                       'Please run the case or suite first.'
-                raise AbortError(msg.format(case, args[0]))
-        for entry in os.listdir(top_directory):
-            case_path = os.path.join(top_directory, entry)
-            if not entry.startswith('.') and os.path.isdir(case_path) and entry in cases:
-                yield self.select_recent(suites, -1, *(args+(entry,)))
+                raise AbortError(msg.format(case, suite_id))
+        for case in cases:
+            yield self.select_recent(suites, -1, suite_id, case)
 
     def select_recents_all(self, suites):
-        for entry in os.listdir(self.root):
-            if not entry.startswith('.') and os.path.isdir(os.path.join(self.root, entry)):
-                yield from self.select_recents_suite(suites, entry)
+        recorded_suites = self.index.select_suite_ids()
+        for suite_id in suites:
+            if suite_id in recorded_suites:
+                yield from self.select_recents_suite(suites, suite_id)
+
+    def merge(self, source):
+        """
+        Insert the results of another archive, e.g. that of a shard of a run,
+        which are not in this archive yet, along with their profiles.
+        Returns the results that were inserted.
+        """
+        merged = []
+        for (suite_id, case_id), rows in itertools.groupby(source.index.select_results(), key=lambda row: row[:2]):
+            existing_ids = set(self.index.select_result_ids(suite_id, case_id))
+            for _, _, result_id, _ in rows:
+                if result_id in existing_ids:
+                    continue
+                result = source.select(suite_id, case_id, result_id)
+                if result is None:
+                    continue
+                self.insert(dict(result))
+                profile_filename = source.profile_filename(result)
+                if profile_filename is not None and os.path.isfile(profile_filename):
+                    with open(profile_filename, 'rb') as profile_file:
+                        self.insert_profile(result, profile_file.read())
+                merged.append(result)
+        return merged
+
+    def compact(self, jobs=1):
+        raise self._unsupported('compact')
+
+    def gc(self, grace_period=3600):
+        raise self._unsupported('gc')
+
+    def prune(self, keep_last=None, older_than=None, keep_results=(), jobs=1, dry_run=False):
+        raise self._unsupported('prune')
+
+    def reindex(self):
+        raise self._unsupported('reindex')
+
+    def _unsupported(self, operation):
+        return AbortError('The archive at "{}" does not support "{}"'.format(self.location, operation))
+
+
+class Archive(BaseArchive):
+    def __init__(self, directory, compression=None):
+        """
+        `compression` selects the codec, and optionally the level, used to
+        compress result contexts, e.g. "zstd" or "gzip:9".  When it is not
+        given, the "compression" setting of the ".config.json" file in the
+        archive directory is used, if present.
+        """
+        self.root = os.path.abspath(directory)
+        self.location = self.root
+        os.makedirs(self.root, exist_ok=True)
+        if compression is None:
+            compression = self._read_config().get('compression')
+        self.codec, self.level = parse_compression(compression)
+        self.blobs = BlobStore(os.path.join(self.root, '.blobs'))
+        # every host keeps an index of its own, which is reconciled with the
+        # result files, as SQLite files must not be shared between hosts
+        index_directory = os.path.join(self.root, '.index')
+        os.makedirs(index_directory, exist_ok=True)
+        self.index = ArchiveIndex(os.path.join(index_directory, host_name() + '.sqlite'), sync=self._sync_index)
+
+    def select(self, suite_id, case_id, result_id):
+        """
+        Return a single result specified
+        """
+        result_filename = self._result_filename(suite_id, case_id, result_id)
+
+        if not os.path.isfile(result_filename):
+            return None
+        else:
+            return self.read_result(result_filename)
 
     def insert(self, result):
         suite_id = result['suite_id']
@@ -100,12 +211,393 @@ class Archive:
         if os.path.isfile(result_filename):
             raise IOError('Result file exists "{}"'.format(result_filename))
 
-        with open(result_filename, 'wb') as result_file:
-            pickle.dump(result, result_file)
+        # the record is written to a hidden temporary file, which readers
+        # ignore, and only then linked to its name, so that readers never see
+        # a partially written result; unlike a rename, linking fails instead
+        # of overwriting a result inserted concurrently with the same id
+        record = self._build_record(result)
+        descriptor, temporary_filename = tempfile.mkstemp(prefix='.insert-', dir=case_directory)
+        try:
+            with os.fdopen(descriptor, 'wb') as result_file:
+                pickle.dump(record, result_file)
+            _link_new(temporary_filename, result_filename)
+        finally:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+        self.index.insert(result)
+
+    def insert_profile(self, result, profile_data):
+        """
+        Store the profile of an archived result next to it, in the format of
+        the profiler named by the result's "profile" key.
+        """
+        with open(self.profile_filename(result), 'wb') as profile_file:
+            profile_file.write(profile_data)
+
+    def profile_filename(self, result):
+        """
+        Return the file name of the profile of a result, or None if the
+        result was not profiled.
+        """
+        profiler = result.get('profile')
+        if profiler is None:
+            return None
+        result_filename = self._result_filename(result['suite_id'], result['case_id'], result['result_id'])
+        return os.path.splitext(result_filename)[0] + PROFILE_SUFFIXES[profiler]
+
+    def compact(self, jobs=1):
+        """
+        Rewrite all context blobs which are not stored with the archive's
+        compression codec, using `jobs` threads.  Results whose contexts are
+        not stored in the blob store yet, including results stored before
+        contexts were split from the metadata, are rewritten to use it.
+        Returns the number of results and blobs that were rewritten.
+        """
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            num_results = sum(executor.map(self._compact_result, list(self._result_filenames())))
+            recompress = functools.partial(self.blobs.recompress, codec=self.codec, level=self.level)
+            num_blobs = sum(executor.map(recompress, list(self.blobs.digests())))
+        return num_results + num_blobs
+
+    def gc(self, grace_period=3600):
+        """
+        Remove the context blobs which are not referred to by any result,
+        returning the number of blobs that were removed.  Blobs written or
+        reused within the last `grace_period` seconds are kept, as they may
+        belong to results that are being inserted.
+        """
+        referenced = set()
+        for filename in self._result_filenames():
+            record = self._read_record(filename)
+            if _is_storage_record(record) and record['context'] and 'blob' in record['context']:
+                referenced.add(record['context']['blob'])
+                referenced.update(record['context']['arrays'])
+
+        num_removed = 0
+        for digest in list(self.blobs.digests()):
+            if digest not in referenced and self.blobs.age(digest) > grace_period:
+                self.blobs.remove(digest)
+                num_removed += 1
+        return num_removed
+
+    def prune(self, keep_last=None, older_than=None, keep_results=(), jobs=1, dry_run=False):
+        """
+        Remove results from the archive, keeping a result if any of these hold:
+
+        - it is one of the `keep_last` most recent results of its case
+        - it ran less than `older_than` seconds ago
+        - its `(suite_id, case_id, result_id)` is in `keep_results`
+
+        Only the index is consulted to select the results, and their files are
+        removed using `jobs` threads.  Their contexts are left in the blob
+        store until `gc` is run.  Returns the keys of the pruned results.
+        """
+        if keep_last is None and older_than is None and not keep_results:
+            raise AbortError('At least one retention policy is required to prune the archive')
+
+        keep_results = set(keep_results)
+        cutoff = None if older_than is None else time.time() - older_than
+        pruned = []
+        for (suite_id, case_id), rows in itertools.groupby(self.index.select_results(), key=lambda row: row[:2]):
+            rows = list(rows)
+            for position, (_, _, result_id, ran_on) in enumerate(rows):
+                key = (suite_id, case_id, result_id)
+                keep = any([
+                    keep_last is not None and position >= len(rows) - keep_last,
+                    cutoff is not None and ran_on is not None and ran_on >= cutoff,
+                    key in keep_results,
+                ])
+                if not keep:
+                    pruned.append(key)
+
+        if not dry_run:
+            # results are removed from the index first, so that they are not
+            # selected while their files are being removed
+            self.index.delete_many(pruned)
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                list(executor.map(lambda key: self._remove_result_files(*key), pruned))
+        return pruned
+
+    def reindex(self):
+        """
+        Reconcile the index with every result file in the archive, returning
+        the number of results that are indexed.
+        """
+        self.index.clear_directories()
+        return len(self.index.select_results())
+
+    def _sync_index(self, suite_id=None, case_id=None):
+        """
+        Reconcile the index with the result files of a case, of the cases of
+        a suite or of every case, reading only the directories which changed
+        since they were last reconciled.  Results are only ever added to the
+        index from their files, or removed when their files are gone, so
+        results inserted concurrently, by this host or any other, are never
+        lost.
+        """
+        recorded = self.index.select_directories(suite_id)
+        if case_id is not None:
+            case_keys = {(suite_id, case_id)}
+        else:
+            case_keys = set(recorded) | set(self._case_keys(suite_id))
+
+        for key in sorted(case_keys):
+            case_directory = os.path.join(self.root, *key)
+            try:
+                mtime_ns = os.stat(case_directory).st_mtime_ns
+            except FileNotFoundError:
+                mtime_ns = None
+            if mtime_ns is not None and recorded.get(key) == mtime_ns:
+                continue
+
+            indexed_ids = self.index.select_indexed_ids(*key)
+            result_ids = set(entry[:-len('.pkl')] for entry in _visible_entries(case_directory)
+                             if entry.endswith('.pkl'))
+            results = []
+            for result_id in sorted(result_ids - indexed_ids):
+                filename = self._result_filename(key[0], key[1], result_id)
+                try:
+                    results.append(self.read_result(filename))
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    print_error('Skipping unreadable result "{}": {}'.format(filename, e))
+            if mtime_ns is not None and time.time() - mtime_ns / 1e9 < INDEX_SETTLE_TIME:
+                mtime_ns = None
+            self.index.reconcile_case(key[0], key[1], results, indexed_ids - result_ids, mtime_ns)
+
+    def _case_keys(self, suite_id=None):
+        suite_ids = [suite_id] if suite_id is not None else _visible_entries(self.root)
+        for suite_id in suite_ids:
+            suite_directory = os.path.join(self.root, suite_id)
+            for case_id in _visible_entries(suite_directory):
+                if os.path.isdir(os.path.join(suite_directory, case_id)):
+                    yield suite_id, case_id
 
     def read_result(self, filename):
+        """
+        Read a result file.  Results are returned as a `LazyResult`, which only
+        loads the context when it is accessed.  Results stored before contexts
+        were split from the metadata are returned as they were pickled.
+        """
+        record = self._read_record(filename)
+
+        if not _is_storage_record(record):
+            return record
+
+        context_descriptor = record['context']
+        if context_descriptor is None:
+            return LazyResult(record['result'])
+        elif 'blob' in context_descriptor:
+            load_context = functools.partial(self._read_blob_context, context_descriptor['blob'])
+        else:
+            # contexts stored in files next to the result, before the blob store
+            context_filename = os.path.join(os.path.dirname(filename), context_descriptor['file'])
+            load_context = functools.partial(self._read_context_file, context_filename)
+        return LazyResult(record['result'], load_context)
+
+    def _read_record(self, filename):
         with open(filename, 'rb') as result_file:
             return pickle.load(result_file)
 
+    def _build_record(self, result):
+        # the context is stored in the blob store, so that the metadata and
+        # metrics can be read without loading the potentially large context
+        metadata = {key: result[key] for key in result if key != 'context'}
+        if 'context' in result:
+            context_descriptor = self._write_context(result['context'])
+        else:
+            context_descriptor = None
+
+        return {
+            'hdat_storage': STORAGE_VERSION,
+            'result': metadata,
+            'context': context_descriptor,
+        }
+
+    def _write_context(self, context):
+        """
+        Write a context into the blob store, returning a descriptor of the
+        blobs it was written to.  Large NumPy arrays within the context are
+        written as separate ".npy" blobs, so that they are not copied while
+        pickling.  When the archive is not compressed, they are memory-mapped
+        when the context is read.
+        """
+        array_digests = []
+
+        def store_array(array):
+            digest = self.blobs.put_array(array, self.codec, self.level)
+            array_digests.append(digest)
+            return _BlobReference(digest)
+
+        skeleton = _replace_arrays(context, store_array)
+        skeleton_data = pickle.dumps(skeleton, protocol=pickle.HIGHEST_PROTOCOL)
+        return {
+            'blob': self.blobs.put_bytes(skeleton_data, self.codec, self.level),
+            'arrays': array_digests,
+        }
+
+    def _read_blob_context(self, digest):
+        with self.blobs.open(digest) as context_file:
+            skeleton = pickle.load(context_file)
+        return _restore_arrays(skeleton, self._load_reference)
+
+    def _read_context_file(self, filename):
+        with open_decompressed(filename) as context_file:
+            skeleton = pickle.load(context_file)
+        case_directory = os.path.dirname(filename)
+        return _restore_arrays(skeleton, functools.partial(self._load_reference, case_directory=case_directory))
+
+    def _load_reference(self, reference, case_directory=None):
+        if isinstance(reference, _BlobReference):
+            return self.blobs.load_array(reference.digest)
+        else:
+            return _load_array(os.path.join(case_directory, reference.file_name))
+
+    def _compact_result(self, filename):
+        record = self._read_record(filename)
+        if _is_storage_record(record) and (record['context'] is None or 'blob' in record['context']):
+            return False
+
+        result = self.read_result(filename)
+        new_record = self._build_record(result)
+        case_directory = os.path.dirname(filename)
+        descriptor, temporary_filename = tempfile.mkstemp(prefix='.compact-', dir=case_directory)
+        with os.fdopen(descriptor, 'wb') as result_file:
+            pickle.dump(new_record, result_file)
+        os.replace(temporary_filename, filename)
+
+        # remove the files of contexts stored next to the result
+        if _is_storage_record(record):
+            os.remove(os.path.join(case_directory, record['context']['file']))
+            if record['context']['arrays']:
+                shutil.rmtree(os.path.join(case_directory, record['context']['arrays']), ignore_errors=True)
+        return True
+
+    def _remove_result_files(self, suite_id, case_id, result_id):
+        result_filename = self._result_filename(suite_id, case_id, result_id)
+        base_filename = os.path.splitext(result_filename)[0]
+        profile_filenames = [base_filename + suffix for suffix in PROFILE_SUFFIXES.values()]
+        for filename in [result_filename, base_filename + '.context'] + profile_filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+        shutil.rmtree(base_filename + '.arrays', ignore_errors=True)
+
+    def _read_config(self):
+        config_filename = os.path.join(self.root, '.config.json')
+        if not os.path.isfile(config_filename):
+            return {}
+        with open(config_filename, 'r') as config_file:
+            return json.load(config_file)
+
     def _result_filename(self, suite_id, case_id, result_id):
         return os.path.join(self.root, suite_id, case_id, result_id + '.pkl')
+
+    def _result_filenames(self):
+        for suite_id, case_id in self._case_keys():
+            case_directory = os.path.join(self.root, suite_id, case_id)
+            for entry in _visible_entries(case_directory):
+                filename = os.path.join(case_directory, entry)
+                if entry.endswith('.pkl') and os.path.isfile(filename):
+                    yield filename
+
+
+class _BlobReference:
+    """
+    Placeholder left in a pickled context for an array stored in the blob store.
+    """
+    def __init__(self, digest):
+        self.digest = digest
+
+
+class _ArrayReference:
+    """
+    Placeholder left in a pickled context for an array stored in a ".npy" file,
+    relative to the case directory, before the blob store.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+
+def open_archive(location, compression=None):
+    """
+    Open the archive at a location, which is either a local directory or the
+    URL of a bucket, and optionally a prefix within it, in an S3-compatible
+    object store, e.g. "s3://bucket/prefix".
+    """
+    if location.startswith('s3://'):
+        from .objectstore import ObjectStoreArchive
+        return ObjectStoreArchive(location, compression=compression)
+    return Archive(location, compression=compression)
+
+
+def _link_new(source, destination):
+    '''
+    Atomically create `destination` as a link to `source`, raising an
+    IOError if it already exists.  On file systems without hard links,
+    `source` is renamed instead, which can not detect concurrent writers.
+    '''
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        raise IOError('Result file exists "{}"'.format(destination))
+    except OSError:
+        if os.path.exists(destination):
+            raise IOError('Result file exists "{}"'.format(destination))
+        os.replace(source, destination)
+
+
+def _is_sidecar_array(value):
+    # object arrays can not be memory-mapped, and subclasses of ndarray would
+    # lose their type, so those are pickled along with the rest of the context
+    if np is None or type(value) is not np.ndarray:
+        return False
+    return not value.dtype.hasobject and value.nbytes >= SIDECAR_ARRAY_MIN_BYTES
+
+
+def _replace_arrays(value, store_array):
+    """
+    Return a copy of the nested dicts, lists and tuples in `value`, with any
+    large arrays replaced by the result of calling `store_array` on them.
+    """
+    if _is_sidecar_array(value):
+        return store_array(value)
+    elif isinstance(value, dict):
+        replaced = copy.copy(value)
+        for key, item in value.items():
+            replaced[key] = _replace_arrays(item, store_array)
+        return replaced
+    elif type(value) in (list, tuple):
+        return type(value)(_replace_arrays(item, store_array) for item in value)
+    else:
+        return value
+
+
+def _load_array(filename):
+    if read_codec(filename) == 'none':
+        return np.load(filename, mmap_mode='r')
+    with open_decompressed(filename) as array_file:
+        return np.lib.format.read_array(array_file, allow_pickle=False)
+
+
+def _restore_arrays(value, load_reference):
+    if isinstance(value, (_BlobReference, _ArrayReference)):
+        return load_reference(value)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            value[key] = _restore_arrays(item, load_reference)
+        return value
+    elif type(value) in (list, tuple):
+        return type(value)(_restore_arrays(item, load_reference) for item in value)
+    else:
+        return value
+
+
+def _is_storage_record(record):
+    return isinstance(record, dict) and record.get('hdat_storage') == STORAGE_VERSION
+
+
+def _visible_entries(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(entry for entry in os.listdir(directory) if not entry.startswith('.'))
@@ -0,0 +1,212 @@
+import sqlite3
+from contextlib import contextmanager
+
+from . import arrayjson
+
+
+class ArchiveIndex:
+    '''
+    A SQLite index of the metadata of every result in an archive, so that
+    results can be looked up without listing directories or reading the
+    result files themselves.
+
+    The index is a cache of the result files.  When `sync` is given, it is
+    called as `sync(suite_id=None, case_id=None)` before results are
+    selected, to reconcile the index with the result files of the selected
+    cases, using `select_directories`, `select_indexed_ids` and
+    `reconcile_case`.  The modification time of the directory of each case
+    is recorded when it is reconciled, so that only the cases which changed
+    since are read again.
+    '''
+    schema_version = 3
+
+    def __init__(self, filename, timeout=30.0, sync=None):
+        self.filename = filename
+        self.timeout = timeout
+        self.sync = sync
+        self.created = self._create_schema()
+
+    def insert(self, result):
+        with self._connect() as connection:
+            self._insert_rows(connection, [result])
+
+    def clear_directories(self):
+        '''
+        Forget when the directory of each case was reconciled, so that every
+        case is reconciled again by the next `sync`.
+        '''
+        with self._connect() as connection:
+            connection.execute('DELETE FROM directories')
+
+    def select_directories(self, suite_id=None):
+        '''
+        Return the recorded modification time of the directory of each case,
+        optionally only those of a suite, by `(suite_id, case_id)`.
+        '''
+        query = 'SELECT suite_id, case_id, mtime_ns FROM directories'
+        parameters = ()
+        if suite_id is not None:
+            query += ' WHERE suite_id = ?'
+            parameters = (suite_id,)
+        with self._connect() as connection:
+            return {(row[0], row[1]): row[2] for row in connection.execute(query, parameters)}
+
+    def select_indexed_ids(self, suite_id, case_id):
+        '''
+        Return the set of the ids of the indexed results of a case, without
+        reconciling it first.
+        '''
+        with self._connect() as connection:
+            rows = connection.execute('SELECT result_id FROM results WHERE suite_id = ? AND case_id = ?',
+                                      (suite_id, case_id))
+            return set(result_id for result_id, in rows)
+
+    def reconcile_case(self, suite_id, case_id, results, removed_ids, mtime_ns):
+        '''
+        Insert the results of a case which were missing from the index and
+        remove those whose files are gone, recording the modification time of
+        its directory, or forgetting it if `mtime_ns` is None, in a single
+        transaction.
+        '''
+        with self._connect() as connection:
+            self._insert_rows(connection, results)
+            connection.executemany(
+                'DELETE FROM results WHERE suite_id = ? AND case_id = ? AND result_id = ?',
+                ((suite_id, case_id, result_id) for result_id in removed_ids),
+            )
+            if mtime_ns is None:
+                connection.execute('DELETE FROM directories WHERE suite_id = ? AND case_id = ?', (suite_id, case_id))
+            else:
+                connection.execute('INSERT OR REPLACE INTO directories (suite_id, case_id, mtime_ns) VALUES (?, ?, ?)',
+                                   (suite_id, case_id, mtime_ns))
+
+    def select_result_ids(self, suite_id, case_id, commit_id=None, input_hash=None, before=None):
+        '''
+        Return the ids of all results of a case, from oldest to most recent,
+        optionally only those run at a commit, with an input hash, or before
+        the time `before`.
+        '''
+        self._sync(suite_id, case_id)
+        conditions = ['suite_id = ?', 'case_id = ?']
+        parameters = [suite_id, case_id]
+        for column, value in (('commit_id', commit_id), ('input_hash', input_hash)):
+            if value is not None:
+                conditions.append('{} = ?'.format(column))
+                parameters.append(value)
+        if before is not None:
+            conditions.append('ran_on < ?')
+            parameters.append(before)
+        with self._connect() as connection:
+            rows = connection.execute(
+                'SELECT result_id FROM results WHERE {} ORDER BY ran_on, result_id'.format(' AND '.join(conditions)),
+                parameters,
+            )
+            return [result_id for result_id, in rows]
+
+    def select_results(self):
+        '''
+        Return `(suite_id, case_id, result_id, ran_on)` tuples for every result,
+        grouped by case, from oldest to most recent within each case.
+        '''
+        self._sync()
+        with self._connect() as connection:
+            return connection.execute(
+                'SELECT suite_id, case_id, result_id, ran_on FROM results '
+                'ORDER BY suite_id, case_id, ran_on, result_id'
+            ).fetchall()
+
+    def delete_many(self, result_keys):
+        '''
+        Remove results, given as `(suite_id, case_id, result_id)` tuples.
+        '''
+        with self._connect() as connection:
+            connection.executemany(
+                'DELETE FROM results WHERE suite_id = ? AND case_id = ? AND result_id = ?',
+                result_keys,
+            )
+
+    def select_case_ids(self, suite_id):
+        self._sync(suite_id)
+        with self._connect() as connection:
+            rows = connection.execute('SELECT DISTINCT case_id FROM results WHERE suite_id = ?', (suite_id,))
+            return set(case_id for case_id, in rows)
+
+    def select_suite_ids(self):
+        self._sync()
+        with self._connect() as connection:
+            rows = connection.execute('SELECT DISTINCT suite_id FROM results')
+            return set(suite_id for suite_id, in rows)
+
+    def _sync(self, suite_id=None, case_id=None):
+        if self.sync is not None:
+            self.sync(suite_id, case_id)
+
+    def _insert_rows(self, connection, results):
+        connection.executemany(
+            'INSERT OR REPLACE INTO results '
+            '(suite_id, case_id, result_id, ran_on, commit_id, status, input_hash, metrics) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (self._row(result) for result in results),
+        )
+
+    def _row(self, result):
+        try:
+            metrics = arrayjson.dumps(result.get('metrics'), sort_keys=True)
+        except (TypeError, ValueError):
+            metrics = None
+        return (
+            result['suite_id'],
+            result['case_id'],
+            result['result_id'],
+            result.get('ran_on'),
+            result.get('commit'),
+            result.get('status'),
+            result.get('input_hash'),
+            metrics,
+        )
+
+    def _create_schema(self):
+        '''
+        Create the index tables if they are missing or were created by another
+        version of hdat.  Returns True if the index is new and needs to be
+        filled from the archive.
+        '''
+        with self._connect() as connection:
+            # take the write lock first, so that concurrent hdat processes
+            # opening a new archive do not both create the tables
+            connection.execute('BEGIN IMMEDIATE')
+            version, = connection.execute('PRAGMA user_version').fetchone()
+            if version == self.schema_version:
+                return False
+            connection.execute('DROP TABLE IF EXISTS results')
+            connection.execute('DROP TABLE IF EXISTS directories')
+            connection.execute(
+                'CREATE TABLE results ('
+                'suite_id TEXT NOT NULL, '
+                'case_id TEXT NOT NULL, '
+                'result_id TEXT NOT NULL, '
+                'ran_on REAL, '
+                'commit_id TEXT, '
+                'status TEXT, '
+                'input_hash TEXT, '
+                'metrics TEXT, '
+                'PRIMARY KEY (suite_id, case_id, result_id))'
+            )
+            connection.execute(
+                'CREATE TABLE directories ('
+                'suite_id TEXT NOT NULL, '
+                'case_id TEXT NOT NULL, '
+                'mtime_ns INTEGER NOT NULL, '
+                'PRIMARY KEY (suite_id, case_id))'
+            )
+            connection.execute('PRAGMA user_version = {:d}'.format(self.schema_version))
+            return True
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.filename, timeout=self.timeout)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
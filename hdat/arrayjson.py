@@ -0,0 +1,58 @@
+import base64
+import json
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# key marking the JSON objects which encode a NumPy array
+ARRAY_KEY = '__ndarray__'
+
+
+def dumps(value, **kwargs):
+    '''
+    Serialize a value to JSON like `json.dumps`, encoding NumPy arrays
+    compactly as base64 little-endian buffers, along with their dtype and
+    shape, and NumPy scalars as plain numbers.
+    '''
+    return json.dumps(value, default=encode_array, **kwargs)
+
+
+def dump(value, fp, **kwargs):
+    fp.write(dumps(value, **kwargs))
+
+
+def loads(s):
+    '''
+    Deserialize JSON written by `dumps`, decoding the encoded arrays.
+    '''
+    return json.loads(s, object_hook=decode_array)
+
+
+def load(fp):
+    return loads(fp.read())
+
+
+def encode_array(value):
+    if np is not None and isinstance(value, np.generic):
+        return value.item()
+    elif np is not None and isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            return value.tolist()
+        little_endian = value.astype(value.dtype.newbyteorder('<'), copy=False)
+        return {
+            ARRAY_KEY: base64.b64encode(np.ascontiguousarray(little_endian).tobytes()).decode('ascii'),
+            'dtype': little_endian.dtype.str,
+            'shape': list(value.shape),
+        }
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+def decode_array(obj):
+    if ARRAY_KEY not in obj:
+        return obj
+    if np is None:
+        raise ImportError('NumPy is required to read array-valued metrics')
+    data = base64.b64decode(obj[ARRAY_KEY])
+    return np.frombuffer(data, dtype=np.dtype(obj['dtype'])).reshape(obj['shape']).copy()
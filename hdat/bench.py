@@ -0,0 +1,195 @@
+import datetime
+import json
+import math
+import os
+import statistics
+import tempfile
+
+from .casespec import print_casespec
+from .perf import current_peak_rss, measure, reset_peak_rss
+from .runner import run_suite, set_up_suite, tear_down_suites
+from .suite import collect_cases
+from .util import AbortError
+
+# the measurements of each repeat, summarized by `summarize`
+BENCH_MEASUREMENTS = ('wall_time', 'cpu_time', 'peak_rss')
+
+# suffix of the names of benchmarks of dirty working trees
+DIRTY_SUFFIX = '-dirty'
+
+
+class BenchStore:
+    '''
+    Keeps the summarized benchmarks of each commit in a small JSON file,
+    "<commit>.json", so that later benchmarks can be compared against them.
+    Benchmarks of a dirty working tree are kept apart, in
+    "<commit>-dirty.json", so that they never replace those of the clean
+    commit.  Benchmarks of cases which were already benchmarked at the same
+    commit, and in the same state, replace the earlier ones.
+    '''
+    def __init__(self, directory):
+        self.root = os.path.abspath(directory)
+
+    def insert(self, bench):
+        name = bench_name(bench['commit'], bench.get('repo_dirty'))
+        previous_bench = self.select(name, exact=True)
+        if previous_bench is not None:
+            cases = previous_bench['cases']
+            cases.update(bench['cases'])
+            bench = dict(bench, cases=cases)
+
+        os.makedirs(self.root, exist_ok=True)
+        descriptor, temporary_filename = tempfile.mkstemp(prefix='.tmp-', dir=self.root)
+        with os.fdopen(descriptor, 'w') as bench_file:
+            json.dump(bench, bench_file, sort_keys=True, separators=(',', ':'))
+        os.replace(temporary_filename, self._bench_filename(name))
+
+    def select(self, commit, exact=False):
+        '''
+        Return the benchmarks of a commit, which may be abbreviated unless
+        `exact` is true, or None if the commit was never benchmarked.  The
+        benchmarks of a dirty working tree are selected by appending
+        "-dirty" to the commit.
+        '''
+        if exact:
+            names = [commit] if os.path.isfile(self._bench_filename(commit)) else []
+        else:
+            dirty = commit.endswith(DIRTY_SUFFIX)
+            prefix = commit[:-len(DIRTY_SUFFIX)] if dirty else commit
+            names = [name for name in self.commits()
+                     if name.endswith(DIRTY_SUFFIX) == dirty and name.startswith(prefix)]
+        if not names:
+            return None
+        elif len(names) > 1:
+            raise AbortError('The commit "{}" is ambiguous; it matches {}'.format(commit, ', '.join(names)))
+        with open(self._bench_filename(names[0]), 'r') as bench_file:
+            return json.load(bench_file)
+
+    def commits(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(entry[:-len('.json')] for entry in os.listdir(self.root)
+                      if entry.endswith('.json') and not entry.startswith('.'))
+
+    def _bench_filename(self, name):
+        return os.path.join(self.root, name + '.json')
+
+
+def bench_name(commit, dirty):
+    return commit + DIRTY_SUFFIX if dirty else commit
+
+
+def bench_cases(suites, git_info, cases, warmup=1, repeat=5):
+    '''
+    Benchmark a list of cases, specified as `(suite_id, case_id)` tuples.
+
+    Each case is run `warmup` times without being measured, and then
+    `repeat` times, measuring the wall time, CPU time and peak resident
+    memory of each run.  The peak resident memory is reset before every run
+    where the OS allows it (see `hdat.perf.reset_peak_rss`).  The results of
+    the runs are neither checked nor archived.  Each suite is set up before
+    its first case is benchmarked, and torn down at the end.
+
+    Returns the benchmarks of the cases, with the measurements summarized by
+    `summarize`, in the form stored by `BenchStore`.
+    '''
+    if repeat < 1:
+        raise AbortError('Benchmarks need at least one repeat')
+
+    bench = {
+        'commit': git_info['commit'],
+        'repo_dirty': git_info['dirty'],
+        'ran_on': datetime.datetime.utcnow().timestamp(),
+        'warmup': warmup,
+        'repeat': repeat,
+        'cases': {},
+    }
+    try:
+        for suite_id, case_id in cases:
+            bench['cases'][print_casespec(suite_id, case_id)] = _bench_case(suites[suite_id], case_id, warmup,
+                                                                            repeat)
+    finally:
+        tear_down_suites()
+    return bench
+
+
+def _bench_case(suite, case_id, warmup, repeat):
+    case_input = collect_cases(suite)[case_id]
+    suite = set_up_suite(suite)
+    for _ in range(warmup):
+        run_suite(suite, case_input)
+
+    measurements = {key: [] for key in BENCH_MEASUREMENTS}
+    for _ in range(repeat):
+        reset_peak_rss()
+        perf = {}
+        with measure(perf, 'run'):
+            run_suite(suite, case_input)
+        measurements['wall_time'].append(perf['run_wall_time'])
+        measurements['cpu_time'].append(perf['run_cpu_time'])
+        rss = current_peak_rss()
+        if rss is not None:
+            measurements['peak_rss'].append(rss)
+
+    return {key: summarize(values) for key, values in measurements.items() if values}
+
+
+def summarize(values):
+    '''
+    Return the minimum, median, 95th percentile and standard deviation of a
+    list of measurements.
+    '''
+    ordered_values = sorted(values)
+    # nearest-rank percentile
+    p95_index = max(int(math.ceil(0.95 * len(ordered_values))) - 1, 0)
+    return {
+        'min': ordered_values[0],
+        'median': statistics.median(ordered_values),
+        'p95': ordered_values[p95_index],
+        'stddev': statistics.stdev(ordered_values) if len(ordered_values) > 1 else 0.0,
+    }
+
+
+def format_bench(bench, baseline=None):
+    '''
+    Format the benchmarks of each case as a line of text, comparing the
+    medians against those of the `baseline` benchmarks, if given.
+    '''
+    lines = []
+    for casespec in sorted(bench['cases']):
+        case_bench = bench['cases'][casespec]
+        line = '{}: {}'.format(casespec, '; '.join(
+            _format_measurement(key, case_bench[key]) for key in BENCH_MEASUREMENTS if key in case_bench
+        ))
+        if baseline is not None:
+            baseline_name = bench_name(baseline['commit'], baseline.get('repo_dirty'))
+            line += '\n    ' + _format_comparison(case_bench, baseline['cases'].get(casespec), baseline_name)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def _format_measurement(key, summary):
+    if key == 'peak_rss':
+        template = '{} min {:.1f} MB, median {:.1f} MB, p95 {:.1f} MB, stddev {:.1f} MB'
+        scale = 2**20
+    else:
+        template = '{} min {:.6f} s, median {:.6f} s, p95 {:.6f} s, stddev {:.6f} s'
+        scale = 1
+    return template.format(
+        key.replace('_', ' '),
+        summary['min'] / scale,
+        summary['median'] / scale,
+        summary['p95'] / scale,
+        summary['stddev'] / scale,
+    )
+
+
+def _format_comparison(case_bench, baseline_case_bench, baseline_commit):
+    if baseline_case_bench is None:
+        return 'not benchmarked at {}'.format(baseline_commit)
+    changes = []
+    for key in BENCH_MEASUREMENTS:
+        if key in case_bench and key in baseline_case_bench and baseline_case_bench[key]['median'] > 0:
+            change = case_bench[key]['median'] / baseline_case_bench[key]['median'] - 1
+            changes.append('{} {:+.1%}'.format(key.replace('_', ' '), change))
+    return 'median vs {}: {}'.format(baseline_commit, ', '.join(changes))
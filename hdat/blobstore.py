@@ -0,0 +1,151 @@
+import hashlib
+import os
+import tempfile
+import time
+
+from .compression import open_compressed, open_decompressed, read_codec
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# suffix of the blobs holding NumPy arrays, which can be memory-mapped when
+# they are not compressed
+ARRAY_SUFFIX = '.npy'
+
+
+class BlobStore:
+    '''
+    A content-addressed store for the contexts of archived results.
+
+    Every blob is named by the SHA-256 digest of its uncompressed contents,
+    so identical contexts, or identical arrays within contexts, are only
+    stored once no matter how many results refer to them.
+    '''
+    def __init__(self, directory):
+        self.root = os.path.abspath(directory)
+
+    def put_bytes(self, data, codec='none', level=None):
+        digest = hashlib.sha256(data).hexdigest()
+        if not self._reuse(digest):
+            with self._open_new(digest, codec, level) as blob_file:
+                blob_file.write(data)
+        return digest
+
+    def put_array(self, array, codec='none', level=None):
+        digest = _hash_array(array) + ARRAY_SUFFIX
+        if not self._reuse(digest):
+            with self._open_new(digest, codec, level) as blob_file:
+                np.lib.format.write_array(blob_file, array, allow_pickle=False)
+        return digest
+
+    def open(self, digest):
+        return open_decompressed(self.filename(digest))
+
+    def load_array(self, digest):
+        '''
+        Load an array blob, memory-mapping it if it is not compressed.
+        '''
+        filename = self.filename(digest)
+        if read_codec(filename) == 'none':
+            return np.load(filename, mmap_mode='r')
+        with open_decompressed(filename) as blob_file:
+            return np.lib.format.read_array(blob_file, allow_pickle=False)
+
+    def recompress(self, digest, codec='none', level=None):
+        '''
+        Rewrite a blob with another codec, returning False if it already uses
+        that codec.
+        '''
+        if read_codec(self.filename(digest)) == codec:
+            return False
+        with self.open(digest) as blob_file, self._open_new(digest, codec, level) as new_blob_file:
+            for chunk in iter(lambda: blob_file.read(1 << 20), b''):
+                new_blob_file.write(chunk)
+        return True
+
+    def remove(self, digest):
+        os.remove(self.filename(digest))
+
+    def digests(self):
+        if not os.path.isdir(self.root):
+            return
+        for prefix in sorted(os.listdir(self.root)):
+            prefix_directory = os.path.join(self.root, prefix)
+            if prefix.startswith('.') or not os.path.isdir(prefix_directory):
+                continue
+            for entry in sorted(os.listdir(prefix_directory)):
+                if not entry.startswith('.'):
+                    yield entry
+
+    def age(self, digest):
+        '''
+        Return the number of seconds since the blob was last written or
+        reused.
+        '''
+        return time.time() - os.path.getmtime(self.filename(digest))
+
+    def filename(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _reuse(self, digest):
+        '''
+        Check if a blob is already stored, marking it as recently used so
+        that it is not garbage collected while the result referring to it is
+        being written.
+        '''
+        try:
+            os.utime(self.filename(digest))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _open_new(self, digest, codec, level):
+        return _AtomicBlobWriter(self.filename(digest), codec, level)
+
+
+class _AtomicBlobWriter:
+    '''
+    Writes a blob into a hidden temporary file, and only moves it into place
+    once it is complete, so that readers and concurrent writers of the same
+    blob never see a partially written blob.
+    '''
+    def __init__(self, filename, codec, level):
+        self.filename = filename
+        self.codec = codec
+        self.level = level
+
+    def __enter__(self):
+        directory = os.path.dirname(self.filename)
+        os.makedirs(directory, exist_ok=True)
+        descriptor, self.temporary_filename = tempfile.mkstemp(prefix='.tmp-', dir=directory)
+        os.close(descriptor)
+        self._compressed = open_compressed(self.temporary_filename, self.codec, self.level)
+        return self._compressed.__enter__()
+
+    def __exit__(self, *exc_info):
+        try:
+            self._compressed.__exit__(*exc_info)
+            if exc_info[0] is None:
+                os.replace(self.temporary_filename, self.filename)
+        finally:
+            if os.path.exists(self.temporary_filename):
+                os.remove(self.temporary_filename)
+        return False
+
+
+def _hash_array(array):
+    '''
+    Hash the dtype, shape, memory order and data of an array, without copying
+    the data of contiguous arrays.
+    '''
+    digest = hashlib.sha256()
+    fortran_order = array.flags.f_contiguous and not array.flags.c_contiguous
+    header = '{}{}{}'.format(array.dtype.str, array.shape, 'F' if fortran_order else 'C')
+    digest.update(header.encode('ascii'))
+    if fortran_order:
+        digest.update(array.T)
+    else:
+        digest.update(np.ascontiguousarray(array))
+    return digest.hexdigest()
@@ -1,11 +1,28 @@
+import statistics
+
+from .suite import collect_cases
 from .util import AbortError, remove_duplicates
 
 
-def resolve_casespecs(suites, casespecs):
+def resolve_casespecs(suites, casespecs, shard=None, archive=None, balance_before=None):
+    '''
+    Resolve a list of case specifiers into `(suite_id, case_id)` tuples.
+
+    When a `shard` is given, as an `(index, count)` tuple with `index`
+    counting from 1, only the cases of that shard are returned (see
+    `shard_cases`).  When an `archive` is given too, the shards are balanced
+    using the run times of the cases' most recent results archived before the
+    `balance_before` time, so that shards which start later, once results of
+    the other shards are archived, still compute the same assignment.
+    '''
     cases = []
     for spec in casespecs:
         cases.extend(resolve_casespec(suites, spec))
-    return remove_duplicates(cases)
+    cases = remove_duplicates(cases)
+    if shard is not None:
+        run_times = None if archive is None else archived_run_times(archive, cases, before=balance_before)
+        cases = shard_cases(cases, shard[0], shard[1], run_times)
+    return cases
 
 
 def resolve_casespec(suites, casespec):
@@ -13,12 +30,12 @@ def resolve_casespec(suites, casespec):
     spec_parts = casespec.split('/')
     if casespec == '':
         for suite_id, suite in suites.items():
-            for case_id in suite.collect():
+            for case_id in collect_cases(suite):
                 cases.append((suite_id, case_id))
     elif len(spec_parts) == 1:
         suite_id = spec_parts[0]
         suite = select_suite(suites, suite_id)
-        for case_id in suite.collect():
+        for case_id in collect_cases(suite):
             cases.append((suite_id, case_id))
     elif len(spec_parts) == 2:
         suite_id, case_id = spec_parts
@@ -40,7 +57,7 @@ def select_suite(suites, suite_id):
 
 
 def select_case(suite, case_id):
-    case_map = suite.collect()
+    case_map = collect_cases(suite)
     if case_id not in case_map:
         all_cases = '\n- '.join(case_map.keys())
         msg = 'Unknown case id "{}". Available cases:\n- {}'
@@ -51,3 +68,62 @@ def select_case(suite, case_id):
 
 def print_casespec(suite_id, case_id):
     return '{}/{}'.format(suite_id, case_id)
+
+
+def parse_shard(shardspec):
+    '''
+    Parse a shard specifier of the form "i/N" into an `(i, N)` tuple.
+    '''
+    index, _, count = shardspec.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index, count = 0, 0
+    if not 1 <= index <= count:
+        raise AbortError('Invalid shard "{}"; expected "i/N" with 1 <= i <= N'.format(shardspec))
+    return index, count
+
+
+def shard_cases(cases, index, count, run_times=None):
+    '''
+    Return the cases of shard `index` (counting from 1) out of `count`, in
+    their original order.
+
+    The cases are assigned to shards longest first, each to the shard with
+    the least total run time so far, using the `run_times` dict from cases to
+    seconds.  Cases without a run time are assumed to take the median run
+    time, so without any run times the cases are dealt out in sorted order.
+    The assignment only depends on the set of cases and their run times, so
+    every machine computes the same shards as long as they see the same
+    run times.
+    '''
+    run_times = run_times or {}
+    default_run_time = statistics.median(run_times.values()) if run_times else 1.0
+    loads = [0.0] * count
+    shard_members = set()
+    for case in sorted(cases, key=lambda case: (-run_times.get(case, default_run_time), case)):
+        shard = min(range(count), key=lambda i: (loads[i], i))
+        loads[shard] += run_times.get(case, default_run_time)
+        if shard == index - 1:
+            shard_members.add(case)
+    return [case for case in cases if case in shard_members]
+
+
+def archived_run_times(archive, cases, before=None):
+    '''
+    Return the run times of the most recent archived results of the cases,
+    optionally only of those which ran before the time `before`, as a dict
+    from cases to seconds, leaving out cases without such results.  The
+    results are selected with the archive's index, and only the selected
+    result of each case is read.
+    '''
+    run_times = {}
+    for suite_id, case_id in cases:
+        result_ids = archive.index.select_result_ids(suite_id, case_id, before=before)
+        if not result_ids:
+            continue
+        result = archive.select(suite_id, case_id, result_ids[-1])
+        perf = {} if result is None else result.get('perf') or {}
+        if 'run_wall_time' in perf:
+            run_times[(suite_id, case_id)] = perf['run_wall_time']
+    return run_times
@@ -0,0 +1,154 @@
+import bz2
+import gzip
+import io
+import lzma
+from contextlib import contextmanager
+
+from .util import AbortError
+
+# Compressed files start with this magic string followed by the length and
+# the name of the codec, so that they can be read without any configuration.
+# Files without it are read as they are, which keeps files written before
+# compression was available, or with the "none" codec, readable.
+MAGIC = b'HDATZ\x01'
+
+
+def _open_gzip(fileobj, mode, level):
+    return gzip.GzipFile(fileobj=fileobj, mode=mode, compresslevel=level)
+
+
+def _open_bz2(fileobj, mode, level):
+    return bz2.BZ2File(fileobj, mode=mode, compresslevel=level)
+
+
+def _open_lzma(fileobj, mode, level):
+    return lzma.LZMAFile(fileobj, mode=mode, preset=level if mode == 'wb' else None)
+
+
+def _open_zstd(fileobj, mode, level):
+    import zstandard
+    if mode == 'wb':
+        return zstandard.open(fileobj, mode, cctx=zstandard.ZstdCompressor(level=level), closefd=False)
+    return zstandard.open(fileobj, mode, closefd=False)
+
+
+def _open_lz4(fileobj, mode, level):
+    import lz4.frame
+    return lz4.frame.open(fileobj, mode, compression_level=level)
+
+
+# codec name -> (function opening a compressed stream over a file object, default level)
+CODECS = {
+    'gzip': (_open_gzip, 6),
+    'bz2': (_open_bz2, 9),
+    'lzma': (_open_lzma, 6),
+    'zstd': (_open_zstd, 3),
+    'lz4': (_open_lz4, 0),
+}
+
+_CODEC_MODULES = {
+    'zstd': 'zstandard',
+    'lz4': 'lz4.frame',
+}
+
+
+def available_codecs():
+    codecs = ['none']
+    for codec in sorted(CODECS):
+        try:
+            if codec in _CODEC_MODULES:
+                __import__(_CODEC_MODULES[codec])
+            codecs.append(codec)
+        except ImportError:
+            pass
+    return codecs
+
+
+def parse_compression(compression):
+    '''
+    Parse a compression specifier of the form "codec" or "codec:level" into a
+    `(codec, level)` tuple.  A missing level means the codec's default level.
+    '''
+    if not compression:
+        return 'none', None
+    codec, _, level = compression.partition(':')
+    codec = codec.strip().lower()
+    if codec not in available_codecs():
+        msg = 'Unknown or unavailable compression codec "{}". Available codecs: {}'
+        raise AbortError(msg.format(codec, ', '.join(available_codecs())))
+    if not level:
+        return codec, None
+    try:
+        return codec, int(level)
+    except ValueError:
+        raise AbortError('Invalid compression level "{}" in "{}"'.format(level, compression))
+
+
+@contextmanager
+def open_compressed(filename, codec='none', level=None):
+    '''
+    Open a file for writing, compressing everything written to it with the
+    given codec.
+    '''
+    with open(filename, 'wb') as raw_file:
+        if codec == 'none':
+            yield raw_file
+            return
+        open_stream, default_level = CODECS[codec]
+        raw_file.write(MAGIC + bytes([len(codec)]) + codec.encode('ascii'))
+        with open_stream(raw_file, 'wb', default_level if level is None else level) as stream:
+            yield stream
+
+
+@contextmanager
+def open_decompressed(filename):
+    '''
+    Open a file written by `open_compressed`, or an uncompressed file, for
+    reading.
+    '''
+    with open(filename, 'rb') as raw_file:
+        codec = _read_codec(raw_file)
+        if codec == 'none':
+            yield raw_file
+            return
+        open_stream, default_level = CODECS[codec]
+        with open_stream(raw_file, 'rb', default_level) as stream:
+            yield io.BufferedReader(_ReadableStream(stream))
+
+
+class _ReadableStream(io.RawIOBase):
+    '''
+    Presents the decompressing streams of the various codecs as a plain,
+    non-seekable, raw stream, so that they behave the same way when wrapped in
+    a buffered reader.
+    '''
+    def __init__(self, stream):
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def read_codec(filename):
+    with open(filename, 'rb') as raw_file:
+        return _read_codec(raw_file)
+
+
+def _read_codec(raw_file):
+    '''
+    Read the codec from the header of an open file, leaving the file
+    positioned at the start of the (possibly compressed) data.
+    '''
+    if raw_file.read(len(MAGIC)) != MAGIC:
+        raw_file.seek(0)
+        return 'none'
+    codec_length = raw_file.read(1)[0]
+    codec = raw_file.read(codec_length).decode('ascii')
+    if codec not in CODECS:
+        raise IOError('File "{}" is compressed with the unknown codec "{}"'.format(raw_file.name, codec))
+    return codec
@@ -0,0 +1,195 @@
+import numbers
+import os
+import zipfile
+from collections import OrderedDict
+
+from .reports import parse_keys, expand_keys, get_nested_item
+from .util import AbortError, print_error
+
+EXPORT_FORMATS = ('parquet', 'feather', 'npz')
+
+# column types, ordered so that the type of a column holding several kinds of
+# values is the largest of their types
+COLUMN_TYPES = ('bool', 'int', 'float', 'str')
+
+
+def export_results(resolve_results, input_keys_str, filename, export_format, batch_size=1000):
+    '''
+    Write the selected keys of the results into a typed, columnar file.
+
+    `resolve_results` is a function returning an iterable of the results; it
+    is called twice, first to find the columns and their types, and then to
+    write the rows in batches of `batch_size` results.  Parquet and Feather
+    files are written with pyarrow; when it is not installed, or when the
+    "npz" format is requested, a NumPy structured array is saved instead.
+    Either way, only one batch is held in memory at a time.
+
+    Returns the name of the file that was written.
+    '''
+    if export_format not in EXPORT_FORMATS:
+        msg = 'Unknown export format "{}". Available formats: {}'
+        raise AbortError(msg.format(export_format, ', '.join(EXPORT_FORMATS)))
+
+    key_parts = parse_keys(input_keys_str)
+    columns, num_rows, str_widths = _column_types(resolve_results(), key_parts)
+    if not columns:
+        raise AbortError('None of the keys "{}" are present in the selected results'.format(input_keys_str))
+    batches = _batches(resolve_results(), key_parts, list(columns), batch_size)
+
+    if export_format != 'npz':
+        try:
+            import pyarrow  # noqa
+        except ImportError:
+            filename = os.path.splitext(filename)[0] + '.npz'
+            print_error('pyarrow is not installed; exporting to "{}" instead'.format(filename))
+            export_format = 'npz'
+
+    if export_format == 'npz':
+        _write_npz(filename, columns, batches, num_rows, str_widths)
+    else:
+        _write_arrow(filename, export_format, columns, batches)
+    return filename
+
+
+def _column_types(results, key_parts):
+    '''
+    Return an ordered mapping from each column name to a `(type, nullable)`
+    tuple, where the type is one of `COLUMN_TYPES`, along with the number of
+    results and the length of the longest value of each column as a string.
+    '''
+    seen_types = {}
+    num_values = {}
+    str_widths = {}
+    num_results = 0
+    for result in results:
+        num_results += 1
+        for expanded_key in expand_keys(result, key_parts):
+            column = '.'.join(expanded_key)
+            value = get_nested_item(result, expanded_key)
+            value_type = _value_type(value)
+            column_type = seen_types.setdefault(column, None)
+            if value_type is not None:
+                num_values[column] = num_values.get(column, 0) + 1
+                str_widths[column] = max(str_widths.get(column, 0), len(str(value)))
+                if column_type is None or COLUMN_TYPES.index(value_type) > COLUMN_TYPES.index(column_type):
+                    seen_types[column] = value_type
+
+    columns = OrderedDict()
+    for column in sorted(seen_types):
+        column_type = seen_types[column] or 'str'
+        columns[column] = (column_type, num_values.get(column, 0) < num_results)
+    return columns, num_results, str_widths
+
+
+def _value_type(value):
+    if value is None:
+        return None
+    elif isinstance(value, bool) or type(value).__name__ == 'bool_':
+        return 'bool'
+    elif isinstance(value, numbers.Integral):
+        return 'int'
+    elif isinstance(value, numbers.Real):
+        return 'float'
+    else:
+        return 'str'
+
+
+def _batches(results, key_parts, columns, batch_size):
+    '''
+    Yield the values of the columns, as a dict of lists, for each batch of
+    results.
+    '''
+    batch = {column: [] for column in columns}
+    num_rows = 0
+    for result in results:
+        row = {'.'.join(expanded_key): expanded_key for expanded_key in expand_keys(result, key_parts)}
+        for column in columns:
+            value = get_nested_item(result, row[column]) if column in row else None
+            batch[column].append(value)
+        num_rows += 1
+        if num_rows == batch_size:
+            yield batch
+            batch = {column: [] for column in columns}
+            num_rows = 0
+    if num_rows > 0:
+        yield batch
+
+
+def _write_arrow(filename, export_format, columns, batches):
+    import pyarrow as pa
+
+    arrow_types = {
+        'bool': pa.bool_(),
+        'int': pa.int64(),
+        'float': pa.float64(),
+        'str': pa.string(),
+    }
+    schema = pa.schema([(column, arrow_types[column_type]) for column, (column_type, _) in columns.items()])
+
+    if export_format == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(filename, schema)
+    else:
+        writer = pa.ipc.new_file(filename, schema)
+    try:
+        for batch in batches:
+            arrays = [
+                pa.array(_convert_values(batch[column], column_type), type=arrow_types[column_type])
+                for column, (column_type, _) in columns.items()
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+    finally:
+        writer.close()
+
+
+def _write_npz(filename, columns, batches, num_rows, str_widths):
+    import numpy as np
+
+    dtypes = []
+    for column, (column_type, nullable) in columns.items():
+        if column_type == 'str':
+            # strings are stored as fixed width unicode, which can be loaded
+            # without allowing pickles
+            dtypes.append((column, 'U{}'.format(max(str_widths.get(column, 0), 1))))
+        elif column_type == 'float' or nullable:
+            # NumPy has no missing integers or booleans, so NaN is used instead
+            dtypes.append((column, np.float64))
+        else:
+            dtypes.append((column, np.int64 if column_type == 'int' else np.bool_))
+    dtype = np.dtype(dtypes)
+
+    # the array is written into the archive batch by batch, after a header
+    # holding the number of rows counted while finding the columns
+    header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (num_rows,)}
+    num_written = 0
+    with zipfile.ZipFile(filename, 'w', allowZip64=True) as npz_file:
+        with npz_file.open('results.npy', 'w', force_zip64=True) as array_file:
+            try:
+                np.lib.format.write_array_header_1_0(array_file, header)
+            except ValueError:
+                np.lib.format.write_array_header_2_0(array_file, header)
+            for batch in batches:
+                batch_rows = len(next(iter(batch.values()))) if batch else 0
+                batch_array = np.zeros(batch_rows, dtype=dtype)
+                for column, (column_type, nullable) in columns.items():
+                    missing = '' if column_type == 'str' else np.nan
+                    values = [missing if value is None else value
+                              for value in _convert_values(batch[column], column_type)]
+                    batch_array[column] = values
+                array_file.write(batch_array.tobytes())
+                num_written += batch_rows
+    if num_written != num_rows:
+        os.remove(filename)
+        raise AbortError('The selected results changed while they were exported; {} results were found, '
+                         'and {} were written'.format(num_rows, num_written))
+
+
+def _convert_values(values, column_type):
+    if column_type == 'str':
+        return [None if value is None else str(value) for value in values]
+    elif column_type == 'float':
+        return [None if value is None else float(value) for value in values]
+    elif column_type == 'int':
+        return [None if value is None else int(value) for value in values]
+    else:
+        return [None if value is None else bool(value) for value in values]
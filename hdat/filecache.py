@@ -0,0 +1,94 @@
+import os
+import tempfile
+
+
+class FileCache:
+    '''
+    A bounded, least recently used cache of immutable files on disk, such as
+    objects fetched from a remote archive.
+
+    Files are named by their keys, which may contain "/".  Every time a file
+    is used its modification time is updated, and once the files take more
+    than `max_bytes`, the least recently used ones are removed.
+
+    The size of the cache is counted once, by listing its files, and is then
+    updated as files are added, so that files are only listed again when the
+    count exceeds `max_bytes`.  Files added by other processes sharing the
+    cache are only counted when it is listed again.
+    '''
+    def __init__(self, directory, max_bytes):
+        self.root = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        # the number of bytes in the cache when it was last listed, plus those
+        # added since, or None if it was not listed yet
+        self.total_bytes = None
+
+    def get(self, key, fetch):
+        '''
+        Return the name of the cached file of a key, calling `fetch(filename)`
+        to write it first if it is not cached.  Errors raised by `fetch` are
+        propagated, and nothing is cached.
+        '''
+        filename = self.filename(key)
+        try:
+            os.utime(filename)
+            return filename
+        except FileNotFoundError:
+            pass
+
+        temporary_filename = self._temporary_filename(filename)
+        try:
+            fetch(temporary_filename)
+            os.replace(temporary_filename, filename)
+        finally:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+        self._added(filename)
+        return filename
+
+    def evict(self, keep=None):
+        '''
+        Remove the least recently used files until the cache holds at most
+        `max_bytes`, never removing the file named `keep`.
+        '''
+        entries = []
+        total_bytes = 0
+        for root, dirs, files in os.walk(self.root):
+            for entry in files:
+                if entry.startswith('.'):
+                    continue
+                filename = os.path.join(root, entry)
+                try:
+                    stat = os.stat(filename)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, filename, stat.st_size))
+                total_bytes += stat.st_size
+
+        for _, filename, size in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if filename == keep:
+                continue
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+        self.total_bytes = total_bytes
+
+    def _added(self, filename):
+        if self.total_bytes is not None:
+            self.total_bytes += os.path.getsize(filename)
+        if self.total_bytes is None or self.total_bytes > self.max_bytes:
+            self.evict(keep=filename)
+
+    def filename(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def _temporary_filename(self, filename):
+        directory = os.path.dirname(filename)
+        os.makedirs(directory, exist_ok=True)
+        descriptor, temporary_filename = tempfile.mkstemp(prefix='.tmp-', dir=directory)
+        os.close(descriptor)
+        return temporary_filename
@@ -1,44 +1,143 @@
-import os
-import json
+import collections
 import copy
+import json
+import os
+import tempfile
+
+from . import arrayjson
 
 
 class GoldenStore:
-    def __init__(self, directory):
+    def __init__(self, directory, consolidated=None):
+        '''
+        Golden results are stored in a JSON file per case,
+        "<suite_id>/<case_id>.json".  When `consolidated` is true, they are
+        stored in a single JSON file per suite instead, "<suite_id>.json",
+        which maps each case id to its golden result with sorted keys, so
+        that it can be loaded in a single read and stays merge-friendly.  When
+        it is not given, the "consolidated" setting of the ".config.json"
+        file in the directory is used, if present.  Golden results are read
+        from either kind of file, preferring the per-case files.
+
+        Golden results which were read are cached, and only read again when
+        the modification time or size of their file changes.
+        '''
         self.root = os.path.abspath(directory)
         os.makedirs(self.root, exist_ok=True)
+        if consolidated is None:
+            consolidated = self._read_config().get('consolidated', False)
+        self.consolidated = consolidated
+        # file name -> ((modification time, size), contents)
+        self._cache = {}
 
     def select_golden(self, suite_id, case_id):
-        golden_filename = self._golden_filename(suite_id, case_id)
-        if not os.path.isfile(golden_filename):
-            return None
-        with open(golden_filename, 'r') as golden_file:
-            return json.load(golden_file)
+        golden_result = self._load(self._golden_filename(suite_id, case_id))
+        if golden_result is None:
+            golden_result = (self._load(self._suite_filename(suite_id)) or {}).get(case_id)
+        # copied, so that callers can not modify the cached golden results
+        return copy.deepcopy(golden_result)
+
+    def preload(self, suite_ids):
+        '''
+        Read the golden results of every case of the given suites into the
+        cache, so that later calls to `select_golden` only check that their
+        files did not change.
+        '''
+        for suite_id in suite_ids:
+            self._load(self._suite_filename(suite_id))
+            suite_directory = os.path.join(self.root, suite_id)
+            if not os.path.isdir(suite_directory):
+                continue
+            for entry in os.scandir(suite_directory):
+                if entry.name.endswith('.json') and entry.is_file():
+                    self._load(entry.path)
+
+    def insert(self, result, keep_perf=False):
+        '''
+        Store the metrics of a result as the golden result of its case.  The
+        perf measurements of the result are only stored when `keep_perf` is
+        true; otherwise the measurements of the previous golden result, if
+        any, are kept as the reference for performance checks.
+        '''
+        self.insert_many([result], keep_perf=keep_perf)
 
-    def insert(self, result):
-        result = self._strip_result(result)
+    def insert_many(self, results, keep_perf=False):
+        '''
+        Store the metrics of many results as golden results, like `insert`.
+        Consolidated suite files are written once for all of the results of
+        their suite, rather than once per result.
+        '''
+        suites_results = collections.OrderedDict()
+        for result in results:
+            result = self._strip_result(result)
 
-        suite_id = result['suite_id']
-        case_id = result['case_id']
+            suite_id = result['suite_id']
+            case_id = result['case_id']
 
-        suite_directory = os.path.join(self.root, suite_id)
-        os.makedirs(suite_directory, exist_ok=True)
+            if not keep_perf:
+                previous_result = self.select_golden(suite_id, case_id)
+                result.pop('perf', None)
+                if previous_result is not None and 'perf' in previous_result:
+                    result['perf'] = previous_result['perf']
 
-        golden_filename = self._golden_filename(suite_id, case_id)
-        with open(golden_filename, 'w') as golden_file:
-            json.dump(result, golden_file, sort_keys=True, indent=4)
+            if self.consolidated:
+                suites_results.setdefault(suite_id, {})[case_id] = result
+            else:
+                suite_directory = os.path.join(self.root, suite_id)
+                os.makedirs(suite_directory, exist_ok=True)
+                self._write(self._golden_filename(suite_id, case_id), result)
+
+        for suite_id, results_by_case in suites_results.items():
+            suite_results = copy.deepcopy(self._load(self._suite_filename(suite_id)) or {})
+            suite_results.update(results_by_case)
+            self._write(self._suite_filename(suite_id), suite_results)
+            # the per-case files would take precedence over the suite file
+            for case_id in results_by_case:
+                golden_filename = self._golden_filename(suite_id, case_id)
+                if os.path.exists(golden_filename):
+                    os.remove(golden_filename)
+
+    def _load(self, filename):
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            self._cache.pop(filename, None)
+            return None
+
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self._cache.get(filename)
+        if cached is None or cached[0] != version:
+            with open(filename, 'r') as golden_file:
+                cached = (version, arrayjson.load(golden_file))
+            self._cache[filename] = cached
+        return cached[1]
+
+    def _write(self, filename, contents):
+        descriptor, temporary_filename = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(filename))
+        with os.fdopen(descriptor, 'w') as golden_file:
+            arrayjson.dump(contents, golden_file, sort_keys=True, indent=4)
+        os.replace(temporary_filename, filename)
+        # the modification time may not change when a file is rewritten
+        # within the resolution of the file system, so it is read again
+        self._cache.pop(filename, None)
+
+    def _read_config(self):
+        config_filename = os.path.join(self.root, '.config.json')
+        if not os.path.isfile(config_filename):
+            return {}
+        with open(config_filename, 'r') as config_file:
+            return json.load(config_file)
 
     def _golden_filename(self, suite_id, case_id):
         return os.path.join(self.root, suite_id, case_id + '.json')
 
+    def _suite_filename(self, suite_id):
+        return os.path.join(self.root, suite_id + '.json')
+
     def _strip_result(self, result):
-        # we don't do a deep copy until we have deleted the potentially large
-        # "context" key
-        shallow_copied_result = copy.copy(result)
-        try:
-            del shallow_copied_result['context']
-            del shallow_copied_result['case_input']
-        except KeyError:
-            pass
-        deeply_copied_result = copy.deepcopy(shallow_copied_result)
+        # we don't do a deep copy until we have dropped the potentially large
+        # "context" key; iterating over the keys also avoids loading the
+        # context of results read lazily from the archive
+        stripped_result = {key: result[key] for key in result if key not in ('context', 'case_input')}
+        deeply_copied_result = copy.deepcopy(stripped_result)
         return deeply_copied_result
@@ -1,9 +1,15 @@
 import argparse
+import os
 import traceback
 
+from .archive import open_archive
+from .bench import BenchStore, bench_cases, format_bench
 from .resultspec import resolve_resultspecs, print_resultspec
-from .casespec import resolve_casespecs, select_suite
-from .reports import print_results
+from .casespec import parse_shard, resolve_casespecs, select_suite
+from .compression import parse_compression
+from .export import EXPORT_FORMATS, export_results
+from .profiling import PROFILERS, format_profile
+from .reports import print_results, stream_results
 from .runner import run_cases
 from .util import AbortError
 
@@ -20,16 +26,70 @@ def parse_arguments(arguments):
     run_parser = subparsers.add_parser('run', help=run_help)
     run_case_help = 'case specifier to run'
     run_parser.add_argument('casespecs', nargs='*', default=[''], metavar='<case>', help=run_case_help)
+    run_jobs_help = 'number of worker processes used to run cases in parallel'
+    run_parser.add_argument('-j', '--jobs', type=int, default=1, metavar='<n>', help=run_jobs_help)
+    run_incremental_help = 'reuse archived results of cases whose inputs and code are unchanged at this commit'
+    run_parser.add_argument('--incremental', action='store_true', help=run_incremental_help)
+    run_timeout_help = 'kill cases which run for longer than this many seconds, giving them the "timeout" status'
+    run_parser.add_argument('--timeout', type=float, metavar='<seconds>', help=run_timeout_help)
+    run_memory_help = 'kill cases whose resident memory exceeds this many MB, giving them the "oom" status'
+    run_parser.add_argument('--memory-limit', type=float, metavar='<MB>', help=run_memory_help)
+    run_trace_memory_help = 'record the peak memory allocated by Python in each case, which slows cases down'
+    run_parser.add_argument('--trace-memory', action='store_true', help=run_trace_memory_help)
+    run_check_perf_help = 'fail cases whose run time or peak memory regressed over the golden perf'
+    run_parser.add_argument('--check-perf', action='store_true', help=run_check_perf_help)
+    run_perf_tolerance_help = 'allowed regression of the run time and peak memory, as a fraction (default: 0.2)'
+    run_parser.add_argument('--perf-tolerance', type=float, default=0.2, metavar='<fraction>',
+                            help=run_perf_tolerance_help)
+    run_repeat_help = 'run each case this many times, keeping the fastest measurements'
+    run_parser.add_argument('--repeat', type=int, default=1, metavar='<n>', help=run_repeat_help)
+    run_profile_help = 'profile each case, storing the profile next to its result'
+    run_parser.add_argument('--profile', choices=PROFILERS, help=run_profile_help)
+    run_shard_help = 'only run the i-th of N shards of the cases, e.g. "2/4", to split a run over several machines'
+    run_parser.add_argument('--shard', metavar='<i/N>', help=run_shard_help)
+    run_balance_help = 'balance the shards by the run time of the most recent result of each case archived ' + \
+                       'before <time>, in seconds since the epoch, which every shard must be given'
+    run_parser.add_argument('--balance-before', metavar='<time>', type=float, help=run_balance_help)
+
+    bench_help = 'benchmark cases, without checking or archiving their results'
+    bench_parser = subparsers.add_parser('bench', help=bench_help)
+    bench_case_help = 'case specifier to benchmark'
+    bench_parser.add_argument('casespecs', nargs='*', default=[''], metavar='<case>', help=bench_case_help)
+    bench_warmup_help = 'number of unmeasured runs of each case before it is measured'
+    bench_parser.add_argument('--warmup', type=int, default=1, metavar='<n>', help=bench_warmup_help)
+    bench_repeat_help = 'number of measured runs of each case'
+    bench_parser.add_argument('--repeat', type=int, default=5, metavar='<n>', help=bench_repeat_help)
+    bench_compare_help = 'compare against the benchmarks saved at this, possibly abbreviated, commit'
+    bench_parser.add_argument('--compare', metavar='<commit>', help=bench_compare_help)
 
     show_help = 'visualize a single result'
     show_parser = subparsers.add_parser('show', help=show_help)
     show_result_help = 'result specifier to show'
     show_parser.add_argument('resultspecs', nargs='*', default=[''], metavar='<result>', help=show_result_help)
+    show_profile_help = 'print the top hotspots of the profiles of the results, instead of visualizing them'
+    show_parser.add_argument('--profile', action='store_true', help=show_profile_help)
+    show_top_help = 'number of hotspots printed with --profile'
+    show_parser.add_argument('--top', type=int, default=20, metavar='<n>', help=show_top_help)
 
     runshow_help = 'run then visualize a single result'
     runshow_parser = subparsers.add_parser('runshow', help=runshow_help)
     runshow_case_help = 'case specifier to run and show results'
     runshow_parser.add_argument('casespecs', nargs='*', default=[''], metavar='<case>', help=runshow_case_help)
+    runshow_parser.add_argument('-j', '--jobs', type=int, default=1, metavar='<n>', help=run_jobs_help)
+    runshow_parser.add_argument('--incremental', action='store_true', help=run_incremental_help)
+    runshow_parser.add_argument('--timeout', type=float, metavar='<seconds>', help=run_timeout_help)
+    runshow_parser.add_argument('--memory-limit', type=float, metavar='<MB>', help=run_memory_help)
+    runshow_parser.add_argument('--trace-memory', action='store_true', help=run_trace_memory_help)
+    runshow_parser.add_argument('--check-perf', action='store_true', help=run_check_perf_help)
+    runshow_parser.add_argument('--perf-tolerance', type=float, default=0.2, metavar='<fraction>',
+                                help=run_perf_tolerance_help)
+    runshow_parser.add_argument('--repeat', type=int, default=1, metavar='<n>', help=run_repeat_help)
+    runshow_parser.add_argument('--profile', choices=PROFILERS, help=run_profile_help)
+
+    merge_help = 'merge the results of other archives, e.g. those of sharded runs, into the archive'
+    merge_parser = subparsers.add_parser('merge', help=merge_help)
+    merge_archive_help = 'archive directory or object store URL to merge'
+    merge_parser.add_argument('archives', nargs='+', metavar='<archive>', help=merge_archive_help)
 
     diff_help = 'compare two results'
     diff_parser = subparsers.add_parser('diff', help=diff_help)
@@ -40,6 +100,8 @@ def parse_arguments(arguments):
     verify_parser = subparsers.add_parser('verify', help=verify_help)
     verify_result_help = 'results to be stripped and moved into the golden store'
     verify_parser.add_argument('resultspecs', nargs='*', default=[''], metavar='<result>', help=verify_result_help)
+    verify_perf_help = 'also store the run time and memory of the results, as the reference for --check-perf'
+    verify_parser.add_argument('--perf', action='store_true', help=verify_perf_help)
 
     csv_help = 'print results into a CSV'
     csv_parser = subparsers.add_parser('csv', help=csv_help)
@@ -47,21 +109,85 @@ def parse_arguments(arguments):
     csv_parser.add_argument('resultspecs', nargs='*', default=[''], metavar='<result>', help=csv_result_help)
     csv_keys_help = 'keys specifier to print data (\'*\' may be used as a wildcard)'
     csv_parser.add_argument('--keys', nargs='?', dest='keys', help=csv_keys_help)
+    csv_stream_help = 'write each row as soon as its result is read, instead of reading all results first'
+    csv_parser.add_argument('--stream', action='store_true', help=csv_stream_help)
+
+    export_help = 'export results into a typed, columnar file for analysis'
+    export_parser = subparsers.add_parser('export', help=export_help)
+    export_result_help = 'results to be exported'
+    export_parser.add_argument('resultspecs', nargs='*', default=[''], metavar='<result>', help=export_result_help)
+    export_parser.add_argument('--keys', nargs='?', dest='keys', help=csv_keys_help)
+    export_format_help = 'file format; "npz" is used if pyarrow is not installed'
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, default='parquet', help=export_format_help)
+    export_output_help = 'name of the file to write'
+    export_parser.add_argument('-o', '--output', required=True, metavar='<file>', help=export_output_help)
+    export_batch_help = 'number of results converted at a time'
+    export_parser.add_argument('--batch-size', type=int, default=1000, metavar='<n>', help=export_batch_help)
+
+    reindex_help = 'rebuild the archive index from the stored result files'
+    subparsers.add_parser('reindex', help=reindex_help)
+
+    archive_help = 'maintain the archive of results'
+    archive_parser = subparsers.add_parser('archive', help=archive_help)
+    archive_subparsers = archive_parser.add_subparsers(dest='archive_command', metavar='<archive command>')
+
+    compact_help = 'recompress stored results with the archive\'s compression codec'
+    compact_parser = archive_subparsers.add_parser('compact', help=compact_help)
+    compact_compression_help = 'compression codec and level to use instead of the archive\'s, e.g. "zstd:3"'
+    compact_parser.add_argument('--compression', metavar='<codec[:level]>', help=compact_compression_help)
+    compact_jobs_help = 'number of results to recompress in parallel'
+    compact_parser.add_argument('-j', '--jobs', type=int, default=1, metavar='<n>', help=compact_jobs_help)
+
+    prune_help = 'remove results which are not kept by any of the given retention policies'
+    prune_parser = archive_subparsers.add_parser('prune', help=prune_help)
+    prune_keep_last_help = 'keep the given number of most recent results of each case'
+    prune_parser.add_argument('--keep-last', type=int, metavar='<n>', help=prune_keep_last_help)
+    prune_older_than_help = 'keep results which ran within the given number of days'
+    prune_parser.add_argument('--older-than', type=float, metavar='<days>', help=prune_older_than_help)
+    prune_keep_golden_help = 'keep results which were verified into the golden store'
+    prune_parser.add_argument('--keep-golden', action='store_true', help=prune_keep_golden_help)
+    prune_jobs_help = 'number of results to remove in parallel'
+    prune_parser.add_argument('-j', '--jobs', type=int, default=1, metavar='<n>', help=prune_jobs_help)
+    prune_dry_run_help = 'only print the results which would be removed'
+    prune_parser.add_argument('--dry-run', action='store_true', help=prune_dry_run_help)
+
+    gc_help = 'remove stored contexts which no result refers to anymore'
+    gc_parser = archive_subparsers.add_parser('gc', help=gc_help)
+    gc_grace_help = 'keep unreferenced contexts written within this many seconds (default: 3600)'
+    gc_parser.add_argument('--grace-period', type=float, default=3600, metavar='<seconds>', help=gc_grace_help)
 
     return parser.parse_args(arguments)
 
 
 def _format_cases_status(cases_status):
-    return 'PASS: {}, FAIL: {}, UNKNOWN: {}, ERROR: {}'.format(
+    return 'PASS: {}, FAIL: {}, UNKNOWN: {}, ERROR: {}, TIMEOUT: {}, OOM: {}'.format(
         cases_status['pass'],
         cases_status['fail'],
         cases_status['unknown'],
         cases_status['error'],
+        cases_status['timeout'],
+        cases_status['oom'],
     )
 
 
+def _memory_limit_bytes(memory_limit):
+    return None if memory_limit is None else int(memory_limit * 2**20)
+
+
+def _validate_arguments(args):
+    if getattr(args, 'jobs', 1) < 1:
+        raise AbortError('The number of jobs must be at least 1, got {}'.format(args.jobs))
+    if getattr(args, 'repeat', 1) < 1:
+        raise AbortError('The number of repeats must be at least 1, got {}'.format(args.repeat))
+    if getattr(args, 'keep_last', None) is not None and args.keep_last < 1:
+        raise AbortError('The number of results to keep must be at least 1, got {}'.format(args.keep_last))
+    if getattr(args, 'older_than', None) is not None and args.older_than < 0:
+        raise AbortError('The age of the results to remove must not be negative, got {}'.format(args.older_than))
+
+
 def hdat_cli(arguments, suites, golden_store, archive, git_info):
     args = parse_arguments(arguments)
+    _validate_arguments(args)
 
     if args.command is None:
         parse_arguments(['-h'])
@@ -69,23 +195,61 @@ def hdat_cli(arguments, suites, golden_store, archive, git_info):
         cases = resolve_casespecs(suites, args.casespecs)
         print("\n".join(['{}/{}'.format(suite_id, case_id) for suite_id, case_id in cases]))
     elif args.command == 'run':
-        cases = resolve_casespecs(suites, args.casespecs)
-        cases_status = run_cases(suites, golden_store, archive, git_info, cases)
+        shard = None if args.shard is None else parse_shard(args.shard)
+        cases = resolve_casespecs(suites, args.casespecs, shard=shard,
+                                  archive=archive if args.balance_before is not None else None,
+                                  balance_before=args.balance_before)
+        cases_status = run_cases(suites, golden_store, archive, git_info, cases, jobs=args.jobs,
+                                 incremental=args.incremental, timeout=args.timeout,
+                                 memory_limit=_memory_limit_bytes(args.memory_limit),
+                                 trace_memory=args.trace_memory, repeat=args.repeat,
+                                 perf_tolerance=args.perf_tolerance if args.check_perf else None,
+                                 profiler=args.profile)
         if cases_status['pass'] < len(cases):
             raise AbortError(_format_cases_status(cases_status))
+    elif args.command == 'bench':
+        cases = resolve_casespecs(suites, args.casespecs)
+        bench_store = BenchStore(os.path.join(archive.root, '.bench'))
+        baseline = None
+        if args.compare is not None:
+            baseline = bench_store.select(args.compare)
+            if baseline is None:
+                raise AbortError('No benchmarks were saved at the commit "{}"'.format(args.compare))
+        bench = bench_cases(suites, git_info, cases, warmup=args.warmup, repeat=args.repeat)
+        bench_store.insert(bench)
+        print(format_bench(bench, baseline))
     elif args.command == 'show':
         results = resolve_resultspecs(archive, suites, args.resultspecs)
         for result in results:
-            show_result(suites, result)
+            if args.profile:
+                show_profile(archive, result, args.top)
+            else:
+                show_result(suites, result)
     elif args.command == 'runshow':
         cases = resolve_casespecs(suites, args.casespecs)
-        cases_status = run_cases(suites, golden_store, archive, git_info, cases)
+        cases_status = run_cases(suites, golden_store, archive, git_info, cases, jobs=args.jobs,
+                                 incremental=args.incremental, timeout=args.timeout,
+                                 memory_limit=_memory_limit_bytes(args.memory_limit),
+                                 trace_memory=args.trace_memory, repeat=args.repeat,
+                                 perf_tolerance=args.perf_tolerance if args.check_perf else None,
+                                 profiler=args.profile)
         if cases_status['error'] > 0:
             raise AbortError(_format_cases_status(cases_status))
         for casespec in args.casespecs:
             results = resolve_resultspecs(archive, suites, casespec)
             for result in results:
                 show_result(suites, result)
+    elif args.command == 'merge':
+        merged = []
+        for location in args.archives:
+            if '://' not in location and not os.path.isdir(location):
+                raise AbortError('Unable to locate the archive "{}"'.format(location))
+            merged.extend(archive.merge(open_archive(location)))
+        print('Merged {} results into the archive at "{}"'.format(len(merged), archive.location))
+        cases_status = merged_cases_status(merged)
+        if cases_status['pass'] < sum(cases_status.values()):
+            raise AbortError(_format_cases_status(cases_status))
+        print(_format_cases_status(cases_status))
     elif args.command == 'diff':
         golden_results = resolve_resultspecs(archive, suites, [args.resultspecs[0]])
         results = resolve_resultspecs(archive, suites, [args.resultspecs[1]])
@@ -93,11 +257,83 @@ def hdat_cli(arguments, suites, golden_store, archive, git_info):
             diff_results(suites, golden_result, result)
     elif args.command == 'verify':
         results = resolve_resultspecs(archive, suites, args.resultspecs)
-        for result in results:
-            golden_store.insert(result)
+        golden_store.insert_many(results, keep_perf=args.perf)
     elif args.command == 'csv':
-        results = resolve_resultspecs(archive, suites, args.resultspecs)
-        print_results(results, args.keys)
+        if args.stream:
+            stream_results(lambda: resolve_resultspecs(archive, suites, args.resultspecs), args.keys)
+        else:
+            results = resolve_resultspecs(archive, suites, args.resultspecs)
+            print_results(results, args.keys)
+    elif args.command == 'export':
+        filename = export_results(
+            lambda: resolve_resultspecs(archive, suites, args.resultspecs),
+            args.keys,
+            args.output,
+            args.format,
+            batch_size=args.batch_size,
+        )
+        print('Exported results to "{}"'.format(filename))
+    elif args.command == 'reindex':
+        num_results = archive.reindex()
+        print('Indexed {} results in the archive at "{}"'.format(num_results, archive.root))
+    elif args.command == 'archive':
+        archive_cli(args, golden_store, archive)
+
+
+def archive_cli(args, golden_store, archive):
+    if args.archive_command is None:
+        parse_arguments(['archive', '-h'])
+    elif args.archive_command == 'compact':
+        if args.compression is not None:
+            archive.codec, archive.level = parse_compression(args.compression)
+        num_rewritten = archive.compact(jobs=args.jobs)
+        print('Rewrote {} results and contexts with "{}"'.format(num_rewritten, archive.codec))
+    elif args.archive_command == 'prune':
+        keep_results = golden_result_keys(archive, golden_store) if args.keep_golden else ()
+        older_than = None if args.older_than is None else args.older_than * 24 * 60 * 60
+        pruned = archive.prune(keep_last=args.keep_last, older_than=older_than, keep_results=keep_results,
+                               jobs=args.jobs, dry_run=args.dry_run)
+        if args.dry_run:
+            print("\n".join('/'.join(key) for key in pruned))
+        else:
+            num_removed = archive.gc()
+            print('Removed {} results and {} unreferenced contexts'.format(len(pruned), num_removed))
+    elif args.archive_command == 'gc':
+        num_removed = archive.gc(grace_period=args.grace_period)
+        print('Removed {} unreferenced contexts'.format(num_removed))
+
+
+def merged_cases_status(results):
+    '''
+    Count the statuses of the most recent of the given results of each case.
+    '''
+    recent_results = {}
+    for result in results:
+        key = (result['suite_id'], result['case_id'])
+        if key not in recent_results or (result.get('ran_on') or 0) >= (recent_results[key].get('ran_on') or 0):
+            recent_results[key] = result
+    cases_status = dict.fromkeys(['pass', 'fail', 'unknown', 'error', 'timeout', 'oom'], 0)
+    for result in recent_results.values():
+        status = result.get('status', 'unknown')
+        cases_status[status] = cases_status.get(status, 0) + 1
+    return cases_status
+
+
+def golden_result_keys(archive, golden_store):
+    keys = set()
+    for suite_id, case_id, _, _ in archive.index.select_results():
+        golden_result = golden_store.select_golden(suite_id, case_id)
+        if golden_result is not None:
+            keys.add((suite_id, case_id, golden_result['result_id']))
+    return keys
+
+
+def show_profile(archive, result, limit):
+    profile_filename = archive.profile_filename(result)
+    if profile_filename is None or not os.path.isfile(profile_filename):
+        raise AbortError('No profile was recorded for "{}"'.format(print_resultspec(result)))
+    print('PROFILE "{}"'.format(print_resultspec(result)))
+    print(format_profile(result['profile'], profile_filename, limit))
 
 
 def show_result(suites, result):
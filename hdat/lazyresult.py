@@ -0,0 +1,38 @@
+from collections.abc import Mapping
+
+
+class LazyResult(Mapping):
+    '''
+    A read-only result whose potentially large context is only loaded the
+    first time the "context" key is accessed.
+
+    All of the other keys are held in memory, so reports that only need the
+    metadata and metrics of a result never read its context.
+    '''
+    def __init__(self, metadata, load_context=None):
+        self._metadata = metadata
+        self._load_context = load_context
+        self._context_loaded = False
+        self._context = None
+
+    def __getitem__(self, key):
+        if key == 'context' and self._load_context is not None:
+            if not self._context_loaded:
+                self._context = self._load_context()
+                self._context_loaded = True
+            return self._context
+        return self._metadata[key]
+
+    def __contains__(self, key):
+        return key in self._metadata or (key == 'context' and self._load_context is not None)
+
+    def __iter__(self):
+        yield from self._metadata
+        if self._load_context is not None:
+            yield 'context'
+
+    def __len__(self):
+        return len(self._metadata) + (self._load_context is not None)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self._metadata)
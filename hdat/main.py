@@ -4,10 +4,10 @@ import os
 
 from hdat.hdat_cli import hdat_cli
 from hdat.suite import collect_suites
-from hdat.source_control import git_info_from_directory
+from hdat.source_control import LazyGitInfo
 from hdat.util import repository_root, print_error, AbortError
 from hdat.goldenstore import GoldenStore
-from hdat.archive import Archive
+from hdat.archive import open_archive
 
 
 def main():
@@ -15,15 +15,15 @@ def main():
     sys.path.append(cwd)
 
     try:
-        git_info = git_info_from_directory(cwd)
+        git_info = LazyGitInfo(cwd)
         repo_directory = repository_root(cwd)
-        suites = collect_suites(repo_directory)
+        suites = collect_suites(repo_directory, os.path.join(repo_directory, '.hdatcache', 'suites.json'))
 
         if 'HDAT_ARCHIVE' in os.environ:
             archive_location = os.environ['HDAT_ARCHIVE']
         else:
             archive_location = os.path.join(repo_directory, '.hdatarchive')
-        archive = Archive(archive_location)
+        archive = open_archive(archive_location, compression=os.environ.get('HDAT_ARCHIVE_COMPRESSION'))
 
         golden_store_location = os.path.join(repo_directory, 'golden_results')
         golden_store = GoldenStore(golden_store_location)
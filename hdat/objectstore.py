@@ -0,0 +1,310 @@
+import functools
+import os
+import pickle
+import shutil
+import tempfile
+
+from .archive import BaseArchive, STORAGE_VERSION, _is_storage_record
+from .compression import open_compressed, open_decompressed, parse_compression
+from .filecache import FileCache
+from .lazyresult import LazyResult
+from .profiling import PROFILE_SUFFIXES
+from .util import AbortError
+
+# default size of the local cache of objects fetched from the store, in MB
+DEFAULT_CACHE_SIZE = 1024
+
+# error codes of the S3 API meaning that an object does not exist
+MISSING_CODES = ('NoSuchKey', '404', 'NotFound')
+
+# keys of the result fields stored in the metadata of result objects, so
+# that results can be filtered without fetching them
+METADATA_KEYS = (('commit', 'hdat-commit'), ('input_hash', 'hdat-input-hash'))
+
+
+class ObjectStoreArchive(BaseArchive):
+    """
+    An archive in a bucket of an S3-compatible object store, so that runners
+    on several machines can share it without a shared file system.
+
+    Each result is stored as two objects, "<prefix>/<suite>/<case>/<id>.pkl"
+    holding its metadata and metrics, and "<id>.context" holding its
+    compressed context, which is only fetched when it is accessed.  The
+    commit and input hash of the result are also stored in the metadata of
+    the ".pkl" object, so that results can be filtered by them without
+    fetching them.  Objects
+    are never modified once written, so the fetched objects are kept in a
+    bounded local cache, and repeated reads of a result are served from disk.
+
+    The store is listed in place of an index, so there is nothing to compact,
+    collect or reindex.
+    """
+    def __init__(self, url, compression=None, cache_directory=None, cache_size=None, client=None):
+        """
+        `url` is of the form "s3://bucket/prefix".  The cache directory
+        defaults to the "HDAT_ARCHIVE_CACHE" environment variable, or a
+        directory per bucket and prefix in "~/.cache/hdat", and its size, in
+        MB, to "HDAT_ARCHIVE_CACHE_SIZE", or 1024 MB.  Object stores other than
+        AWS S3, such as MinIO, are selected by setting "HDAT_S3_ENDPOINT_URL".
+        """
+        if not url.startswith('s3://') or not url[len('s3://'):].strip('/'):
+            raise AbortError('Invalid object store URL "{}"; expected "s3://bucket/prefix"'.format(url))
+        self.location = url
+        self.bucket, _, prefix = url[len('s3://'):].partition('/')
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+        if cache_directory is None:
+            cache_directory = os.environ.get('HDAT_ARCHIVE_CACHE') or os.path.join(
+                os.path.expanduser('~'), '.cache', 'hdat', self.bucket, *self.prefix.split('/'))
+        if cache_size is None:
+            cache_size = float(os.environ.get('HDAT_ARCHIVE_CACHE_SIZE') or DEFAULT_CACHE_SIZE)
+        self.root = os.path.abspath(cache_directory)
+        self.cache = FileCache(os.path.join(self.root, 'objects'), int(cache_size * 2**20))
+
+        self.codec, self.level = parse_compression(compression)
+        self.client = _s3_client() if client is None else client
+        self.index = ObjectStoreIndex(self)
+
+    def select(self, suite_id, case_id, result_id):
+        """
+        Return a single result specified, or None if it is not in the archive
+        """
+        try:
+            filename = self._fetch(self._result_key(suite_id, case_id, result_id))
+        except KeyError:
+            return None
+        return self.read_result(filename)
+
+    def insert(self, result):
+        result_key = self._result_key(result['suite_id'], result['case_id'], result['result_id'])
+        if self._exists(result_key):
+            raise IOError('Result object exists "{}"'.format(result_key))
+
+        metadata = {key: result[key] for key in result if key != 'context'}
+        if 'context' in result:
+            context_key = _replace_suffix(result_key, '.context')
+            self._put_context(context_key, result['context'])
+            context_descriptor = {'key': context_key}
+        else:
+            context_descriptor = None
+
+        # the context is written before the record, so that readers never
+        # find a result whose context is missing
+        record = {
+            'hdat_storage': STORAGE_VERSION,
+            'result': metadata,
+            'context': context_descriptor,
+        }
+        metadata = {metadata_key: str(result.get(key) or '') for key, metadata_key in METADATA_KEYS}
+        self.client.put_object(Bucket=self.bucket, Key=result_key, Body=pickle.dumps(record), Metadata=metadata)
+        self.index.insert(result)
+
+    def insert_profile(self, result, profile_data):
+        """
+        Store the profile of an archived result next to it, in the format of
+        the profiler named by the result's "profile" key.
+        """
+        self.client.put_object(Bucket=self.bucket, Key=self._profile_key(result), Body=profile_data)
+
+    def profile_filename(self, result):
+        """
+        Return the name of the locally cached file of the profile of a result,
+        or None if the result was not profiled.
+        """
+        if result.get('profile') is None:
+            return None
+        try:
+            return self._fetch(self._profile_key(result))
+        except KeyError:
+            return None
+
+    def read_result(self, filename):
+        """
+        Read a result record.  Results are returned as a `LazyResult`, which
+        only fetches the context when it is accessed.
+        """
+        with open(filename, 'rb') as result_file:
+            record = pickle.load(result_file)
+
+        if not _is_storage_record(record):
+            return record
+        elif record['context'] is None:
+            return LazyResult(record['result'])
+        return LazyResult(record['result'], functools.partial(self._read_context, record['context']['key']))
+
+    def _put_context(self, key, context):
+        descriptor, temporary_filename = tempfile.mkstemp(prefix='.context-')
+        os.close(descriptor)
+        try:
+            with open_compressed(temporary_filename, self.codec, self.level) as context_file:
+                pickle.dump(context, context_file, protocol=pickle.HIGHEST_PROTOCOL)
+            self.client.upload_file(temporary_filename, self.bucket, key)
+        finally:
+            os.remove(temporary_filename)
+
+    def _read_context(self, key):
+        with open_decompressed(self._fetch(key)) as context_file:
+            return pickle.load(context_file)
+
+    def _fetch(self, key):
+        """
+        Return the name of the locally cached copy of an object, fetching it
+        if needed, and raising a KeyError if it does not exist.
+        """
+        def download(filename):
+            try:
+                response = self.client.get_object(Bucket=self.bucket, Key=key)
+            except Exception as e:
+                if _is_missing(e):
+                    raise KeyError(key)
+                raise
+            with open(filename, 'wb') as object_file:
+                shutil.copyfileobj(response['Body'], object_file)
+
+        return self.cache.get(key, download)
+
+    def _exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except Exception as e:
+            if _is_missing(e):
+                return False
+            raise
+
+    def _result_key(self, suite_id, case_id, result_id):
+        return '{}{}/{}/{}.pkl'.format(self.prefix, suite_id, case_id, result_id)
+
+    def _profile_key(self, result):
+        result_key = self._result_key(result['suite_id'], result['case_id'], result['result_id'])
+        return _replace_suffix(result_key, PROFILE_SUFFIXES[result['profile']])
+
+
+class ObjectStoreIndex:
+    """
+    Lists the results of an `ObjectStoreArchive`, with the same `select_*`
+    methods as `ArchiveIndex`, by listing the objects in the store.
+    """
+    def __init__(self, archive):
+        self.archive = archive
+        # (suite_id, case_id, result_id) -> the fields of METADATA_KEYS of a
+        # result, which never change once it is stored
+        self._metadata = {}
+
+    def insert(self, result):
+        pass
+
+    def select_result_ids(self, suite_id, case_id, commit_id=None, input_hash=None, before=None):
+        '''
+        Return the ids of all results of a case, from oldest to most recent,
+        optionally only those run at a commit, with an input hash, or before
+        the time `before`, which is read from the result ids.  The
+        results are filtered using the metadata of their objects, which is
+        read with a HEAD request per result the first time; results stored
+        without it are fetched instead.
+        '''
+        case_prefix = '{}{}/{}/'.format(self.archive.prefix, suite_id, case_id)
+        result_ids = sorted(
+            (key[len(case_prefix):-len('.pkl')] for key in self._list_keys(case_prefix) if key.endswith('.pkl')),
+            key=_result_id_order,
+        )
+        if before is not None:
+            result_ids = [result_id for result_id in result_ids if 0 < _result_id_order(result_id)[0] < before]
+        if commit_id is None and input_hash is None:
+            return result_ids
+
+        selected = []
+        for result_id in result_ids:
+            fields = self._result_fields(suite_id, case_id, result_id)
+            if fields is None:
+                continue
+            if commit_id is not None and fields['commit'] != commit_id:
+                continue
+            if input_hash is not None and fields['input_hash'] != input_hash:
+                continue
+            selected.append(result_id)
+        return selected
+
+    def _result_fields(self, suite_id, case_id, result_id):
+        cache_key = (suite_id, case_id, result_id)
+        if cache_key in self._metadata:
+            return self._metadata[cache_key]
+
+        try:
+            response = self.archive.client.head_object(
+                Bucket=self.archive.bucket, Key=self.archive._result_key(suite_id, case_id, result_id))
+        except Exception as e:
+            if _is_missing(e):
+                return None
+            raise
+        metadata = response.get('Metadata') or {}
+        if all(metadata_key in metadata for _, metadata_key in METADATA_KEYS):
+            fields = {key: metadata[metadata_key] or None for key, metadata_key in METADATA_KEYS}
+        else:
+            result = self.archive.select(suite_id, case_id, result_id)
+            if result is None:
+                return None
+            fields = {key: result.get(key) for key, _ in METADATA_KEYS}
+        self._metadata[cache_key] = fields
+        return fields
+
+    def select_results(self):
+        '''
+        Return `(suite_id, case_id, result_id, ran_on)` tuples for every result,
+        grouped by case, from oldest to most recent within each case.  The
+        times are read from the result ids.
+        '''
+        rows = []
+        for key in self._list_keys(self.archive.prefix):
+            parts = key[len(self.archive.prefix):].split('/')
+            if len(parts) != 3 or not parts[2].endswith('.pkl'):
+                continue
+            suite_id, case_id, entry = parts
+            result_id = entry[:-len('.pkl')]
+            rows.append((suite_id, case_id, result_id, _result_id_order(result_id)[0]))
+        return sorted(rows, key=lambda row: (row[0], row[1], row[3] or 0, row[2]))
+
+    def select_case_ids(self, suite_id):
+        return set(self._list_directories('{}{}/'.format(self.archive.prefix, suite_id)))
+
+    def select_suite_ids(self):
+        return set(self._list_directories(self.archive.prefix))
+
+    def _list_keys(self, prefix):
+        paginator = self.archive.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.archive.bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                yield item['Key']
+
+    def _list_directories(self, prefix):
+        paginator = self.archive.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.archive.bucket, Prefix=prefix, Delimiter='/'):
+            for item in page.get('CommonPrefixes', []):
+                yield item['Prefix'][len(prefix):].rstrip('/')
+
+
+def _s3_client():
+    try:
+        import boto3
+    except ImportError:
+        raise AbortError('The "boto3" package is required to use archives in object stores')
+    return boto3.client('s3', endpoint_url=os.environ.get('HDAT_S3_ENDPOINT_URL'))
+
+
+def _is_missing(error):
+    response = getattr(error, 'response', None)
+    return isinstance(response, dict) and response.get('Error', {}).get('Code') in MISSING_CODES
+
+
+def _result_id_order(result_id):
+    # result ids start with the time the case was run (see
+    # `hdat.runner.build_result_id`); ids that do not are sorted first
+    try:
+        ran_on = float(result_id.split('_', 1)[0])
+    except ValueError:
+        ran_on = None
+    return (ran_on or 0, result_id)
+
+
+def _replace_suffix(key, suffix):
+    return key[:-len('.pkl')] + suffix
@@ -0,0 +1,99 @@
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+@contextmanager
+def measure(perf, phase, trace_memory=False):
+    '''
+    Measure the wall time and CPU time of the block, adding them to the flat
+    `perf` dict as "<phase>_wall_time" and "<phase>_cpu_time".  When
+    `trace_memory` is true, the peak of the memory allocated by Python
+    during the block is also recorded, as "<phase>_traced_peak".
+    '''
+    if trace_memory:
+        tracemalloc.start()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield perf
+    finally:
+        perf[phase + '_wall_time'] = time.perf_counter() - wall_start
+        perf[phase + '_cpu_time'] = time.process_time() - cpu_start
+        if trace_memory:
+            perf[phase + '_traced_peak'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+def peak_rss():
+    '''
+    Return the peak resident memory of this process in bytes, or None where
+    it is not available.
+    '''
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def reset_peak_rss():
+    '''
+    Reset the peak resident memory returned by `current_peak_rss` to the
+    current resident memory, returning False where the OS does not allow it.
+    Only Linux does.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def current_peak_rss():
+    '''
+    Return the peak resident memory of this process since it started, or
+    since the last successful `reset_peak_rss`, in bytes.
+    '''
+    try:
+        with open('/proc/self/status', 'r') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return peak_rss()
+
+
+def format_perf_summary(case_perfs, num_slowest=5):
+    '''
+    Summarize the perf dicts of the cases of a run, given as a list of
+    `(casespec, perf)` tuples, into a few lines of text.
+    '''
+    case_perfs = [(casespec, perf) for casespec, perf in case_perfs if 'run_wall_time' in perf]
+    if not case_perfs:
+        return 'No cases were run'
+
+    lines = []
+    for phase in ('run', 'check', 'insert'):
+        wall_times = [perf.get(phase + '_wall_time', 0.0) for _, perf in case_perfs]
+        cpu_times = [perf.get(phase + '_cpu_time', 0.0) for _, perf in case_perfs]
+        msg = '{}: {:.3f} s wall, {:.3f} s CPU in total; {:.3f} s wall at most'
+        lines.append(msg.format(phase.upper(), sum(wall_times), sum(cpu_times), max(wall_times)))
+
+    peak_rsss = [perf['run_peak_rss'] for _, perf in case_perfs if 'run_peak_rss' in perf]
+    if peak_rsss:
+        lines.append('PEAK RSS: {:.1f} MB'.format(max(peak_rsss) / 2**20))
+
+    slowest = sorted(case_perfs, key=lambda case_perf: case_perf[1]['run_wall_time'], reverse=True)
+    lines.append('SLOWEST: ' + ', '.join(
+        '{} ({:.3f} s)'.format(casespec, perf['run_wall_time']) for casespec, perf in slowest[:num_slowest]
+    ))
+    return '\n'.join(lines)
@@ -0,0 +1,70 @@
+import cProfile
+import io
+import marshal
+import pickle
+import pstats
+import tracemalloc
+
+# profiler name -> suffix of the profile files stored next to the results
+PROFILE_SUFFIXES = {
+    'cprofile': '.pstats',
+    'tracemalloc': '.tracemalloc',
+}
+
+PROFILERS = tuple(sorted(PROFILE_SUFFIXES))
+
+# number of frames recorded for each traced memory allocation
+TRACEMALLOC_FRAMES = 25
+
+
+def profile_call(profiler, fn, *args):
+    '''
+    Call `fn(*args)` under a profiler, returning its return value and the
+    profile as bytes.  cProfile profiles are in the format written by
+    `pstats.Stats.dump_stats`, and tracemalloc profiles in the format written
+    by `tracemalloc.Snapshot.dump`, so that both can be loaded by the
+    standard library from the stored files.
+    '''
+    if profiler == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            value = fn(*args)
+        finally:
+            profile.disable()
+        return value, marshal.dumps(pstats.Stats(profile).stats)
+    elif profiler == 'tracemalloc':
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        try:
+            value = fn(*args)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        return value, pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL)
+    else:
+        raise ValueError('Unknown profiler "{}"'.format(profiler))
+
+
+def format_profile(profiler, filename, limit=20):
+    '''
+    Return the `limit` top hotspots of a stored profile as text: the
+    functions with the largest cumulative time, or the lines which allocated
+    the most memory that was still allocated at the end of the run.
+    '''
+    if profiler == 'cprofile':
+        stream = io.StringIO()
+        stats = pstats.Stats(filename, stream=stream)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+    elif profiler == 'tracemalloc':
+        snapshot = tracemalloc.Snapshot.load(filename)
+        statistics = snapshot.statistics('lineno')
+        lines = ['Top {} lines allocating memory:'.format(min(limit, len(statistics)))]
+        for statistic in statistics[:limit]:
+            frame = statistic.traceback[0]
+            msg = '{}:{}: {:.1f} KiB in {} blocks'
+            lines.append(msg.format(frame.filename, frame.lineno, statistic.size / 1024, statistic.count))
+        lines.append('Total: {:.1f} KiB'.format(sum(statistic.size for statistic in statistics) / 1024))
+        return '\n'.join(lines)
+    else:
+        raise ValueError('Unknown profiler "{}"'.format(profiler))
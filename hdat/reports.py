@@ -28,23 +28,42 @@ def get_nested_item(result, nested_key):
         return
 
 
-def print_results(results, input_keys_str):
+DEFAULT_KEYS = 'case_id,result_id,ran_on,commit,metrics.*'
+
+
+def parse_keys(input_keys_str):
     if not input_keys_str:
-        input_keys_str = 'case_id,result_id,ran_on,commit,metrics.*'
+        input_keys_str = DEFAULT_KEYS
     reader_keys = csv.reader([input_keys_str])
     input_keys = [key.strip() for key in list(reader_keys)[0]]
-    key_parts = [key.split('.') for key in input_keys]
+    return [key.split('.') for key in input_keys]
+
+
+def has_wildcards(key_parts):
+    return any(ks[-1] == '*' for ks in key_parts)
+
+
+def expand_keys(result, key_parts):
+    expanded_keys_gens = [expand_key_parts(result, ks) for ks in key_parts]
+    return chain.from_iterable(expanded_keys_gens)
+
+
+def extract_result_data(result, key_parts):
+    result_data = defaultdict(lambda: '')
+    for expanded_key in expand_keys(result, key_parts):
+        result_key = '.'.join(expanded_key)
+        result_data[result_key] = get_nested_item(result, expanded_key)
+    return result_data
+
+
+def print_results(results, input_keys_str):
+    key_parts = parse_keys(input_keys_str)
 
     keys = set()
     all_result_data = []
     for result in results:
-        result_data = defaultdict(lambda: '')
-        expanded_keys_gens = [expand_key_parts(result, ks) for ks in key_parts]
-        expanded_keys = chain.from_iterable(expanded_keys_gens)
-        for expanded_key in expanded_keys:
-            result_key = '.'.join(expanded_key)
-            keys.add(result_key)
-            result_data[result_key] = get_nested_item(result, expanded_key)
+        result_data = extract_result_data(result, key_parts)
+        keys.update(result_data.keys())
         all_result_data.append(result_data)
 
     output_writer = csv.writer(sys.stdout)
@@ -53,3 +72,30 @@ def print_results(results, input_keys_str):
     for result_data in all_result_data:
         data_out = [result_data[key] for key in sorted_keys]
         output_writer.writerow(data_out)
+
+
+def stream_results(resolve_results, input_keys_str):
+    """
+    Print the same CSV as `print_results`, but write each row as soon as its
+    result is resolved, without holding on to the results.
+
+    `resolve_results` is a function returning an iterable of the results.
+    When the keys contain wildcards, it is called twice: the first pass only
+    collects the expanded keys for the header, which only needs the metadata
+    of archived results.
+    """
+    key_parts = parse_keys(input_keys_str)
+
+    if has_wildcards(key_parts):
+        keys = set()
+        for result in resolve_results():
+            keys.update('.'.join(expanded_key) for expanded_key in expand_keys(result, key_parts))
+    else:
+        keys = set('.'.join(ks) for ks in key_parts)
+
+    output_writer = csv.writer(sys.stdout)
+    sorted_keys = sorted(list(keys))
+    output_writer.writerow(sorted_keys)
+    for result in resolve_results():
+        result_data = extract_result_data(result, key_parts)
+        output_writer.writerow([result_data[key] for key in sorted_keys])
@@ -1,6 +1,7 @@
 import os
 import traceback
 
+from .suite import collect_cases
 from .util import AbortError
 
 
@@ -37,7 +38,7 @@ def resolve_resultspec(archive, suites, resultspec):
     pick_by_result_id = len(resultspec_parts) == 3 and not pick_by_index
 
     if pick_recent or pick_by_index:
-        if resultspec_parts[1] not in suites[resultspec_parts[0]].collect().keys():
+        if resultspec_parts[1] not in collect_cases(suites[resultspec_parts[0]]).keys():
             msg = 'Unable to locate "{}"; the case "{}" does not exist within suite "{}"'
             raise AbortError(msg.format(resultspec, resultspec_parts[1], resultspec_parts[0]))
         if pick_recent:
@@ -59,7 +60,7 @@ def resolve_resultspec(archive, suites, resultspec):
         result = archive.select(*resultspec_parts)
         if result is None:
             msg = 'Unable to locate result "{}" in the archive at "{}"'
-            raise AbortError(msg.format(resultspec, archive.root))
+            raise AbortError(msg.format(resultspec, archive.location))
         else:
             return [result]
     elif pick_recents_all_suites:
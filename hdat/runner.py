@@ -1,60 +1,617 @@
 import datetime
+import functools
+import hashlib
+import inspect
+import math
+import multiprocessing.util
+import os
+import pickle
+import time
 import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 from .casespec import print_casespec
+from .perf import format_perf_summary, measure, peak_rss
+from .profiling import profile_call
+from .suite import collect_cases, MetricsChecker, Suite
+from .supervisor import LimitExceeded, SupervisedExecutor
+from .util import AbortError, host_name, remove_duplicates
 
+# statuses of cases whose worker process was killed for exceeding a limit
+LIMIT_STATUSES = ('timeout', 'oom')
 
-def run_cases(suites, golden_store, archive, git_info, cases):
+# perf measurements compared against the golden result by `check_perf`
+CHECKED_PERF_KEYS = ('run_wall_time', 'run_peak_rss')
+
+# perf measurements of a batch which are divided between its cases
+SHARED_PERF_KEYS = ('run_wall_time', 'run_cpu_time')
+
+
+def run_cases(suites, golden_store, archive, git_info, cases, jobs=1, incremental=False, timeout=None,
+              memory_limit=None, trace_memory=False, repeat=1, perf_tolerance=None, profiler=None):
     '''
     Run a list of cases, store results in the archive, and check against
     results in the golden_store.
 
     Cases are specified by a list of tuples of the form `(suite_id, case_id)`.
 
+    When `jobs` is greater than one, the `Suite.run` calls are distributed
+    over a pool of worker processes.  Checking against the golden store and
+    inserting into the archive always happens in this process, in the order
+    the cases were given, so the output and the archive remain deterministic.
+
+    When `incremental` is true, cases whose input hash (see `hash_case`)
+    matches a result archived at the current commit are not run again;
+    the archived result is checked against the golden store instead (see
+    `select_reusable`).
+
+    When a `timeout` (in seconds) or a `memory_limit` (in bytes) is given,
+    each case runs in its own supervised worker process, which is killed
+    when it exceeds either limit.  Such cases get the "timeout" or "oom"
+    status, and are archived without metrics or context.
+
+    The time and memory used by each case are recorded in the "perf" dict
+    of its result (see `measure_suite` and `record_case`), and summarized
+    once all cases are done.  When `trace_memory` is true, the peak memory
+    allocated by Python while running each case is traced as well, which
+    slows the cases down.  Each case is run `repeat` times, keeping the
+    fastest of the measurements, to reduce their noise.
+
+    When a `perf_tolerance` is given, cases whose run time or peak memory
+    exceed those of their golden result by more than this fraction fail (see
+    `check_perf`).  Every case then runs in its own worker process, so that
+    its peak memory is not inflated by earlier cases.
+
+    When a `profiler` ("cprofile" or "tracemalloc") is given, the runs of
+    each case are profiled, and the profile is stored next to its result
+    (see `Archive.insert_profile`).
+
+    Cases of suites which override `Suite.run_batch` are run in batches,
+    unless they are limited or their perf is checked, which happens per
+    case (see `_start_cases`).  Every process running cases calls
+    `Suite.setup` before the first case of each suite, and `Suite.teardown`
+    once it is done.
+
     This function assumes that all cases are valid.
     '''
+    if trace_memory and profiler == 'tracemalloc':
+        raise AbortError('Memory can not be traced while profiling with tracemalloc')
+    # resolve lazily read git info once, before any of the cases are run
+    git_info = dict(git_info)
+    golden_store.preload(remove_duplicates(suite_id for suite_id, _ in cases))
     cases_status = {
         'pass': 0,
         'fail': 0,
         'error': 0,
         'unknown': 0,
+        'timeout': 0,
+        'oom': 0,
     }
-    for suite_id, case_id in cases:
+    case_perfs = [(print_casespec(suite_id, case_id), {}) for suite_id, case_id in cases]
+    isolate = perf_tolerance is not None
+    batch = timeout is None and memory_limit is None and not isolate
+    try:
+        with _case_executor(jobs, timeout, memory_limit, isolate) as executor:
+            pending = _start_cases(executor, suites, golden_store, archive, git_info, cases, case_perfs,
+                                   incremental, trace_memory, repeat, perf_tolerance, profiler,
+                                   batch_jobs=jobs if batch else None)
+            for (suite_id, case_id), finish_case in zip(cases, pending):
+                casespec = print_casespec(suite_id, case_id)
+                print('STARTING CASE "{}"'.format(casespec))
+                try:
+                    status, comments = finish_case()
+                except Exception:
+                    comments = 'Error "{}"'.format(casespec)
+                    status = 'error'
+                    traceback.print_exc()
+
+                cases_status[status] += 1
+                print('Case "{}" status: {}\n{}\n'.format(casespec, status.upper(), comments))
+    finally:
+        tear_down_suites()
+
+    print('PERFORMANCE\n{}\n'.format(format_perf_summary(case_perfs)))
+    return cases_status
+
+
+def _start_cases(executor, suites, golden_store, archive, git_info, cases, case_perfs, incremental,
+                 trace_memory=False, repeat=1, perf_tolerance=None, profiler=None, batch_jobs=None):
+    '''
+    Start running a list of cases in the executor, returning a function per
+    case like `_start_case`.
+
+    When `batch_jobs` is given, the cases of each suite which overrides
+    `Suite.run_batch` are run in batches of up to `Suite.batch_size` cases,
+    which are made smaller so that there are at least `batch_jobs` batches
+    to run in parallel.  The results are then split back into a result per
+    case, which is checked and archived separately.  Cases reused by
+    incremental runs are not run, and so are left out of the batches.
+    '''
+    pending = []
+    batches = OrderedDict()
+    for (suite_id, case_id), (_, perf) in zip(cases, case_perfs):
         suite = suites[suite_id]
-        casespec = print_casespec(suite_id, case_id)
-        print('STARTING CASE "{}"'.format(casespec))
+        if batch_jobs is None or not has_run_batch(suite):
+            pending.append(_start_case(executor, suite, golden_store, archive, git_info, case_id, incremental,
+                                       perf, trace_memory, repeat, perf_tolerance, profiler))
+            continue
         try:
-            status, comments = run_case(suite, golden_store, archive, git_info, case_id)
-        except Exception:
-            comments = 'Error "{}"'.format(casespec)
-            status = 'error'
-            traceback.print_exc()
+            case_input = collect_cases(suite)[case_id]
+            input_hash = hash_case(suite, case_input)
+            previous_result = select_reusable(archive, suite, git_info, case_id, case_input, input_hash, incremental)
+            if previous_result is not None:
+                pending.append(functools.partial(reuse_case, suite, golden_store, case_id, previous_result))
+                continue
+        except Exception as e:
+            pending.append(_deferred_error(e))
+            continue
+        batches.setdefault(suite_id, []).append((len(pending), case_id, case_input, input_hash, perf))
+        pending.append(None)
 
-        cases_status[status] += 1
-        print('Case "{}" status: {}\n{}\n'.format(casespec, status.upper(), comments))
+    for suite_id, batch_cases in batches.items():
+        suite = suites[suite_id]
+        batch_size = min(suite.batch_size, int(math.ceil(len(batch_cases) / batch_jobs)))
+        for start in range(0, len(batch_cases), batch_size):
+            batch = batch_cases[start:start + batch_size]
+            try:
+                future = executor.submit(profile_suite_batch, suite, [case[2] for case in batch], trace_memory,
+                                         repeat, profiler)
+            except Exception as e:
+                future = _FailedCall(e)
+            for position, (i, case_id, case_input, input_hash, perf) in enumerate(batch):
+                pending[i] = functools.partial(
+                    _finish_batch_case, future, position, len(batch), suite, golden_store, archive, git_info,
+                    case_id, case_input, input_hash, perf, profiler,
+                )
+    return pending
+
+
+def _finish_batch_case(future, position, batch_size, suite, golden_store, archive, git_info, case_id, case_input,
+                       input_hash, perf, profiler):
+    '''
+    Wait for the batch of a case to finish, and check and archive the case's
+    result.  The run time of the batch is divided evenly between its cases,
+    and every case gets the profile of the whole batch.
+    '''
+    run_results, batch_perf, profile_data = future.result()
+    for key, value in batch_perf.items():
+        perf[key] = value / batch_size if key in SHARED_PERF_KEYS else value
+    perf['run_batch_size'] = batch_size
+    profile = None if profiler is None else (profiler, profile_data)
+    return record_case(suite, golden_store, archive, git_info, case_id, case_input, run_results[position],
+                       input_hash, perf, profile=profile)
+
+
+def _deferred_error(error):
+    def raise_error():
+        raise error
+    return raise_error
+
+
+def _start_case(executor, suite, golden_store, archive, git_info, case_id, incremental, perf=None,
+                trace_memory=False, repeat=1, perf_tolerance=None, profiler=None):
+    '''
+    Start running a case in the executor, returning a function which waits
+    for the case to finish, checks and archives its result, and returns its
+    status and comments.  Errors raised while starting the case are deferred
+    to that function, so that they are reported in order with the case.
+
+    The measurements of the case are added to the `perf` dict.
+    '''
+    if perf is None:
+        perf = {}
+    try:
+        case_input = collect_cases(suite)[case_id]
+        input_hash = hash_case(suite, case_input)
+        previous_result = select_reusable(archive, suite, git_info, case_id, case_input, input_hash, incremental)
+        if previous_result is not None:
+            return lambda: reuse_case(suite, golden_store, case_id, previous_result)
+        future = executor.submit(profile_suite, suite, case_input, trace_memory, repeat, profiler)
+    except Exception as e:
+        return _deferred_error(e)
+
+    def finish_case():
+        try:
+            run_result, run_perf, profile_data = future.result()
+        except LimitExceeded as e:
+            return record_limit_exceeded(suite, archive, git_info, case_id, case_input, e, input_hash)
+        perf.update(run_perf)
+        profile = None if profiler is None else (profiler, profile_data)
+        return record_case(suite, golden_store, archive, git_info, case_id, case_input, run_result, input_hash,
+                           perf, perf_tolerance, profile)
+    return finish_case
+
+
+def _case_executor(jobs, timeout=None, memory_limit=None, isolate=False):
+    if timeout is not None or memory_limit is not None or isolate:
+        return SupervisedExecutor(jobs, timeout, memory_limit)
+    elif jobs > 1:
+        return ProcessPoolExecutor(max_workers=jobs)
+    else:
+        return _InlineExecutor()
+
+
+class _InlineExecutor:
+    '''
+    Stands in for a process pool when cases are run one at a time.  Each case
+    is only run when its result is requested, so cases run in order, between
+    their status messages.
+    '''
+    def submit(self, fn, *args):
+        return _DeferredCall(fn, args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _DeferredCall:
+    '''
+    Calls a function the first time its result is requested, and keeps the
+    result, or the error raised, for the later requests of the other cases of
+    a batch.
+    '''
+    def __init__(self, fn, args):
+        self._fn = fn
+        self._args = args
+        self._called = False
+        self._value = None
+        self._error = None
+
+    def result(self):
+        if not self._called:
+            self._called = True
+            try:
+                self._value = self._fn(*self._args)
+            except Exception as e:
+                self._error = e
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class _FailedCall:
+    def __init__(self, error):
+        self._error = error
+
+    def result(self):
+        raise self._error
+
+
+class _SuiteLifecycle:
+    '''
+    Keeps track of the suites which were set up in this process, so that
+    each is set up once and torn down when the run is over.  Worker
+    processes start out with none, and tear their suites down when they
+    exit.
+
+    Suites are kept by id, and the instance which was set up is used for
+    every later case of its suite, as the tasks sent to a worker process
+    each carry a copy of the suite which was not set up.
+    '''
+    def __init__(self):
+        self.suites = OrderedDict()
+        self.finalizer = None
+
+    def set_up(self, suite):
+        if suite.id in self.suites:
+            return self.suites[suite.id]
+        suite.setup()
+        self.suites[suite.id] = suite
+        if self.finalizer is None:
+            self.finalizer = multiprocessing.util.Finalize(None, self.tear_down, exitpriority=0)
+        return suite
+
+    def tear_down(self):
+        while self.suites:
+            _, suite = self.suites.popitem()
+            try:
+                suite.teardown()
+            except Exception:
+                traceback.print_exc()
+
+    def reset(self):
+        self.suites = OrderedDict()
+        self.finalizer = None
+
+
+_suite_lifecycle = _SuiteLifecycle()
+multiprocessing.util.register_after_fork(_suite_lifecycle, _SuiteLifecycle.reset)
+
+
+def set_up_suite(suite):
+    '''
+    Call `Suite.setup` unless it was already called in this process on a
+    suite with the same id, and return the suite instance which was set up.
+    '''
+    return _suite_lifecycle.set_up(suite)
+
+
+def tear_down_suites():
+    '''
+    Call `Suite.teardown` on every suite set up in this process, in reverse
+    order, printing any errors they raise.
+    '''
+    _suite_lifecycle.tear_down()
+
+
+def has_run_batch(suite):
+    return getattr(type(suite), 'run_batch', Suite.run_batch) is not Suite.run_batch
 
-    return cases_status
 
+def run_case(suite, golden_store, archive, git_info, case_id, profiler=None):
+    case_input = collect_cases(suite)[case_id]
+    try:
+        run_result, perf, profile_data = profile_suite(suite, case_input, profiler=profiler)
+    finally:
+        tear_down_suites()
+    input_hash = hash_case(suite, case_input)
+    profile = None if profiler is None else (profiler, profile_data)
+    return record_case(suite, golden_store, archive, git_info, case_id, case_input, run_result, input_hash, perf,
+                       profile=profile)
 
-def run_case(suite, golden_store, archive, git_info, case_id):
-    case_input = suite.collect()[case_id]
+
+def run_suite(suite, case_input):
+    '''
+    Run the suite against a single case input.  This is the only part of
+    running a case that may happen in a worker process.
+    '''
     run_result = suite.run(case_input)
     validate_result(run_result)
-    metrics, context = run_result
+    return run_result
+
+
+def run_suite_batch(suite, case_inputs):
+    '''
+    Run the suite against a batch of case inputs with `Suite.run_batch`,
+    returning a run result per case input.
+    '''
+    run_results = list(suite.run_batch(case_inputs))
+    if len(run_results) != len(case_inputs):
+        msg = 'Suite "{}" returned {} results for a batch of {} cases'
+        raise ValueError(msg.format(suite.id, len(run_results), len(case_inputs)))
+    for run_result in run_results:
+        validate_result(run_result)
+    return run_results
+
+
+def measure_suite(suite, case_input, trace_memory=False, repeat=1):
+    '''
+    Run the suite against a single case input, returning its result along
+    with a perf dict holding the wall time, CPU time and peak resident memory
+    of the run (see `hdat.perf.measure`).  The peak resident memory is that
+    of the whole process running the case, including any earlier cases run
+    by the same worker process.
+
+    When `repeat` is greater than one, the case is run that many times; the
+    result of the last run is returned, along with the smallest of the
+    measurements of each kind.
+    '''
+    return _measure(run_suite, (suite, case_input), trace_memory, repeat)
+
+
+def measure_suite_batch(suite, case_inputs, trace_memory=False, repeat=1):
+    '''
+    Run and measure the suite against a batch of case inputs like
+    `measure_suite`, returning the run result of each case input, and the
+    measurements of the whole batch.
+    '''
+    return _measure(run_suite_batch, (suite, case_inputs), trace_memory, repeat)
+
 
+def _measure(run, args, trace_memory, repeat):
+    perf = {}
+    for _ in range(repeat):
+        repeat_perf = {}
+        with measure(repeat_perf, 'run', trace_memory):
+            run_result = run(*args)
+        for key, value in repeat_perf.items():
+            perf[key] = min(perf.get(key, value), value)
+    if repeat > 1:
+        perf['run_repeat'] = repeat
+    rss = peak_rss()
+    if rss is not None:
+        perf['run_peak_rss'] = rss
+    return run_result, perf
+
+
+def profile_suite(suite, case_input, trace_memory=False, repeat=1, profiler=None):
+    '''
+    Run and measure the suite against a single case input like
+    `measure_suite`, under a profiler if one is given (see
+    `hdat.profiling.profile_call`).  Returns the run result, the perf dict,
+    and the profile, which is None when no profiler is given.  The overhead
+    of the profiler is included in the measurements.
+
+    The suite is set up first, if it was not set up in this process yet,
+    and the instance which was set up is run.
+    '''
+    return _profile(measure_suite, suite, case_input, trace_memory, repeat, profiler)
+
+
+def profile_suite_batch(suite, case_inputs, trace_memory=False, repeat=1, profiler=None):
+    '''
+    Run, measure and profile the suite against a batch of case inputs like
+    `profile_suite`, using `measure_suite_batch`.
+    '''
+    return _profile(measure_suite_batch, suite, case_inputs, trace_memory, repeat, profiler)
+
+
+def _profile(measure_fn, suite, case_input, trace_memory, repeat, profiler):
+    suite = set_up_suite(suite)
+    if profiler is None:
+        run_result, perf = measure_fn(suite, case_input, trace_memory, repeat)
+        return run_result, perf, None
+    (run_result, perf), profile_data = profile_call(profiler, measure_fn, suite, case_input, trace_memory, repeat)
+    return run_result, perf, profile_data
+
+
+def check_case(suite, golden_store, case_id, metrics):
     golden_result = golden_store.select_golden(suite.id, case_id)
 
     if golden_result is None:
-        status, comments = 'unknown', 'No golden result present'
+        return 'unknown', 'No golden result present'
     else:
         passed, comments = suite.check(golden_result['metrics'], metrics)
-        status = 'pass' if passed else 'fail'
+        return 'pass' if passed else 'fail', comments
 
-    result = build_result(suite, git_info, case_id, case_input, metrics, context, status)
-    archive.insert(result)
+
+def record_case(suite, golden_store, archive, git_info, case_id, case_input, run_result, input_hash=None,
+                perf=None, perf_tolerance=None, profile=None):
+    '''
+    Check a run result and archive it.  The time taken by the check is added
+    to the `perf` dict before it is stored in the result; the time taken by
+    inserting the result into the archive is added afterwards, so it is only
+    part of the run's summary.
+
+    When a `perf_tolerance` is given, the run's perf is also checked against
+    the golden result's (see `check_perf`).  A `profile`, given as a
+    `(profiler, profile_data)` tuple, is stored next to the result.
+    '''
+    metrics, context = run_result
+    if perf is None:
+        perf = {}
+
+    with measure(perf, 'check'):
+        status, comments = check_case(suite, golden_store, case_id, metrics)
+    if perf_tolerance is not None and status == 'pass':
+        status, comments = check_perf(golden_store, suite.id, case_id, perf, perf_tolerance, comments)
+
+    result = build_result(suite, git_info, case_id, case_input, metrics, context, status, input_hash, dict(perf))
+    if profile is not None:
+        result['profile'] = profile[0]
+    with measure(perf, 'insert'):
+        archive.insert(result)
+        if profile is not None:
+            archive.insert_profile(result, profile[1])
     return status, comments
 
 
+def check_perf(golden_store, suite_id, case_id, perf, tolerance, comments=''):
+    '''
+    Check that the run time and peak memory of a passing case have not
+    increased by more than the fraction `tolerance` over those recorded in
+    its golden result, which are recorded by `hdat verify --perf`.  Returns
+    the status of the case and its comments.
+    '''
+    golden_perf = golden_store.select_golden(suite_id, case_id).get('perf') or {}
+    checked_keys = [key for key in CHECKED_PERF_KEYS if key in golden_perf and key in perf]
+    if not checked_keys:
+        return 'pass', '{}\nNo golden perf to check against'.format(comments)
+
+    checker = MetricsChecker(
+        {key: golden_perf[key] for key in checked_keys},
+        {key: perf[key] for key in checked_keys},
+    )
+    for key in checked_keys:
+        checker.can_decrease(key, abs_tol=tolerance * golden_perf[key])
+    perf_passed, perf_msgs = checker.result()
+    return 'pass' if perf_passed else 'fail', '\n'.join([comments] + perf_msgs)
+
+
+def record_limit_exceeded(suite, archive, git_info, case_id, case_input, limit_exceeded, input_hash=None):
+    status = limit_exceeded.status
+    result = build_result(suite, git_info, case_id, case_input, None, None, status, input_hash)
+    archive.insert(result)
+    return status, str(limit_exceeded)
+
+
+def select_reusable(archive, suite, git_info, case_id, case_input, input_hash, incremental=True):
+    '''
+    Return the archived result which an incremental run can reuse instead of
+    running a case, or None.
+
+    Uncommitted changes are only covered by the input hash when they are in
+    the suite's module or in its declared dependencies (see `hash_case`), so
+    results are neither reused in a dirty working tree nor from one, unless
+    the suite declares the dependencies of the case.
+    '''
+    if not incremental:
+        return None
+    previous_result = archive.select_reusable(suite.id, case_id, git_info['commit'], input_hash)
+    if previous_result is None or previous_result['status'] in LIMIT_STATUSES:
+        return None
+    if (git_info['dirty'] or previous_result.get('repo_dirty')) and not list(suite.dependencies(case_input)):
+        return None
+    return previous_result
+
+
+def reuse_case(suite, golden_store, case_id, previous_result):
+    status, comments = check_case(suite, golden_store, case_id, previous_result['metrics'])
+    msg = 'Reused result "{}", the case and its dependencies are unchanged\n{}'
+    return status, msg.format(previous_result['result_id'], comments)
+
+
+def hash_case(suite, case_input):
+    '''
+    Return a hash of everything that the result of running a case is assumed
+    to depend on, besides the commit: the case input, the source of the
+    module defining the suite, and the files returned by
+    `Suite.dependencies`.  The members of sets in the case input are sorted
+    first, as their order differs between processes.
+    '''
+    digest = hashlib.sha256()
+    digest.update(pickle.dumps(_canonical(case_input), protocol=2))
+    filenames = [inspect.getsourcefile(type(suite))] + list(suite.dependencies(case_input))
+    for filename in filenames:
+        if filename is not None:
+            digest.update(_file_digest(filename))
+    return digest.hexdigest()
+
+
+def _canonical(value):
+    '''
+    Return a value with the members of its sets, and those of sets nested in
+    lists, tuples and dicts, sorted by their pickles.  Values without sets are
+    returned as they are, so that their hashes do not change.
+    '''
+    if isinstance(value, (set, frozenset)):
+        members = sorted(pickle.dumps(_canonical(member), protocol=2) for member in value)
+        return (type(value).__name__, members)
+    elif isinstance(value, (list, tuple)):
+        items = [_canonical(item) for item in value]
+        if all(item is original for item, original in zip(items, value)):
+            return value
+        return items if isinstance(value, list) else tuple(items)
+    elif isinstance(value, dict):
+        items = [(_canonical(key), _canonical(item)) for key, item in value.items()]
+        if all(key is original_key and item is original_item
+               for (key, item), (original_key, original_item) in zip(items, value.items())):
+            return value
+        return dict(items)
+    return value
+
+
+# digests of the files hashed by `hash_case`, by file name, along with the
+# modification time and size they were computed for
+_file_digests = {}
+
+
+def _file_digest(filename):
+    '''
+    Return the SHA-256 digest of a file, which is only read again when its
+    modification time or size changed, as many cases share their files.
+    Files modified within the last few seconds are always read, as they may
+    change again without changing their modification time.
+    '''
+    stat = os.stat(filename)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _file_digests.get(filename)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as dependency_file:
+        for chunk in iter(lambda: dependency_file.read(1 << 20), b''):
+            digest.update(chunk)
+    if stat.st_mtime < time.time() - 2:
+        _file_digests[filename] = (key, digest.digest())
+    return digest.digest()
+
+
 def validate_result(run_result):
     if type(run_result) != tuple and len(run_result) == 2:
         msg = 'Test suites must return a tuple of the form (metrics, context).  Got "{}".'
@@ -62,10 +619,16 @@ def validate_result(run_result):
 
 
 def build_result_id(result):
-        return '{}_{}'.format(result['ran_on'], result['commit'])
+    '''
+    Result ids start with the time and commit of the run, so that they sort
+    and read well, followed by the host, the process id and a random nonce,
+    so that concurrent runs of the same case never produce the same id.
+    '''
+    unique_suffix = '{}-{}-{}'.format(host_name(), os.getpid(), uuid.uuid4().hex[:8])
+    return '{}_{}_{}'.format(result['ran_on'], result['commit'], unique_suffix)
 
 
-def build_result(suite, git_info, case_id, case_input, metrics, context, status):
+def build_result(suite, git_info, case_id, case_input, metrics, context, status, input_hash=None, perf=None):
     run_datetime = datetime.datetime.utcnow()
     result = {
         'suite_id': suite.id,
@@ -77,6 +640,8 @@ def build_result(suite, git_info, case_id, case_input, metrics, context, status)
         'metrics': metrics,
         'context': context,
         'status': status,
+        'input_hash': input_hash,
+        'perf': perf or {},
     }
 
     result['result_id'] = build_result_id(result)
@@ -1,15 +1,132 @@
-from git import Repo, InvalidGitRepositoryError
+import os
+import subprocess
+from collections.abc import Mapping
 
-from .util import AbortError
+from .util import AbortError, find_here_or_in_parents
+
+# (git directory, index modification time, commit) -> dirty flag
+_dirty_cache = {}
+
+
+class LazyGitInfo(Mapping):
+    '''
+    The git info of a directory (see `git_info_from_directory`), which is
+    only read the first time one of its keys is accessed, so that commands
+    which do not record results never touch the repository.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self._info = None
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+    def __iter__(self):
+        return iter(self._resolve())
+
+    def __len__(self):
+        return len(self._resolve())
+
+    def _resolve(self):
+        if self._info is None:
+            self._info = git_info_from_directory(self.directory)
+        return self._info
 
 
 def git_info_from_directory(directory):
-    try:
-        repo = Repo(directory, search_parent_directories=True)
-    except InvalidGitRepositoryError:
+    '''
+    Return the commit checked out in the git repository containing
+    `directory`, and whether any tracked files were modified.
+
+    The commit is read directly from the files in the git directory; the
+    dirty flag runs `git status`, and is cached for as long as the index and
+    the commit stay the same.
+    '''
+    git_directory = _find_git_directory(directory)
+    if git_directory is None:
         raise AbortError('No git repository found in, or above, "{}"'.format(directory))
 
+    commit = _resolve_head(git_directory)
+    try:
+        index_mtime = os.stat(os.path.join(git_directory, 'index')).st_mtime_ns
+    except FileNotFoundError:
+        index_mtime = None
+
+    cache_key = (git_directory, index_mtime, commit)
+    if cache_key not in _dirty_cache:
+        _dirty_cache[cache_key] = _is_dirty(directory)
     return {
-        'commit': repo.head.commit.hexsha,
-        'dirty': repo.is_dirty(),
+        'commit': commit,
+        'dirty': _dirty_cache[cache_key],
     }
+
+
+def _find_git_directory(directory):
+    '''
+    Find the git directory of the repository containing `directory`,
+    following the ".git" files used by worktrees and submodules.
+    '''
+    git_entry = find_here_or_in_parents(directory, '.git')
+    if git_entry is None or os.path.isdir(git_entry):
+        return git_entry
+
+    with open(git_entry, 'r') as git_file:
+        contents = git_file.read().strip()
+    if not contents.startswith('gitdir:'):
+        return None
+    git_directory = contents[len('gitdir:'):].strip()
+    return os.path.normpath(os.path.join(os.path.dirname(git_entry), git_directory))
+
+
+def _resolve_head(git_directory):
+    with open(os.path.join(git_directory, 'HEAD'), 'r') as head_file:
+        head = head_file.read().strip()
+    if not head.startswith('ref:'):
+        return head
+
+    ref = head[len('ref:'):].strip()
+    # linked worktrees keep their HEAD in their own git directory, but share
+    # the refs of the main repository
+    common_directory = git_directory
+    commondir_filename = os.path.join(git_directory, 'commondir')
+    if os.path.exists(commondir_filename):
+        with open(commondir_filename, 'r') as commondir_file:
+            common_directory = os.path.normpath(os.path.join(git_directory, commondir_file.read().strip()))
+
+    for ref_directory in (git_directory, common_directory):
+        try:
+            with open(os.path.join(ref_directory, ref), 'r') as ref_file:
+                return ref_file.read().strip()
+        except FileNotFoundError:
+            pass
+
+    commit = _read_packed_ref(common_directory, ref)
+    if commit is None:
+        raise AbortError('Unable to resolve "{}" in the git repository "{}"'.format(ref, git_directory))
+    return commit
+
+
+def _read_packed_ref(git_directory, ref):
+    try:
+        with open(os.path.join(git_directory, 'packed-refs'), 'r') as packed_refs_file:
+            for line in packed_refs_file:
+                if line.startswith(('#', '^')):
+                    continue
+                commit, _, name = line.strip().partition(' ')
+                if name == ref:
+                    return commit
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def _is_dirty(directory):
+    try:
+        output = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=directory,
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise AbortError('Unable to check whether the git repository is dirty: {}'.format(e))
+    return bool(output.strip())
@@ -1,9 +1,22 @@
+import fnmatch
 import importlib
-import sys
 import inspect
+import json
+import numbers
 import os
+import tempfile
+import weakref
+from collections import OrderedDict
+from collections.abc import Mapping
 
-from .util import print_error, AbortError
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .util import print_error, AbortError, remove_duplicates
+
+SUITE_CACHE_VERSION = 2
 
 
 class Suite:
@@ -40,6 +53,47 @@ class Suite:
         '''
         raise NotImplementedError()
 
+    # largest number of cases passed to `run_batch` at once
+    batch_size = 32
+
+    def run_batch(self, case_inputs):
+        '''
+        Run the algorithm against a list of "case data", returning a list with
+        the two-tuple `run` would return for each of them, in order.  Suites
+        whose algorithm processes many cases at once more efficiently, e.g.
+        because it is vectorized, can override this method, and the runner
+        then passes it up to `batch_size` cases at a time.  `run` is still
+        used wherever cases are run one at a time.
+        '''
+        return [self.run(case_input) for case_input in case_inputs]
+
+    def setup(self):
+        '''
+        Prepare any state shared by the cases of the suite, such as a loaded
+        model or lookup tables.  Called once in every process that runs cases
+        of the suite, i.e. in each worker process when cases are run in
+        parallel, before its first case is run.  The time it takes is not
+        included in the cases' perf.
+        '''
+        pass
+
+    def teardown(self):
+        '''
+        Release the state prepared by `setup`.  Called once in every process
+        where `setup` was called, after the last case of the run.
+        '''
+        pass
+
+    def dependencies(self, case_input):
+        '''
+        Return the paths of any files, besides the module defining the suite,
+        that the result of running a case depends on, such as data files or
+        the modules of the algorithm being tested.  Incremental runs only
+        re-run a case when its input, the suite's module, or one of these
+        files has changed.
+        '''
+        return []
+
     def show(self, result):
         raise NotImplementedError()
 
@@ -51,39 +105,155 @@ class Suite:
         return type(self).__name__
 
 
-def collect_suites(directory):
-    suite_classes = _collect_suite_classes(directory)
-    mapping = {}
-    for suite_class in suite_classes:
+def collect_suites(directory, cache_filename=None):
+    '''
+    Find every suite defined in the "*_hdat.py" modules found in, or below,
+    `directory`, returning a mapping from suite id to suite.
+
+    When a `cache_filename` is given, the suite ids defined by each module are
+    recorded in it, keyed by the modification time and size of the module
+    and of the files in `directory` it imports classes, functions or modules
+    from, so that later calls only import the modules which changed; the
+    other modules are imported, and their suites instantiated, when a suite
+    is first looked up.
+
+    Collecting suites starts a fresh case cache; see `collect_cases`.
+    '''
+    invalidate_cases()
+    cache = _read_suite_cache(cache_filename, directory)
+    modules = OrderedDict()
+    locations = OrderedDict()
+    suites = {}
+    for module_spec, filename in _find_suite_modules(directory):
+        entry = cache.get(module_spec)
+        if entry is None or not _files_unchanged(entry['files']):
+            module_suites, entry = _scan_module(module_spec, filename, directory)
+            suites.update((suite.id, suite) for _, suite in module_suites)
+        modules[module_spec] = entry
+
+        for class_name, suite_id in entry['suites']:
+            if suite_id in locations:
+                raise AbortError('Duplicate suite id "{}"'.format(suite_id))
+            elif '/' in suite_id:
+                raise AbortError('Invalid suite id "{}", no "/" allowed in suite ids'.format(suite_id))
+            locations[suite_id] = (module_spec, class_name)
+
+    if cache_filename is not None and modules != cache:
+        _write_suite_cache(cache_filename, directory, modules)
+    return LazySuites(locations, suites, modules, cache_filename, directory)
+
+
+class LazySuites(Mapping):
+    '''
+    A mapping from suite id to suite, which imports the module defining a
+    suite and instantiates the suite the first time it is looked up.
+
+    Changes the suite cache did not notice, e.g. to modules imported from
+    outside of the directory, are found when the module is imported; the
+    module is then scanned again and its entry in the cache rewritten.
+    '''
+    def __init__(self, locations, suites=None, modules=None, cache_filename=None, directory=None):
+        self._locations = locations
+        self._suites = dict(suites or {})
+        self._modules = modules if modules is not None else OrderedDict()
+        self._cache_filename = cache_filename
+        self._directory = directory
+
+    def __getitem__(self, suite_id):
         try:
-            suite = suite_class()
-        except Exception as e:
-            print_error(e)
-            suite_class_name = suite_class.__name__
-            msg = 'Error while instatiating suite "{}"'
-            raise AbortError(msg.format(suite_class_name))
-
-        suite_id = suite.id
-        if suite_id in mapping:
-            raise AbortError('Duplicate suite id "{}"'.format(suite_id))
-        elif '/' in suite_id:
-            raise AbortError('Invalid suite id "{}", no "/" allowed in suite ids'.format(suite_id))
-        else:
-            mapping[suite_id] = suite
-    return mapping
-
-
-def _collect_suite_classes(directory):
+            return self._suites[suite_id]
+        except KeyError:
+            module_spec, class_name = self._locations[suite_id]
+
+        suite_class = getattr(importlib.import_module(module_spec), class_name, None)
+        suite = None if suite_class is None else _instantiate_suite(suite_class)
+        if suite is None or suite.id != suite_id:
+            self._rescan(module_spec)
+            if suite_id not in self._suites:
+                msg = 'Suite "{}" is no longer defined in "{}"'
+                raise AbortError(msg.format(suite_id, module_spec))
+            return self._suites[suite_id]
+        self._suites[suite_id] = suite
+        return suite
+
+    def _rescan(self, module_spec):
+        module = importlib.import_module(module_spec)
+        module_suites, entry = _scan_module(module_spec, inspect.getsourcefile(module), self._directory)
+        for suite_id, (location_spec, _) in list(self._locations.items()):
+            if location_spec == module_spec:
+                del self._locations[suite_id]
+                self._suites.pop(suite_id, None)
+        for class_name, suite in module_suites:
+            if suite.id in self._locations:
+                raise AbortError('Duplicate suite id "{}"'.format(suite.id))
+            self._locations[suite.id] = (module_spec, class_name)
+            self._suites[suite.id] = suite
+
+        self._modules[module_spec] = entry
+        if self._cache_filename is not None:
+            _write_suite_cache(self._cache_filename, self._directory, self._modules)
+
+    def __contains__(self, suite_id):
+        return suite_id in self._locations
+
+    def __iter__(self):
+        return iter(self._locations)
+
+    def __len__(self):
+        return len(self._locations)
+
+
+_collected_cases = weakref.WeakKeyDictionary()
+
+
+def collect_cases(suite):
+    '''
+    Return the case map of a suite.  `Suite.collect` is only called the first
+    time a suite instance is asked for its cases; the case map is shared by
+    every later caller until `invalidate_cases` is called.
+    '''
+    try:
+        return _collected_cases[suite]
+    except KeyError:
+        case_map = suite.collect()
+        _collected_cases[suite] = case_map
+        return case_map
+
+
+def invalidate_cases(suite=None):
+    '''
+    Forget the cached case map of a suite, or of every suite if none is given,
+    so that the next `collect_cases` call collects the cases again.
+    '''
+    if suite is None:
+        _collected_cases.clear()
+    else:
+        _collected_cases.pop(suite, None)
+
+
+def _instantiate_suite(suite_class):
+    try:
+        return suite_class()
+    except Exception as e:
+        print_error(e)
+        suite_class_name = suite_class.__name__
+        msg = 'Error while instatiating suite "{}"'
+        raise AbortError(msg.format(suite_class_name))
+
+
+def _find_suite_modules(directory):
+    '''
+    Yield the module spec and file name of every "*_hdat.py" module in, or
+    below, `directory`.
+    '''
     hdat_module_suffix = '_hdat.py'
-    hdat_suite_class = Suite
 
-    suite_classes = []
     for root, dirs, files in os.walk(directory, topdown=True):
         # prevent os.walk from going into hidden dirs
         dirs[:] = [subdir for subdir in dirs if not subdir.startswith('.')]
         for filename in files:
             if filename.endswith(hdat_module_suffix):
-                module_name = filename.strip(".py")
+                module_name = filename[:-len('.py')]
 
                 module_path = (os.path.relpath(root, start=directory))
                 if module_path == '.':
@@ -91,12 +261,104 @@ def _collect_suite_classes(directory):
                 else:
                     module_spec = os.path.join(module_path, '').replace(os.path.sep, '.') + module_name
 
-                importlib.import_module(module_spec)
-                classes = inspect.getmembers(sys.modules[module_spec], predicate=inspect.isclass)
-                for name, value in classes:
-                    if hdat_suite_class in inspect.getmro(value) and hdat_suite_class != value:
-                        suite_classes.append(value)
-    return suite_classes
+                yield module_spec, os.path.join(root, filename)
+
+
+def _scan_module(module_spec, filename, directory):
+    '''
+    Import a suite module and instantiate its suites, returning them as
+    `(class_name, suite)` tuples, along with the module's suite cache entry.
+    '''
+    module_suites = [(name, _instantiate_suite(value)) for name, value in _suite_classes(module_spec)]
+    filenames = [filename] + _imported_filenames(importlib.import_module(module_spec), directory)
+    entry = {
+        'files': _file_stats(filenames),
+        'suites': [[name, suite.id] for name, suite in module_suites],
+    }
+    return module_suites, entry
+
+
+def _imported_filenames(module, directory):
+    '''
+    Return the source files within `directory`, if given, of the classes,
+    functions and modules which a module imported from other modules.  The
+    suites of a module usually depend on those.
+    '''
+    root = None if directory is None else os.path.join(os.path.abspath(directory), '')
+    filenames = []
+    for _, value in inspect.getmembers(module):
+        if not (inspect.isclass(value) or inspect.isfunction(value) or inspect.ismodule(value)):
+            continue
+        classes = inspect.getmro(value) if inspect.isclass(value) else [value]
+        for member in classes:
+            try:
+                filename = inspect.getsourcefile(member)
+            except TypeError:
+                continue
+            if filename is not None and (root is None or os.path.abspath(filename).startswith(root)):
+                filenames.append(os.path.abspath(filename))
+    return sorted(set(filenames) - {os.path.abspath(inspect.getsourcefile(module))})
+
+
+def _file_stats(filenames):
+    stats = {}
+    for filename in filenames:
+        stat = os.stat(filename)
+        stats[os.path.abspath(filename)] = [stat.st_mtime_ns, stat.st_size]
+    return stats
+
+
+def _files_unchanged(file_stats):
+    try:
+        return _file_stats(file_stats) == file_stats
+    except OSError:
+        return False
+
+
+def _suite_classes(module_spec):
+    hdat_suite_class = Suite
+
+    module = importlib.import_module(module_spec)
+    classes = inspect.getmembers(module, predicate=inspect.isclass)
+    for name, value in classes:
+        if hdat_suite_class in inspect.getmro(value) and hdat_suite_class != value:
+            yield name, value
+
+
+def _read_suite_cache(cache_filename, directory):
+    '''
+    Read the modules recorded in a suite cache, ignoring caches which are
+    missing, unreadable, or were written for another directory or version.
+    '''
+    if cache_filename is None:
+        return {}
+    try:
+        with open(cache_filename, 'r') as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+    if cache.get('version') != SUITE_CACHE_VERSION or cache.get('directory') != os.path.abspath(directory):
+        return {}
+    return cache['modules']
+
+
+def _write_suite_cache(cache_filename, directory, modules):
+    cache = {
+        'version': SUITE_CACHE_VERSION,
+        'directory': os.path.abspath(directory),
+        'modules': modules,
+    }
+    try:
+        cache_directory = os.path.dirname(os.path.abspath(cache_filename))
+        os.makedirs(cache_directory, exist_ok=True)
+        descriptor, temporary_filename = tempfile.mkstemp(prefix='.tmp-', dir=cache_directory)
+        with os.fdopen(descriptor, 'w') as cache_file:
+            json.dump(cache, cache_file, indent=2)
+        os.replace(temporary_filename, cache_filename)
+    except IOError as e:
+        # the cache only speeds up later calls, so failing to write it, e.g.
+        # in a read-only checkout, is not an error
+        print_error('Unable to write the suite cache "{}": {}'.format(cache_filename, e))
 
 
 def ignore_key_errors(decoratee):
@@ -131,8 +393,32 @@ class MetricsChecker:
         '''Fills in for math.isclose in 3.4'''
         return abs(a - b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
 
+    def _is_array(self, metric):
+        '''
+        Check if a metric is compared elementwise by the bulk checks; see
+        `_array_values`.
+        '''
+        return self._array_values(metric) is not None
+
+    def _array_values(self, metric):
+        '''
+        Return the golden and new values of a metric as NumPy arrays if either
+        is an array, or a list which converts cleanly to a numeric array, and
+        the other converts too; otherwise return None, and the values are
+        compared as they are, e.g. lists of strings or nested lists of
+        different lengths.
+        '''
+        if np is None:
+            return None
+        values = [_as_numeric_array(value) for value in (self._old[metric], self._new[metric])]
+        if any(value is None for value in values) or all(value.ndim == 0 for value in values):
+            return None
+        return values
+
     @ignore_key_errors
     def is_close(self, metric, **kwargs):
+        if self._is_array(metric):
+            return self.bulk_is_close([metric], **kwargs)
         if not self._is_close(self._old[metric], self._new[metric], **kwargs):
             self._match = False
             msg = 'Metric {} value {} was not close to golden value {} within {}'
@@ -140,6 +426,8 @@ class MetricsChecker:
 
     @ignore_key_errors
     def is_exact(self, metric):
+        if self._is_array(metric):
+            return self.bulk_is_exact([metric])
         if self._old[metric] != self._new[metric]:
             self._match = False
             msg = 'Metric {} value {} did not match golden value {}'
@@ -154,6 +442,8 @@ class MetricsChecker:
 
     @ignore_key_errors
     def can_increase(self, metric, abs_tol=0.0):
+        if self._is_array(metric):
+            return self.bulk_can_increase([metric], abs_tol=abs_tol)
         if (self._new[metric] + abs_tol < self._old[metric] and
                 not self._is_close(self._new[metric], self._old[metric])):
             self._match = False
@@ -162,12 +452,139 @@ class MetricsChecker:
 
     @ignore_key_errors
     def can_decrease(self, metric, abs_tol=0.0):
+        if self._is_array(metric):
+            return self.bulk_can_decrease([metric], abs_tol=abs_tol)
         if (self._new[metric] - abs_tol > self._old[metric] and
                 not self._is_close(self._new[metric], self._old[metric])):
             self._match = False
             msg = 'Metric {} value {} increased over golden value {} more than {}'
             self._msgs.append(msg.format(metric, self._new[metric], self._old[metric], abs_tol))
 
+    def bulk_is_close(self, metrics, rel_tol=1e-09, abs_tol=0.0):
+        '''
+        Check many metrics at once, like `is_close`.  `metrics` is a metric
+        name or pattern (e.g. "region_*"), or a list of them, and metrics
+        may also be lists or arrays, which are checked elementwise.
+        '''
+        msg = 'value {} was not close to golden value {} within {}'
+        tolerance = {'rel_tol': rel_tol, 'abs_tol': abs_tol}
+        self._bulk_check(metrics, lambda old, new: ~_are_close(old, new, rel_tol, abs_tol), msg, tolerance,
+                         self.is_close, rel_tol=rel_tol, abs_tol=abs_tol)
+
+    def all_close(self, metrics, rtol=1e-05, atol=1e-08):
+        '''
+        Check that metrics, usually arrays, are close elementwise with the
+        tolerances of `numpy.allclose`, i.e. that
+        `abs(new - golden) <= atol + rtol * abs(golden)`.  `metrics` is a
+        metric name or pattern, or a list of them, as for `bulk_is_close`.
+        '''
+        msg = 'value {} was not close to golden value {} within {}'
+        tolerance = {'rtol': rtol, 'atol': atol}
+        self._bulk_check(metrics, lambda old, new: ~np.isclose(new, old, rtol=rtol, atol=atol), msg, tolerance,
+                         self.is_close, rel_tol=rtol, abs_tol=atol)
+
+    def bulk_is_exact(self, metrics):
+        '''
+        Check many metrics at once, like `is_exact`; see `bulk_is_close`.
+        '''
+        msg = 'value {} did not match golden value {}'
+        self._bulk_check(metrics, lambda old, new: old != new, msg, None, self.is_exact, numeric=False)
+
+    def bulk_can_increase(self, metrics, abs_tol=0.0):
+        '''
+        Check many metrics at once, like `can_increase`; see `bulk_is_close`.
+        '''
+        msg = 'value {} decreased over golden value {} more than {}'
+        self._bulk_check(metrics, lambda old, new: (new + abs_tol < old) & ~_are_close(new, old), msg, abs_tol,
+                         self.can_increase, abs_tol=abs_tol)
+
+    def bulk_can_decrease(self, metrics, abs_tol=0.0):
+        '''
+        Check many metrics at once, like `can_decrease`; see `bulk_is_close`.
+        '''
+        msg = 'value {} increased over golden value {} more than {}'
+        self._bulk_check(metrics, lambda old, new: (new - abs_tol > old) & ~_are_close(new, old), msg, abs_tol,
+                         self.can_decrease, abs_tol=abs_tol)
+
+    def _bulk_check(self, metrics, failed, msg, tolerance, check_one, numeric=True, **kwargs):
+        '''
+        Compare the scalar metrics matching `metrics` in a single vectorized
+        `failed(old, new)` call, which returns a boolean array marking the
+        failed metrics, and each array-valued metric in one call of its own.
+        `msg` describes a failure, after the metric name, from the new value,
+        the golden value and the `tolerance`, and is only formatted for the
+        metrics which failed.  Other metrics, such as strings and lists of
+        strings, and every metric without NumPy, are checked by `check_one`
+        instead.  Values which `check_one` can not compare, such as strings
+        checked for closeness, fail unless they are equal.
+        '''
+        names = self._select_metrics(metrics)
+        if np is None:
+            for name in names:
+                self._check_other(name, check_one, **kwargs)
+            return
+
+        is_scalar = _is_number if numeric else _is_scalar
+        scalar_names = []
+        array_values = {}
+        for name in names:
+            values = self._array_values(name)
+            if values is not None:
+                array_values[name] = values
+            elif is_scalar(self._old[name]) and is_scalar(self._new[name]):
+                scalar_names.append(name)
+            else:
+                self._check_other(name, check_one, **kwargs)
+
+        if scalar_names:
+            scalar_dtype = float if numeric else object
+            old = np.array([self._old[name] for name in scalar_names], dtype=scalar_dtype)
+            new = np.array([self._new[name] for name in scalar_names], dtype=scalar_dtype)
+            for i in np.flatnonzero(failed(old, new)):
+                name = scalar_names[i]
+                self._match = False
+                self._msgs.append('Metric {} '.format(name) + msg.format(self._new[name], self._old[name], tolerance))
+
+        for name, (old, new) in array_values.items():
+            if numeric:
+                old, new = old.astype(float), new.astype(float)
+            if old.shape != new.shape:
+                self._match = False
+                msg_shape = 'Metric {} has shape {}, but the golden value has shape {}'
+                self._msgs.append(msg_shape.format(name, new.shape, old.shape))
+                continue
+            failures = np.asarray(failed(old, new))
+            if failures.any():
+                self._match = False
+                index = tuple(int(i) for i in np.argwhere(failures)[0])
+                msg_array = 'Metric {} failed in {} of {} elements, e.g. at index {}: '
+                summary = msg_array.format(name, int(failures.sum()), failures.size, index)
+                self._msgs.append(summary + msg.format(new[index], old[index], tolerance))
+
+    def _check_other(self, name, check_one, **kwargs):
+        try:
+            check_one(name, **kwargs)
+        except TypeError:
+            if self._old[name] != self._new[name]:
+                self._match = False
+                msg = 'Metric {} value {} could not be compared to golden value {}'
+                self._msgs.append(msg.format(name, self._new[name], self._old[name]))
+
+    def _select_metrics(self, metrics):
+        '''
+        Return the names of the metrics present in both results which are
+        named, or matched by a pattern, in `metrics`.
+        '''
+        patterns = [metrics] if isinstance(metrics, str) else list(metrics)
+        common_names = [name for name in self._new if name in self._old]
+        names = []
+        for pattern in patterns:
+            if pattern in self._old and pattern in self._new:
+                names.append(pattern)
+            else:
+                names.extend(sorted(fnmatch.filter(common_names, pattern)))
+        return remove_duplicates(names)
+
     def msgs(self):
         return self._msgs
 
@@ -176,3 +593,28 @@ class MetricsChecker:
 
     def result(self):
         return self._match, self._msgs
+
+
+def _as_numeric_array(value):
+    if isinstance(value, np.ndarray):
+        return value
+    try:
+        array = np.asarray(value)
+    except (ValueError, TypeError):
+        return None
+    return array if array.dtype.kind in 'biufc' else None
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Number)
+
+
+def _is_scalar(value):
+    return not isinstance(value, (list, tuple)) and np.ndim(value) == 0
+
+
+def _are_close(a, b, rel_tol=1e-09, abs_tol=0.0):
+    '''
+    Elementwise version of `MetricsChecker._is_close` for NumPy arrays.
+    '''
+    return np.abs(a - b) <= np.maximum(rel_tol * np.maximum(np.abs(a), np.abs(b)), abs_tol)
@@ -0,0 +1,124 @@
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from .util import AbortError
+
+# seconds between checks of a supervised process's run time and memory use
+POLL_INTERVAL = 0.05
+
+
+class LimitExceeded(Exception):
+    '''
+    Raised in place of the result of a call whose process was killed for
+    exceeding a limit.  `status` is either "timeout" or "oom".
+    '''
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class SupervisedExecutor:
+    '''
+    Runs each submitted call in its own worker process, at most `jobs` at a
+    time, and kills the process if it runs for longer than `timeout` seconds
+    or its resident memory exceeds `memory_limit` bytes.  A crash or a
+    killed process only loses the call that was running in it.
+
+    The processes are started by supervisor threads, so they are not forked
+    from this process, whose other threads may hold locks, e.g. those of its
+    output streams, which a forked child would inherit held.  They are
+    started from a fork server, or spawned where there is none, so the
+    submitted calls and their arguments must be picklable, and their modules
+    importable.
+    '''
+    def __init__(self, jobs=1, timeout=None, memory_limit=None):
+        if memory_limit is not None and not os.path.exists('/proc/self/status'):
+            raise AbortError('Memory limits are only supported on systems with a /proc filesystem')
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._supervisors = ThreadPoolExecutor(max_workers=jobs)
+        self._context = _process_context()
+
+    def submit(self, fn, *args):
+        return self._supervisors.submit(self._supervise, fn, args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._supervisors.shutdown(wait=True)
+        return False
+
+    def _supervise(self, fn, args):
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=_call_in_worker, args=(sender, fn, args), daemon=True)
+        started_on = time.monotonic()
+        process.start()
+        sender.close()
+        try:
+            while True:
+                # the result is received as soon as it is sent, so that a
+                # large result never blocks the worker on a full pipe
+                if receiver.poll(POLL_INTERVAL):
+                    try:
+                        succeeded, value = receiver.recv()
+                    except EOFError:
+                        process.join()
+                        msg = 'The worker process exited with code {} without returning a result'
+                        raise RuntimeError(msg.format(process.exitcode))
+                    if succeeded:
+                        return value
+                    raise value
+
+                run_time = time.monotonic() - started_on
+                if self.timeout is not None and run_time > self.timeout:
+                    raise LimitExceeded('timeout', 'Killed after running for more than {} s'.format(self.timeout))
+                if self.memory_limit is not None:
+                    rss = _resident_memory(process.pid)
+                    if rss is not None and rss > self.memory_limit:
+                        msg = 'Killed after using {} MB of memory, more than the limit of {} MB'
+                        raise LimitExceeded('oom', msg.format(rss // 2**20, self.memory_limit // 2**20))
+        finally:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+            receiver.close()
+
+
+def _process_context():
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _call_in_worker(sender, fn, args):
+    try:
+        value = (True, fn(*args))
+    except Exception as e:
+        # the traceback is lost when the exception is pickled, so print it
+        # from the worker
+        traceback.print_exc()
+        value = (False, e)
+    try:
+        sender.send(value)
+    except Exception:
+        sender.send((False, RuntimeError(repr(value[1]))))
+    sender.close()
+
+
+def _resident_memory(pid):
+    '''
+    Return the resident memory of a process in bytes, or None if the process
+    has already exited.
+    '''
+    try:
+        with open('/proc/{}/status'.format(pid), 'r') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
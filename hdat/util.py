@@ -1,4 +1,6 @@
 import os
+import re
+import socket
 import sys
 
 
@@ -10,6 +12,14 @@ def print_error(message):
     print(message, file=sys.stderr)
 
 
+def host_name():
+    '''
+    The short name of this host, restricted to characters that are safe in
+    file names.
+    '''
+    return re.sub(r'[^A-Za-z0-9-]', '-', socket.gethostname().split('.')[0]) or 'localhost'
+
+
 def find_here_or_in_parents(start_directory, entryname):
     current_directory = os.path.abspath(start_directory)
 
@@ -39,11 +39,14 @@ setup(
 
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
 
-    install_requires=['gitpython'],
+    install_requires=[],
 
     extras_require={
         'dev': ['check-manifest', 'sphinx', 'sphinx-autobuild', 'mock'],
         'test': ['coverage', 'numpy'],
+        'compression': ['zstandard', 'lz4'],
+        'export': ['pyarrow'],
+        's3': ['boto3'],
     },
 
     package_data={},
@@ -1,6 +1,20 @@
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pytest
 
+from hdat.archive import Archive, BaseArchive
+from hdat.compression import read_codec
+from hdat.util import AbortError
+
+
+def context_blob(archive, suite_id, case_id, result_id):
+    record = archive._read_record(archive._result_filename(suite_id, case_id, result_id))
+    return record['context']['blob']
+
 
 class TestArchive:
     def test_insert_then_select(self, tmp_archive):
@@ -26,3 +40,220 @@ class TestArchive:
         result['context'] = 'b'
         with pytest.raises(IOError):
             tmp_archive.insert(result)
+
+    def test_concurrent_inserts(self, tmpdir):
+        # the archive is created by the concurrent writers themselves
+        with ProcessPoolExecutor(max_workers=4) as executor:
+            list(executor.map(insert_result, [str(tmpdir)] * 40, range(40)))
+        tmp_archive = Archive(str(tmpdir))
+        assert len(tmp_archive.index.select_result_ids('a', '1')) == 40
+        case_directory = os.path.join(tmp_archive.root, 'a', '1')
+        assert len(os.listdir(case_directory)) == 40
+        assert tmp_archive.reindex() == 40
+
+    def test_insert_updates_index(self, archive):
+        assert archive.index.select_result_ids('a', '1') == ['r1', '101_r2']
+        assert archive.index.select_case_ids('a') == set(['1', '2'])
+        assert archive.index.select_suite_ids() == set(['a', 'b'])
+
+    def test_reindex(self, archive):
+        assert archive.reindex() == 4
+        assert archive.index.select_result_ids('a', '1') == ['r1', '101_r2']
+
+    def test_index_reconciled_with_files(self, archive):
+        assert archive.index.select_suite_ids() == set(['a', 'b'])
+        os.remove(archive._result_filename('a', '1', 'r1'))
+        assert archive.index.select_result_ids('a', '1') == ['101_r2']
+
+    def test_index_per_host(self, archive, monkeypatch):
+        monkeypatch.setattr('hdat.archive.host_name', lambda: 'other')
+        other_host_archive = Archive(archive.root)
+        assert other_host_archive.index.filename != archive.index.filename
+        other_host_archive.insert({'suite_id': 'a', 'case_id': '1', 'result_id': '102_r3', 'ran_on': 102})
+        assert archive.index.select_result_ids('a', '1') == ['r1', '101_r2', '102_r3']
+
+    def test_incomplete_archive_fails_on_creation(self):
+        class IncompleteArchive(BaseArchive):
+            def select(self, suite_id, case_id, result_id):
+                return None
+
+        with pytest.raises(TypeError):
+            IncompleteArchive()
+
+    def test_existing_archive_indexed_on_open(self, archive):
+        os.remove(archive.index.filename)
+        reopened = Archive(archive.root)
+        assert reopened.index.select_result_ids('a', '1') == ['r1', '101_r2']
+
+    def test_context_loaded_lazily(self, tmp_archive):
+        result = {
+            'suite_id': 'sid',
+            'case_id': 'cid',
+            'result_id': 'rid',
+            'metrics': {'m': 1},
+            'context': 'large',
+        }
+        tmp_archive.insert(result)
+        data = tmp_archive.select('sid', 'cid', 'rid')
+        os.remove(tmp_archive.blobs.filename(context_blob(tmp_archive, 'sid', 'cid', 'rid')))
+        assert data['metrics'] == {'m': 1}
+        assert 'context' in data
+        with pytest.raises(IOError):
+            data['context']
+
+    def test_select_unsplit_result(self, tmp_archive):
+        result = {
+            'suite_id': 'sid',
+            'case_id': 'cid',
+            'result_id': 'rid',
+            'context': 'a',
+        }
+        os.makedirs(os.path.join(tmp_archive.root, 'sid', 'cid'))
+        with open(tmp_archive._result_filename('sid', 'cid', 'rid'), 'wb') as result_file:
+            pickle.dump(result, result_file)
+        assert tmp_archive.select('sid', 'cid', 'rid') == result
+
+    def test_large_arrays_memory_mapped(self, tmp_archive):
+        large = np.random.rand(100, 100)
+        small = np.arange(4)
+        result = {
+            'suite_id': 'sid',
+            'case_id': 'cid',
+            'result_id': 'rid',
+            'context': {'large': large, 'nested': [small, large.T], 'name': 'x'},
+        }
+        tmp_archive.insert(result)
+        context = tmp_archive.select('sid', 'cid', 'rid')['context']
+        assert isinstance(context['large'], np.memmap)
+        assert not context['large'].flags.writeable
+        assert np.array_equal(context['large'], large)
+        assert not isinstance(context['nested'][0], np.memmap)
+        assert np.array_equal(context['nested'][0], small)
+        assert np.array_equal(context['nested'][1], large.T)
+        assert context['name'] == 'x'
+
+    def test_array_context(self, tmp_archive):
+        large = np.random.rand(100, 100)
+        result = {
+            'suite_id': 'sid',
+            'case_id': 'cid',
+            'result_id': 'rid',
+            'context': large,
+        }
+        tmp_archive.insert(result)
+        assert np.array_equal(tmp_archive.select('sid', 'cid', 'rid')['context'], large)
+
+    @pytest.mark.parametrize('codec', ['gzip', 'lzma'])
+    def test_compressed_context(self, tmpdir, codec):
+        archive = Archive(str(tmpdir), compression=codec)
+        large = np.random.rand(100, 100)
+        result = {
+            'suite_id': 'sid',
+            'case_id': 'cid',
+            'result_id': 'rid',
+            'context': {'large': large},
+        }
+        archive.insert(result)
+        assert read_codec(archive.blobs.filename(context_blob(archive, 'sid', 'cid', 'rid'))) == codec
+        assert np.array_equal(archive.select('sid', 'cid', 'rid')['context']['large'], large)
+
+    def test_compression_from_config(self, tmpdir):
+        tmpdir.join('.config.json').write('{"compression": "bz2:1"}')
+        archive = Archive(str(tmpdir))
+        assert (archive.codec, archive.level) == ('bz2', 1)
+
+    def test_compact(self, tmpdir):
+        large = np.random.rand(100, 100)
+        results = [
+            {'suite_id': 'sid', 'case_id': 'cid', 'result_id': 'r1', 'context': {'large': large}},
+            {'suite_id': 'sid', 'case_id': 'cid', 'result_id': 'r2'},
+        ]
+        archive = Archive(str(tmpdir))
+        for result in results:
+            archive.insert(result)
+
+        compressed_archive = Archive(str(tmpdir), compression='gzip')
+        assert compressed_archive.compact(jobs=2) == 2
+        assert compressed_archive.compact() == 0
+        assert read_codec(archive.blobs.filename(context_blob(archive, 'sid', 'cid', 'r1'))) == 'gzip'
+        assert np.array_equal(archive.select('sid', 'cid', 'r1')['context']['large'], large)
+        assert archive.select('sid', 'cid', 'r2') == results[1]
+
+    def test_compact_unsplit_result(self, tmp_archive):
+        result = {
+            'suite_id': 'sid',
+            'case_id': 'cid',
+            'result_id': 'rid',
+            'context': 'a',
+        }
+        os.makedirs(os.path.join(tmp_archive.root, 'sid', 'cid'))
+        with open(tmp_archive._result_filename('sid', 'cid', 'rid'), 'wb') as result_file:
+            pickle.dump(result, result_file)
+        assert tmp_archive.compact() == 1
+        assert context_blob(tmp_archive, 'sid', 'cid', 'rid') in tmp_archive.blobs.digests()
+        assert tmp_archive.select('sid', 'cid', 'rid') == result
+
+    def test_identical_contexts_stored_once(self, tmp_archive):
+        large = np.random.rand(100, 100)
+        for result_id in ['r1', 'r2']:
+            tmp_archive.insert({
+                'suite_id': 'sid',
+                'case_id': 'cid',
+                'result_id': result_id,
+                'context': {'large': large.copy()},
+            })
+        assert context_blob(tmp_archive, 'sid', 'cid', 'r1') == context_blob(tmp_archive, 'sid', 'cid', 'r2')
+        assert len(list(tmp_archive.blobs.digests())) == 2
+
+    def test_gc(self, tmp_archive):
+        for result_id, value in [('r1', 'kept'), ('r2', 'collected')]:
+            tmp_archive.insert({
+                'suite_id': 'sid',
+                'case_id': 'cid',
+                'result_id': result_id,
+                'context': value,
+            })
+        os.remove(tmp_archive._result_filename('sid', 'cid', 'r2'))
+        assert tmp_archive.gc() == 0
+        assert tmp_archive.gc(grace_period=-1) == 1
+        assert list(tmp_archive.blobs.digests()) == [context_blob(tmp_archive, 'sid', 'cid', 'r1')]
+        assert tmp_archive.select('sid', 'cid', 'r1')['context'] == 'kept'
+
+    def test_prune_keep_last(self, archive):
+        assert archive.prune(keep_last=1, jobs=2) == [('a', '1', 'r1')]
+        assert archive.index.select_result_ids('a', '1') == ['101_r2']
+        assert not os.path.exists(archive._result_filename('a', '1', 'r1'))
+        assert archive.select('a', '1', '101_r2') is not None
+
+    def test_prune_older_than(self, archive):
+        archive.insert({'suite_id': 'a', 'case_id': '2', 'result_id': 'recent', 'ran_on': time.time()})
+        pruned = archive.prune(older_than=60)
+        assert len(pruned) == 4
+        assert archive.index.select_results() == [('a', '2', 'recent', pytest.approx(time.time(), abs=60))]
+
+    def test_prune_keep_results(self, archive):
+        pruned = archive.prune(keep_last=0, keep_results=[('a', '1', 'r1')], dry_run=True)
+        assert pruned == [('a', '1', '101_r2'), ('a', '2', '103_r3'), ('b', '3', '103_r4')]
+        assert len(archive.index.select_results()) == 4
+
+    def test_prune_requires_policy(self, archive):
+        with pytest.raises(AbortError):
+            archive.prune()
+
+    def test_merge(self, archive, tmpdir):
+        source = Archive(str(tmpdir))
+        source.insert({'suite_id': 'a', 'case_id': '1', 'result_id': '105_r5', 'ran_on': 105, 'context': 'c'})
+        source.insert({'suite_id': 'a', 'case_id': '1', 'result_id': 'r1', 'ran_on': 100})
+        assert [result['result_id'] for result in archive.merge(source)] == ['105_r5']
+        assert archive.select('a', '1', '105_r5')['context'] == 'c'
+        assert archive.merge(source) == []
+
+
+def insert_result(archive_root, i):
+    Archive(archive_root).insert({
+        'suite_id': 'a',
+        'case_id': '1',
+        'result_id': 'r{}'.format(i),
+        'ran_on': i,
+        'context': {'data': np.full(100000, i)},
+    })
@@ -0,0 +1,71 @@
+import pytest
+
+from hdat.bench import BenchStore, bench_cases, format_bench, summarize
+from hdat.runner import set_up_suite
+from hdat.util import AbortError
+from test_suite_hdat import BasicSuiteA
+
+
+class ModelSuite(BasicSuiteA):
+    id = 'model'
+
+    def setup(self):
+        self.model = 2
+
+    def run(self, case_input):
+        return case_input * self.model, {}
+
+
+class TestBench:
+    def test_summarize(self):
+        summary = summarize([3.0, 1.0, 2.0, 10.0])
+        assert summary['min'] == 1.0
+        assert summary['median'] == 2.5
+        assert summary['p95'] == 10.0
+        assert summary['stddev'] == pytest.approx(4.0825, abs=1e-4)
+
+    def test_bench_cases(self, mock_suites, mock_git_info):
+        bench = bench_cases(mock_suites, mock_git_info, [('a', '1'), ('b', '3')], warmup=1, repeat=3)
+        assert bench['commit'] == 'commit'
+        assert sorted(bench['cases']) == ['a/1', 'b/3']
+        assert set(bench['cases']['a/1']) >= {'wall_time', 'cpu_time'}
+
+    def test_bench_cases_set_up_instance(self, mock_git_info):
+        # a copy of the suite was set up first, as in a worker process
+        set_up_suite(ModelSuite())
+        suite = ModelSuite()
+        bench = bench_cases({'model': suite}, mock_git_info, [('model', case_id) for case_id in suite.collect()],
+                            warmup=0, repeat=1)
+        assert len(bench['cases']) == len(suite.collect())
+
+    def test_store_merges_cases(self, tmpdir):
+        bench_store = BenchStore(str(tmpdir))
+        summary = summarize([1.0])
+        bench_store.insert({'commit': 'abc123', 'cases': {'a/1': {'wall_time': summary}}})
+        bench_store.insert({'commit': 'abc123', 'cases': {'a/2': {'wall_time': summary}}})
+        assert sorted(bench_store.select('abc')['cases']) == ['a/1', 'a/2']
+        assert bench_store.select('def') is None
+
+        bench_store.insert({'commit': 'abc456', 'cases': {}})
+        with pytest.raises(AbortError):
+            bench_store.select('abc')
+
+    def test_store_keeps_dirty_separate(self, tmpdir):
+        bench_store = BenchStore(str(tmpdir))
+        summary = summarize([1.0])
+        bench_store.insert({'commit': 'abc123', 'repo_dirty': False, 'cases': {'a/1': {'wall_time': summary}}})
+        bench_store.insert({'commit': 'abc123', 'repo_dirty': True, 'cases': {'a/2': {'wall_time': summary}}})
+        assert bench_store.commits() == ['abc123', 'abc123-dirty']
+        assert sorted(bench_store.select('abc')['cases']) == ['a/1']
+        assert sorted(bench_store.select('abc-dirty')['cases']) == ['a/2']
+
+    def test_format_compare(self):
+        baseline = {'commit': 'old', 'cases': {'a/1': {'wall_time': summarize([1.0])}}}
+        bench = {'commit': 'new', 'cases': {
+            'a/1': {'wall_time': summarize([1.5])},
+            'a/2': {'wall_time': summarize([1.0])},
+        }}
+        lines = format_bench(bench, baseline).splitlines()
+        assert lines[0].startswith('a/1: wall time min 1.500000 s')
+        assert lines[1].strip() == 'median vs old: wall time +50.0%'
+        assert lines[3].strip() == 'not benchmarked at old'
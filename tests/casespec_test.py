@@ -1,6 +1,6 @@
 import pytest
 
-from hdat.casespec import resolve_casespecs
+from hdat.casespec import archived_run_times, parse_shard, resolve_casespecs, shard_cases
 from hdat.util import AbortError
 
 
@@ -31,3 +31,43 @@ class TestSelectCases:
     def test_long_specifier(self, mock_suites):
         with pytest.raises(AbortError):
             resolve_casespecs(mock_suites, ['a/1/huh'])
+
+
+class TestShardCases:
+    cases = [('a', str(i)) for i in range(7)]
+
+    def test_shards_partition_cases(self):
+        shards = [shard_cases(self.cases, i, 3) for i in range(1, 4)]
+        assert sorted(sum(shards, [])) == sorted(self.cases)
+        assert [len(shard) for shard in shards] == [3, 2, 2]
+
+    def test_shard_order_independent(self):
+        assert shard_cases(self.cases, 2, 3) == shard_cases(list(reversed(self.cases)), 2, 3)[::-1]
+
+    def test_shards_balanced(self):
+        run_times = {('a', '0'): 10.0, ('a', '1'): 6.0, ('a', '2'): 4.0}
+        assert shard_cases(self.cases[:3], 1, 2, run_times) == [('a', '0')]
+        assert shard_cases(self.cases[:3], 2, 2, run_times) == [('a', '1'), ('a', '2')]
+
+    def test_archived_run_times_before(self, tmp_archive, monkeypatch):
+        for result_id, ran_on, run_time in (('r1', 100, 1.0), ('r2', 200, 2.0)):
+            tmp_archive.insert({'suite_id': 'a', 'case_id': '1', 'result_id': result_id, 'ran_on': ran_on,
+                                'perf': {'run_wall_time': run_time}})
+        assert archived_run_times(tmp_archive, [('a', '1'), ('a', '2')]) == {('a', '1'): 2.0}
+        assert archived_run_times(tmp_archive, [('a', '1')], before=150) == {('a', '1'): 1.0}
+        assert archived_run_times(tmp_archive, [('a', '1')], before=100) == {}
+
+        selected = []
+        select = tmp_archive.select
+        monkeypatch.setattr(tmp_archive, 'select', lambda *key: selected.append(key) or select(*key))
+        assert archived_run_times(tmp_archive, [('a', '1')], before=250) == {('a', '1'): 2.0}
+        assert selected == [('a', '1', 'r2')]
+
+    def test_resolve_shard(self, mock_suites):
+        assert resolve_casespecs(mock_suites, ['a', 'b'], shard=(2, 2)) == [('a', '2')]
+
+    def test_parse_shard(self):
+        assert parse_shard('2/4') == (2, 4)
+        for shardspec in ['0/4', '5/4', '2', 'a/b']:
+            with pytest.raises(AbortError):
+                parse_shard(shardspec)
@@ -0,0 +1,39 @@
+import pickle
+
+import pytest
+
+from hdat.compression import available_codecs, open_compressed, open_decompressed, parse_compression, read_codec
+from hdat.util import AbortError
+
+
+class TestCompression:
+    @pytest.mark.parametrize('codec', available_codecs())
+    def test_roundtrip(self, tmpdir, codec):
+        filename = str(tmpdir.join('data'))
+        data = {'key': list(range(1000))}
+        with open_compressed(filename, codec) as compressed_file:
+            pickle.dump(data, compressed_file)
+        assert read_codec(filename) == codec
+        with open_decompressed(filename) as decompressed_file:
+            assert pickle.load(decompressed_file) == data
+
+    def test_uncompressed_file(self, tmpdir):
+        filename = str(tmpdir.join('data'))
+        with open(filename, 'wb') as raw_file:
+            pickle.dump('value', raw_file)
+        assert read_codec(filename) == 'none'
+        with open_decompressed(filename) as decompressed_file:
+            assert pickle.load(decompressed_file) == 'value'
+
+    @pytest.mark.parametrize('compression, expected', [
+        (None, ('none', None)),
+        ('gzip', ('gzip', None)),
+        ('LZMA:9', ('lzma', 9)),
+    ])
+    def test_parse_compression(self, compression, expected):
+        assert parse_compression(compression) == expected
+
+    @pytest.mark.parametrize('compression', ['rar', 'gzip:fast'])
+    def test_parse_invalid_compression(self, compression):
+        with pytest.raises(AbortError):
+            parse_compression(compression)
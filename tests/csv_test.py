@@ -68,3 +68,32 @@ class TestPrintResult:
         hdat.print_results([nested_result], 'case_id, space key, commit')
         out, err = capfd.readouterr()
         assert 'case_id,commit,space key' in out
+
+
+class TestStreamResults:
+    @pytest.mark.parametrize('keys', ['', 'case_id, metrics.max, wrongkey', 'metrics.*, "quotedkey"'])
+    def test_same_as_print(self, nested_result, mock_results, keys, capfd):
+        results = [nested_result] + mock_results
+        reports.print_results(results, keys)
+        printed, err = capfd.readouterr()
+        reports.stream_results(lambda: iter(results), keys)
+        streamed, err = capfd.readouterr()
+        assert streamed == printed
+
+    def test_single_pass_without_wildcards(self, nested_result, capfd):
+        passes = []
+
+        def resolve_results():
+            passes.append(True)
+            return [nested_result]
+
+        reports.stream_results(resolve_results, 'case_id,commit')
+        out, err = capfd.readouterr()
+        assert len(passes) == 1
+        assert out.splitlines() == ['case_id,commit', 'cid,c1']
+
+    def test_stream_cli(self, mock_suites, tmp_golden_store, archive, mock_git_info, capfd):
+        hdat.hdat_cli(['csv', '--stream', '--keys', 'case_id,result_id'], mock_suites, tmp_golden_store,
+                      archive, mock_git_info)
+        out, err = capfd.readouterr()
+        assert out.splitlines() == ['case_id,result_id', '1,101_r2', '2,103_r3', '3,103_r4']
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from hdat.export import export_results
+from hdat.util import AbortError
+
+
+@pytest.fixture
+def metric_results():
+    return [
+        {'case_id': '1', 'ran_on': 1.5, 'metrics': {'count': 1, 'mean': 2.5, 'ok': True}},
+        {'case_id': '2', 'ran_on': 2.0, 'metrics': {'count': 3, 'label': 'x'}},
+        {'case_id': '3', 'ran_on': 3.0, 'metrics': {'count': 4, 'mean': 1}},
+    ]
+
+
+class TestExportResults:
+    def test_npz(self, tmpdir, metric_results):
+        filename = str(tmpdir.join('results.npz'))
+        written = export_results(lambda: iter(metric_results), 'case_id,ran_on,metrics.*', filename, 'npz',
+                                 batch_size=2)
+        assert written == filename
+        results = np.load(filename)['results']
+        assert results.dtype.names == ('case_id', 'metrics.count', 'metrics.label', 'metrics.mean', 'metrics.ok',
+                                       'ran_on')
+        assert list(results['case_id']) == ['1', '2', '3']
+        assert results['metrics.count'].dtype == np.int64
+        assert list(results['metrics.count']) == [1, 3, 4]
+        assert list(results['metrics.label']) == ['', 'x', '']
+        assert np.array_equal(results['metrics.mean'], [2.5, np.nan, 1.0], equal_nan=True)
+        assert np.array_equal(results['metrics.ok'], [1.0, np.nan, np.nan], equal_nan=True)
+
+    def test_npz_results_changed(self, tmpdir, metric_results):
+        resolved = [metric_results, metric_results[:2]]
+        filename = str(tmpdir.join('results.npz'))
+        with pytest.raises(AbortError):
+            export_results(lambda: iter(resolved.pop(0)), 'case_id', filename, 'npz')
+        assert not tmpdir.join('results.npz').exists()
+
+    def test_parquet_falls_back_to_npz(self, tmpdir, metric_results):
+        try:
+            import pyarrow  # noqa
+            pytest.skip('pyarrow is installed')
+        except ImportError:
+            pass
+        written = export_results(lambda: iter(metric_results), '', str(tmpdir.join('results.parquet')), 'parquet')
+        assert written == str(tmpdir.join('results.npz'))
+        assert len(np.load(written)['results']) == 3
+
+    def test_parquet(self, tmpdir, metric_results):
+        pq = pytest.importorskip('pyarrow.parquet')
+        filename = str(tmpdir.join('results.parquet'))
+        export_results(lambda: iter(metric_results), 'case_id,metrics.*', filename, 'parquet', batch_size=2)
+        table = pq.read_table(filename)
+        assert table.column('metrics.count').to_pylist() == [1, 3, 4]
+        assert table.column('metrics.label').to_pylist() == [None, 'x', None]
+
+    def test_no_matching_keys(self, tmpdir, metric_results):
+        with pytest.raises(AbortError):
+            export_results(lambda: iter(metric_results), 'missing.*', str(tmpdir.join('results.npz')), 'npz')
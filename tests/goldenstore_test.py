@@ -1,3 +1,13 @@
+import json
+import os
+
+import numpy as np
+
+from hdat import arrayjson
+from hdat.goldenstore import GoldenStore
+from hdat.lazyresult import LazyResult
+
+
 class TestGoldenStore:
     def test_select_missing(self, tmp_golden_store):
         assert tmp_golden_store.select_golden('sid', 'cid') is None
@@ -31,3 +41,90 @@ class TestGoldenStore:
             'case_id': 'cid',
             'result_id': 'new_rid',
         }
+
+    def test_insert_perf(self, tmp_golden_store):
+        result = {'suite_id': 'sid', 'case_id': 'cid', 'result_id': 'rid', 'perf': {'run_wall_time': 1.0}}
+        tmp_golden_store.insert(result)
+        assert 'perf' not in tmp_golden_store.select_golden('sid', 'cid')
+
+        tmp_golden_store.insert(result, keep_perf=True)
+        result['perf'] = {'run_wall_time': 2.0}
+        tmp_golden_store.insert(result)
+        assert tmp_golden_store.select_golden('sid', 'cid')['perf'] == {'run_wall_time': 1.0}
+
+    def test_insert_lazy_result(self, tmp_golden_store):
+        def load_context():
+            raise AssertionError('context should not be loaded')
+
+        result = LazyResult({'suite_id': 'sid', 'case_id': 'cid', 'result_id': 'rid'}, load_context)
+        tmp_golden_store.insert(result)
+        assert tmp_golden_store.select_golden('sid', 'cid') == {
+            'suite_id': 'sid',
+            'case_id': 'cid',
+            'result_id': 'rid',
+        }
+
+    def test_insert_array_metrics(self, tmp_golden_store):
+        histogram = np.arange(1000, dtype='>i4').reshape(10, 100)
+        result = {
+            'suite_id': 'sid',
+            'case_id': 'cid',
+            'metrics': {'histogram': histogram, 'mean': np.float64(1.5), 'count': np.int64(3)},
+        }
+        tmp_golden_store.insert(result)
+        metrics = tmp_golden_store.select_golden('sid', 'cid')['metrics']
+        assert metrics['histogram'].dtype == np.dtype('<i4')
+        assert np.array_equal(metrics['histogram'], histogram)
+        assert metrics['mean'] == 1.5 and metrics['count'] == 3
+
+        golden_filename = os.path.join(tmp_golden_store.root, 'sid', 'cid.json')
+        assert os.path.getsize(golden_filename) < 6000
+
+    def test_consolidated(self, tmpdir):
+        golden_store = GoldenStore(str(tmpdir), consolidated=True)
+        golden_store.insert({'suite_id': 'sid', 'case_id': 'b', 'metrics': {'m': 2}})
+        golden_store.insert({'suite_id': 'sid', 'case_id': 'a', 'metrics': {'m': 1}})
+        assert os.listdir(str(tmpdir)) == ['sid.json']
+        with open(str(tmpdir.join('sid.json'))) as suite_file:
+            assert list(json.load(suite_file)) == ['a', 'b']
+
+        per_case_store = GoldenStore(str(tmpdir))
+        assert per_case_store.select_golden('sid', 'a')['metrics'] == {'m': 1}
+        per_case_store.insert({'suite_id': 'sid', 'case_id': 'a', 'metrics': {'m': 3}})
+        assert per_case_store.select_golden('sid', 'a')['metrics'] == {'m': 3}
+
+    def test_consolidated_insert_many(self, tmpdir, monkeypatch):
+        golden_store = GoldenStore(str(tmpdir), consolidated=True)
+        written = []
+        write = golden_store._write
+
+        def counting_write(filename, contents):
+            written.append(filename)
+            write(filename, contents)
+
+        monkeypatch.setattr(golden_store, '_write', counting_write)
+        golden_store.insert_many({'suite_id': suite_id, 'case_id': str(i), 'metrics': {'m': i}}
+                                 for suite_id in ('s1', 's2') for i in range(10))
+        assert sorted(os.path.basename(filename) for filename in written) == ['s1.json', 's2.json']
+        assert golden_store.select_golden('s2', '7')['metrics'] == {'m': 7}
+
+    def test_consolidated_config(self, tmpdir):
+        tmpdir.join('.config.json').write('{"consolidated": true}')
+        assert GoldenStore(str(tmpdir)).consolidated is True
+
+    def test_preload_cache(self, tmp_golden_store, monkeypatch):
+        tmp_golden_store.insert({'suite_id': 'sid', 'case_id': 'cid', 'metrics': {'m': 1}})
+        tmp_golden_store.preload(['sid', 'missing'])
+
+        def fail_load(golden_file):
+            raise AssertionError('cached golden results should not be read again')
+        monkeypatch.setattr(arrayjson, 'load', fail_load)
+        golden_result = tmp_golden_store.select_golden('sid', 'cid')
+        golden_result['metrics']['m'] = 2
+        assert tmp_golden_store.select_golden('sid', 'cid')['metrics'] == {'m': 1}
+        monkeypatch.undo()
+
+        golden_filename = os.path.join(tmp_golden_store.root, 'sid', 'cid.json')
+        with open(golden_filename, 'w') as golden_file:
+            json.dump({'metrics': {'m': 10}}, golden_file)
+        assert tmp_golden_store.select_golden('sid', 'cid')['metrics'] == {'m': 10}
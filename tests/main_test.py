@@ -1,5 +1,6 @@
 import pytest
 
+from hdat.archive import Archive
 from hdat.hdat_cli import hdat_cli
 from hdat.util import AbortError
 
@@ -15,6 +16,87 @@ class TestMainRun:
             hdat_cli_with_mocks(['run'])
         assert 'UNKNOWN: 3' in str(e)
 
+    def test_run_all_parallel(self, hdat_cli_with_mocks, mock_suites, tmp_archive, capfd):
+        with pytest.raises(AbortError) as e:
+            hdat_cli_with_mocks(['run', '-j', '2'])
+        assert 'UNKNOWN: 3' in str(e)
+
+        out, err = capfd.readouterr()
+        assert out.index('a/1') < out.index('a/2') < out.index('b/3')
+        assert len(list(tmp_archive.select_recents_all(mock_suites))) == 3
+
+    def test_run_jobs_validated(self, hdat_cli_with_mocks):
+        with pytest.raises(AbortError) as e:
+            hdat_cli_with_mocks(['run', '-j', '0'])
+        assert 'at least 1' in str(e)
+
+    def test_run_repeat_validated(self, hdat_cli_with_mocks):
+        with pytest.raises(AbortError) as e:
+            hdat_cli_with_mocks(['run', '--repeat', '0'])
+        assert 'repeats must be at least 1' in str(e)
+
+    def test_run_incremental(self, hdat_cli_with_mocks, tmp_archive, capfd):
+        with pytest.raises(AbortError):
+            hdat_cli_with_mocks(['run', '--incremental', 'a/1'])
+        with pytest.raises(AbortError) as e:
+            hdat_cli_with_mocks(['run', '--incremental', 'a/1'])
+        assert 'UNKNOWN: 1' in str(e)
+
+        out, err = capfd.readouterr()
+        assert out.count('Reused result') == 1
+        assert len(tmp_archive.index.select_result_ids('a', '1')) == 1
+
+    def test_run_incremental_dirty(self, mock_suites, tmp_golden_store, tmp_archive, capfd):
+        dirty_git_info = {'commit': 'commit', 'dirty': True}
+        for _ in range(2):
+            with pytest.raises(AbortError):
+                hdat_cli(['run', '--incremental', 'a/1'], mock_suites, tmp_golden_store, tmp_archive, dirty_git_info)
+
+        out, err = capfd.readouterr()
+        assert 'Reused result' not in out
+        assert len(tmp_archive.index.select_result_ids('a', '1')) == 2
+
+    def test_run_perf_csv(self, hdat_cli_with_mocks, capfd):
+        with pytest.raises(AbortError):
+            hdat_cli_with_mocks(['run', 'a/1'])
+        capfd.readouterr()
+        hdat_cli_with_mocks(['csv', 'a/1', '--keys', 'perf.*'])
+        out, err = capfd.readouterr()
+        assert out.splitlines()[0].split(',')[:2] == ['perf.check_cpu_time', 'perf.check_wall_time']
+        assert 'perf.run_wall_time' in out
+
+    def test_run_check_perf(self, hdat_cli_with_mocks, tmp_golden_store, capfd):
+        with pytest.raises(AbortError):
+            hdat_cli_with_mocks(['run', 'a/1'])
+        hdat_cli_with_mocks(['verify', '--perf', 'a/1'])
+        golden_result = tmp_golden_store.select_golden('a', '1')
+        golden_result['perf']['run_wall_time'] = 1e-9
+        tmp_golden_store.insert(golden_result, keep_perf=True)
+
+        with pytest.raises(AbortError) as e:
+            hdat_cli_with_mocks(['run', '--check-perf', '--repeat', '2', 'a/1'])
+        assert 'FAIL: 1' in str(e)
+        out, err = capfd.readouterr()
+        assert 'Metric run_wall_time value' in out
+
+    def test_bench_compare(self, hdat_cli_with_mocks, capfd):
+        hdat_cli_with_mocks(['bench', '--repeat', '2', 'a'])
+        hdat_cli_with_mocks(['bench', '--repeat', '2', '--compare', 'com', 'a/1'])
+        out, err = capfd.readouterr()
+        assert out.count('a/1: wall time') == 2
+        assert 'median vs commit: wall time' in out
+
+        with pytest.raises(AbortError):
+            hdat_cli_with_mocks(['bench', '--compare', 'missing', 'a/1'])
+
+    def test_show_profile(self, hdat_cli_with_mocks, capfd):
+        with pytest.raises(AbortError):
+            hdat_cli_with_mocks(['run', '--profile', 'cprofile', 'a/1'])
+        hdat_cli_with_mocks(['show', '--profile', '--top', '5', 'a/1'])
+        out, err = capfd.readouterr()
+        assert 'PROFILE "a/1/' in out
+        assert 'cumulative' in out
+
     def test_runshow(self, hdat_cli_with_mocks):
         with pytest.raises(AbortError) as e:
             hdat_cli_with_mocks(['runshow', 'a'])
@@ -34,3 +116,52 @@ class TestMainRun:
             hdat_cli_with_mocks(['diff', 'a/1/r1', 'a/1/101_r2'])
 
         assert 'diffing "a/1/r1" and "a/1/101_r2"' in str(e)
+
+    def test_run_shards_then_merge(self, mock_suites, tmp_golden_store, tmp_archive, mock_git_info, tmpdir, capfd):
+        for i in (1, 2):
+            shard_archive = Archive(str(tmpdir.join(str(i))))
+            with pytest.raises(AbortError):
+                hdat_cli(['run', '--shard', '{}/2'.format(i), '--balance-before', '100'], mock_suites, tmp_golden_store,
+                         shard_archive, mock_git_info)
+        capfd.readouterr()
+
+        with pytest.raises(AbortError) as e:
+            hdat_cli(['merge', str(tmpdir.join('1')), str(tmpdir.join('2'))], mock_suites, tmp_golden_store,
+                     tmp_archive, mock_git_info)
+        assert 'UNKNOWN: 3' in str(e)
+        out, err = capfd.readouterr()
+        assert 'Merged 3 results' in out
+        assert len(list(tmp_archive.select_recents_all(mock_suites))) == 3
+
+
+class TestMainReindex:
+    def test_reindex(self, hdat_cli_with_mocks, archive, capfd):
+        hdat_cli_with_mocks(['reindex'])
+        out, err = capfd.readouterr()
+        assert 'Indexed 4 results' in out
+
+
+class TestMainArchive:
+    def test_compact(self, hdat_cli_with_mocks, archive, capfd):
+        hdat_cli_with_mocks(['archive', 'compact', '--compression', 'gzip'])
+        out, err = capfd.readouterr()
+        assert 'Rewrote 0 results and contexts with "gzip"' in out
+
+    def test_prune_keep_golden(self, hdat_cli_with_mocks, archive, tmp_golden_store, mock_results, capfd):
+        tmp_golden_store.insert(mock_results[0])
+        hdat_cli_with_mocks(['archive', 'prune', '--keep-golden'])
+        out, err = capfd.readouterr()
+        assert 'Removed 3 results' in out
+        assert archive.index.select_result_ids('a', '1') == ['r1']
+
+    def test_prune_keep_last_validated(self, hdat_cli_with_mocks, archive):
+        for keep_last in ('0', '-1'):
+            with pytest.raises(AbortError) as e:
+                hdat_cli_with_mocks(['archive', 'prune', '--keep-last', keep_last])
+            assert 'results to keep must be at least 1' in str(e)
+        assert len(archive.index.select_results()) == 4
+
+    def test_gc(self, hdat_cli_with_mocks, archive, capfd):
+        hdat_cli_with_mocks(['archive', 'gc'])
+        out, err = capfd.readouterr()
+        assert 'Removed 0 unreferenced contexts' in out
@@ -0,0 +1,185 @@
+import os
+
+import pytest
+
+from hdat.archive import open_archive
+from hdat.filecache import FileCache
+from hdat.objectstore import ObjectStoreArchive
+from hdat.util import AbortError
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+
+@pytest.fixture
+def s3_archive(tmpdir, monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('HDAT_ARCHIVE_CACHE', str(tmpdir))
+    with moto.mock_aws():
+        boto3.client('s3').create_bucket(Bucket='bucket')
+        yield open_archive('s3://bucket/prefix')
+
+
+@pytest.fixture
+def s3_results_archive(s3_archive, mock_results):
+    for result in mock_results:
+        s3_archive.insert(result)
+    return s3_archive
+
+
+class TestObjectStoreArchive:
+    def test_open_archive(self, s3_archive):
+        assert isinstance(s3_archive, ObjectStoreArchive)
+        assert s3_archive.bucket == 'bucket'
+        assert s3_archive.prefix == 'prefix/'
+
+    def test_invalid_url(self):
+        with pytest.raises(AbortError):
+            ObjectStoreArchive('s3://', client=object())
+
+    def test_insert_then_select(self, s3_archive):
+        result = {
+            'suite_id': 'sid',
+            'case_id': 'cid',
+            'result_id': 'rid',
+            'metrics': {'a': 1},
+            'context': {'b': [1, 2, 3]},
+        }
+        s3_archive.insert(result)
+        data = s3_archive.select('sid', 'cid', 'rid')
+        assert data['metrics'] == {'a': 1}
+        assert data['context'] == {'b': [1, 2, 3]}
+        assert s3_archive.select('sid', 'cid', 'missing') is None
+
+    def test_overwrite_fails(self, s3_archive):
+        result = {'suite_id': 'sid', 'case_id': 'cid', 'result_id': 'rid'}
+        s3_archive.insert(result)
+        with pytest.raises(IOError):
+            s3_archive.insert(result)
+
+    def test_context_fetched_lazily(self, s3_archive):
+        s3_archive.insert({'suite_id': 'sid', 'case_id': 'cid', 'result_id': 'rid', 'context': 'c'})
+        context_filename = s3_archive.cache.filename('prefix/sid/cid/rid.context')
+
+        data = s3_archive.select('sid', 'cid', 'rid')
+        assert not os.path.exists(context_filename)
+        assert data['context'] == 'c'
+        assert os.path.exists(context_filename)
+
+    def test_reads_served_from_cache(self, s3_archive):
+        s3_archive.insert({'suite_id': 'sid', 'case_id': 'cid', 'result_id': 'rid', 'context': 'c'})
+        assert s3_archive.select('sid', 'cid', 'rid')['context'] == 'c'
+        s3_archive.client.delete_object(Bucket='bucket', Key='prefix/sid/cid/rid.pkl')
+        s3_archive.client.delete_object(Bucket='bucket', Key='prefix/sid/cid/rid.context')
+        assert s3_archive.select('sid', 'cid', 'rid')['context'] == 'c'
+
+    def test_index(self, s3_results_archive):
+        index = s3_results_archive.index
+        assert index.select_result_ids('a', '1') == ['r1', '101_r2']
+        assert index.select_result_ids('a', '1', before=102) == ['101_r2']
+        assert index.select_case_ids('a') == set(['1', '2'])
+        assert index.select_suite_ids() == set(['a', 'b'])
+        assert [row[:3] for row in index.select_results()] == [
+            ('a', '1', 'r1'),
+            ('a', '1', '101_r2'),
+            ('a', '2', '103_r3'),
+            ('b', '3', '103_r4'),
+        ]
+
+    def test_select_recent(self, s3_results_archive, mock_suites):
+        result = s3_results_archive.select_recent(mock_suites, -1, 'a', '1')
+        assert result['result_id'] == '101_r2'
+
+    def test_select_reusable(self, s3_archive):
+        for result_id, input_hash in (('1_r1', 'x'), ('2_r2', 'y'), ('3_r3', 'x')):
+            s3_archive.insert({
+                'suite_id': 'sid',
+                'case_id': 'cid',
+                'result_id': result_id,
+                'commit': 'commit',
+                'input_hash': input_hash,
+            })
+        assert s3_archive.select_reusable('sid', 'cid', 'commit', 'y')['result_id'] == '2_r2'
+        assert s3_archive.select_reusable('sid', 'cid', 'commit', 'z') is None
+
+    def test_filter_without_fetching(self, s3_archive, monkeypatch):
+        for result_id, input_hash in (('1_r1', 'x'), ('2_r2', 'y')):
+            s3_archive.insert({'suite_id': 'sid', 'case_id': 'cid', 'result_id': result_id, 'input_hash': input_hash})
+
+        def fetch(key):
+            raise AssertionError('fetched "{}"'.format(key))
+
+        monkeypatch.setattr(s3_archive, '_fetch', fetch)
+        assert s3_archive.index.select_result_ids('sid', 'cid', input_hash='y') == ['2_r2']
+        assert s3_archive.index.select_result_ids('sid', 'cid', commit_id='commit') == []
+
+    def test_profile(self, s3_archive):
+        result = {'suite_id': 'sid', 'case_id': 'cid', 'result_id': 'rid', 'profile': 'cprofile'}
+        s3_archive.insert(result)
+        assert s3_archive.profile_filename(result) is None
+        s3_archive.insert_profile(result, b'profile')
+        with open(s3_archive.profile_filename(result), 'rb') as profile_file:
+            assert profile_file.read() == b'profile'
+
+    def test_maintenance_unsupported(self, s3_archive):
+        with pytest.raises(AbortError):
+            s3_archive.prune(keep_last=1)
+        with pytest.raises(AbortError):
+            s3_archive.reindex()
+
+
+class TestFileCache:
+    def test_get_fetches_once(self, tmpdir):
+        cache = FileCache(str(tmpdir), 100)
+        fetched = []
+
+        def fetch(filename):
+            fetched.append(filename)
+            with open(filename, 'wb') as f:
+                f.write(b'data')
+
+        filename = cache.get('a/b', fetch)
+        assert cache.get('a/b', fetch) == filename
+        assert len(fetched) == 1
+        with open(filename, 'rb') as f:
+            assert f.read() == b'data'
+
+    def test_failed_fetch_not_cached(self, tmpdir):
+        cache = FileCache(str(tmpdir), 100)
+
+        def fetch(filename):
+            raise KeyError(filename)
+
+        with pytest.raises(KeyError):
+            cache.get('a', fetch)
+        assert os.listdir(str(tmpdir)) == []
+
+    def test_least_recently_used_evicted(self, tmpdir):
+        cache = FileCache(str(tmpdir), 35)
+        for i, key in enumerate(['a', 'b', 'c']):
+            filename = cache.get(key, lambda filename: _write(filename, b'x' * 10))
+            os.utime(filename, (i, i))
+        # using "a" makes "b" the least recently used
+        cache.get('a', None)
+        cache.get('d', lambda filename: _write(filename, b'x' * 10))
+        assert not os.path.exists(cache.filename('b'))
+        for key in ['a', 'c', 'd']:
+            assert os.path.exists(cache.filename(key))
+
+    def test_size_counted_incrementally(self, tmpdir, monkeypatch):
+        cache = FileCache(str(tmpdir), 35)
+        walks = []
+        walk = os.walk
+        monkeypatch.setattr('hdat.filecache.os.walk', lambda root: walks.append(root) or walk(root))
+        for key in ['a', 'b', 'c']:
+            cache.get(key, lambda filename: _write(filename, b'x' * 10))
+        assert len(walks) == 1 and cache.total_bytes == 30
+        cache.get('d', lambda filename: _write(filename, b'x' * 10))
+        assert len(walks) == 2 and cache.total_bytes == 30
+
+
+def _write(filename, data):
+    with open(filename, 'wb') as f:
+        f.write(data)
@@ -0,0 +1,233 @@
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+from hdat.profiling import format_profile
+from hdat.runner import build_result_id, check_perf, hash_case, measure_suite, run_cases
+from hdat.supervisor import _resident_memory
+from test_suite_hdat import BasicSuiteA
+
+
+class DependentSuite(BasicSuiteA):
+    def __init__(self, dependency):
+        self.dependency = dependency
+
+    def dependencies(self, case_input):
+        return [self.dependency]
+
+
+class LimitedSuite(BasicSuiteA):
+    id = 'limited'
+
+    def collect(self):
+        return OrderedDict([('sleep', 'sleep'), ('allocate', 'allocate'), ('crash', 'crash'), ('ok', 'ok')])
+
+    def run(self, case_input):
+        if case_input == 'sleep':
+            time.sleep(30)
+        elif case_input == 'allocate':
+            memory = bytearray(256 * 2**20)
+            time.sleep(30)
+            return len(memory), {}
+        elif case_input == 'crash':
+            os._exit(1)
+        return case_input, {}
+
+
+class BatchSuite(BasicSuiteA):
+    id = 'batch'
+    batch_size = 3
+
+    def __init__(self, log_filename):
+        self.log_filename = log_filename
+        self.batches = []
+
+    def collect(self):
+        return OrderedDict((str(i), i) for i in range(5))
+
+    def setup(self):
+        self.log('setup')
+
+    def teardown(self):
+        self.log('teardown')
+
+    def run_batch(self, case_inputs):
+        self.batches.append(list(case_inputs))
+        return [(case_input * 2, {}) for case_input in case_inputs]
+
+    def log(self, event):
+        with open(self.log_filename, 'a') as log_file:
+            log_file.write('{} {}\n'.format(os.getpid(), event))
+
+
+class ModelSuite(BatchSuite):
+    id = 'model'
+    batch_size = 2
+
+    def collect(self):
+        return OrderedDict((str(i), i) for i in range(12))
+
+    def setup(self):
+        self.model = 2
+
+    def run(self, case_input):
+        return case_input * self.model, {}
+
+    def run_batch(self, case_inputs):
+        return [self.run(case_input) for case_input in case_inputs]
+
+
+class TestBuildResultId:
+    def test_unique(self):
+        result = {'ran_on': 100.5, 'commit': 'abc'}
+        result_ids = set(build_result_id(result) for _ in range(100))
+        assert len(result_ids) == 100
+        assert all(result_id.startswith('100.5_abc_') and '/' not in result_id for result_id in result_ids)
+
+
+class TestHashCase:
+    def test_hash_depends_on_input(self, basic_suite_a):
+        suite = basic_suite_a()
+        assert hash_case(suite, 10) == hash_case(suite, 10)
+        assert hash_case(suite, 10) != hash_case(suite, 20)
+
+    def test_hash_independent_of_hash_seed(self):
+        code = ('from hdat.runner import hash_case; from test_suite_hdat import BasicSuiteA; '
+                'print(hash_case(BasicSuiteA(), {"tags": {"a", "b", "c", "d"}, "pairs": [frozenset(["x", "y"])]}))')
+        tests_directory = os.path.dirname(os.path.abspath(__file__))
+        python_path = os.pathsep.join([tests_directory, os.path.dirname(tests_directory)])
+        hashes = set()
+        for hash_seed in ('1', '2', '3'):
+            env = dict(os.environ, PYTHONHASHSEED=hash_seed, PYTHONPATH=python_path)
+            hashes.add(subprocess.check_output([sys.executable, '-c', code], env=env))
+        assert len(hashes) == 1
+
+    def test_hash_reads_changed_files(self, tmpdir):
+        dependency = tmpdir.join('data.txt')
+        dependency.write('one')
+        dependency.setmtime(1000000)
+        suite = DependentSuite(str(dependency))
+        first_hash = hash_case(suite, 10)
+        assert hash_case(suite, 10) == first_hash
+        dependency.write('two')
+        dependency.setmtime(2000000)
+        assert hash_case(suite, 10) != first_hash
+
+    def test_hash_depends_on_dependencies(self, tmpdir):
+        dependency = tmpdir.join('data.txt')
+        dependency.write('one')
+        suite = DependentSuite(str(dependency))
+        first_hash = hash_case(suite, 10)
+        dependency.write('two')
+        assert hash_case(suite, 10) != first_hash
+
+
+class TestRunLimits:
+    def test_limits(self, tmp_golden_store, tmp_archive, mock_git_info):
+        suite = LimitedSuite()
+        cases = [('limited', case_id) for case_id in suite.collect()]
+        # workers import the same modules as this process
+        memory_limit = _resident_memory(os.getpid()) + 128 * 2**20
+        started_on = time.monotonic()
+        cases_status = run_cases({'limited': suite}, tmp_golden_store, tmp_archive, mock_git_info, cases,
+                                 jobs=2, timeout=2, memory_limit=memory_limit)
+        assert time.monotonic() - started_on < 20
+        assert cases_status == {'pass': 0, 'fail': 0, 'error': 1, 'unknown': 1, 'timeout': 1, 'oom': 1}
+
+        statuses = {
+            case_id: tmp_archive.select_recent({'limited': suite}, -1, 'limited', case_id)['status']
+            for case_id in ('sleep', 'allocate', 'ok')
+        }
+        assert statuses == {'sleep': 'timeout', 'allocate': 'oom', 'ok': 'unknown'}
+        assert not tmp_archive.index.select_result_ids('limited', 'crash')
+
+
+class TestRunBatch:
+    def test_batches(self, tmp_golden_store, tmp_archive, mock_git_info, tmpdir):
+        suite = BatchSuite(str(tmpdir.join('log')))
+        cases = [('batch', case_id) for case_id in suite.collect()]
+        cases_status = run_cases({'batch': suite}, tmp_golden_store, tmp_archive, mock_git_info, cases)
+        assert cases_status['unknown'] == 5
+        assert suite.batches == [[0, 1, 2], [3, 4]]
+
+        result = tmp_archive.select_recent({'batch': suite}, -1, 'batch', '4')
+        assert result['metrics'] == 8
+        assert result['perf']['run_batch_size'] == 2
+        assert tmpdir.join('log').read() == '{0} setup\n{0} teardown\n'.format(os.getpid())
+
+    def test_batches_in_workers(self, tmp_golden_store, tmp_archive, mock_git_info, tmpdir):
+        suite = BatchSuite(str(tmpdir.join('log')))
+        cases = [('batch', case_id) for case_id in suite.collect()]
+        run_cases({'batch': suite}, tmp_golden_store, tmp_archive, mock_git_info, cases, jobs=2)
+        metrics = [tmp_archive.select_recent({'batch': suite}, -1, 'batch', case_id)['metrics']
+                   for case_id, _ in suite.collect().items()]
+        assert metrics == [0, 2, 4, 6, 8]
+
+        events = [line.split() for line in tmpdir.join('log').read().splitlines()]
+        for pid in set(pid for pid, _ in events):
+            assert [event for event_pid, event in events if event_pid == pid] == ['setup', 'teardown']
+        assert str(os.getpid()) not in dict(events)
+
+    def test_setup_state_in_workers(self, tmp_golden_store, tmp_archive, mock_git_info, tmpdir):
+        suite = ModelSuite(str(tmpdir.join('log')))
+        cases = [('model', case_id) for case_id in suite.collect()]
+        # batched, and one case at a time in supervised workers
+        for kwargs in ({}, {'timeout': 10}):
+            cases_status = run_cases({'model': suite}, tmp_golden_store, tmp_archive, mock_git_info, cases, jobs=2,
+                                     **kwargs)
+            assert cases_status['unknown'] == 12
+            metrics = [tmp_archive.select_recent({'model': suite}, -1, 'model', case_id)['metrics']
+                       for case_id in suite.collect()]
+            assert metrics == [i * 2 for i in range(12)]
+
+    def test_limits_run_cases_separately(self, tmp_golden_store, tmp_archive, mock_git_info, tmpdir):
+        suite = BatchSuite(str(tmpdir.join('log')))
+        cases_status = run_cases({'batch': suite}, tmp_golden_store, tmp_archive, mock_git_info, [('batch', '1')],
+                                 timeout=10)
+        assert cases_status['unknown'] == 1
+        result = tmp_archive.select_recent({'batch': suite}, -1, 'batch', '1')
+        assert result['metrics'] == 1
+        assert 'run_batch_size' not in result['perf']
+
+
+class TestRunPerf:
+    def test_perf_recorded(self, mock_suites, tmp_golden_store, tmp_archive, mock_git_info, capfd):
+        run_cases(mock_suites, tmp_golden_store, tmp_archive, mock_git_info, [('a', '1'), ('b', '3')],
+                  trace_memory=True)
+        perf = tmp_archive.select_recent(mock_suites, -1, 'a', '1')['perf']
+        assert set(perf) >= {'run_wall_time', 'run_cpu_time', 'run_traced_peak', 'check_wall_time'}
+        assert 'insert_wall_time' not in perf
+
+        out, err = capfd.readouterr()
+        assert 'PERFORMANCE\nRUN:' in out
+        assert 'SLOWEST: ' in out and 'b/3' in out
+
+    def test_repeat(self, basic_suite_a):
+        run_result, perf = measure_suite(basic_suite_a(), 10, repeat=3)
+        assert run_result == (10, {})
+        assert perf['run_repeat'] == 3
+
+    def test_check_perf(self, tmp_golden_store):
+        golden_perf = {'run_wall_time': 1.0, 'run_peak_rss': 100}
+        tmp_golden_store.insert({'suite_id': 'a', 'case_id': '1', 'perf': golden_perf}, keep_perf=True)
+
+        perf = {'run_wall_time': 1.1, 'run_peak_rss': 100}
+        assert check_perf(tmp_golden_store, 'a', '1', perf, 0.2)[0] == 'pass'
+
+        perf = {'run_wall_time': 1.5, 'run_peak_rss': 100}
+        status, comments = check_perf(tmp_golden_store, 'a', '1', perf, 0.2)
+        assert status == 'fail'
+        assert 'run_wall_time' in comments and 'run_peak_rss' not in comments
+
+    def test_profile_cprofile(self, mock_suites, tmp_golden_store, tmp_archive, mock_git_info):
+        run_cases(mock_suites, tmp_golden_store, tmp_archive, mock_git_info, [('a', '1')], profiler='cprofile')
+        result = tmp_archive.select_recent(mock_suites, -1, 'a', '1')
+        assert result['profile'] == 'cprofile'
+        assert format_profile('cprofile', tmp_archive.profile_filename(result)).count('run_suite') >= 1
+
+    def test_profile_tracemalloc(self, mock_suites, tmp_golden_store, tmp_archive, mock_git_info):
+        run_cases(mock_suites, tmp_golden_store, tmp_archive, mock_git_info, [('a', '1')], profiler='tracemalloc')
+        result = tmp_archive.select_recent(mock_suites, -1, 'a', '1')
+        assert format_profile('tracemalloc', tmp_archive.profile_filename(result)).startswith('Top ')
@@ -0,0 +1,66 @@
+import os
+import subprocess
+import tempfile
+
+import pytest
+
+from hdat.source_control import LazyGitInfo, git_info_from_directory
+from hdat.util import AbortError
+
+
+def git(directory, *args):
+    return subprocess.check_output(['git'] + list(args), cwd=directory).decode().strip()
+
+
+@pytest.fixture
+def git_repository():
+    tmp_directory = tempfile.TemporaryDirectory()
+    directory = tmp_directory.name
+    git(directory, 'init', '-q')
+    git(directory, 'config', 'user.email', 'test@example.com')
+    git(directory, 'config', 'user.name', 'Test')
+    with open(os.path.join(directory, 'tracked.txt'), 'w') as tracked_file:
+        tracked_file.write('a')
+    git(directory, 'add', 'tracked.txt')
+    git(directory, 'commit', '-q', '-m', 'First')
+    yield directory
+    tmp_directory.cleanup()
+
+
+class TestGitInfo:
+    def test_clean(self, git_repository):
+        os.makedirs(os.path.join(git_repository, 'sub'))
+        info = git_info_from_directory(os.path.join(git_repository, 'sub'))
+        assert info == {'commit': git(git_repository, 'rev-parse', 'HEAD'), 'dirty': False}
+
+    def test_dirty(self, git_repository):
+        with open(os.path.join(git_repository, 'untracked.txt'), 'w') as untracked_file:
+            untracked_file.write('b')
+        assert git_info_from_directory(git_repository)['dirty'] is False
+
+        with open(os.path.join(git_repository, 'tracked.txt'), 'w') as tracked_file:
+            tracked_file.write('b')
+        git(git_repository, 'add', 'tracked.txt')
+        assert git_info_from_directory(git_repository)['dirty'] is True
+
+    def test_packed_refs(self, git_repository):
+        git(git_repository, 'pack-refs', '--all')
+        commit = git(git_repository, 'rev-parse', 'HEAD')
+        assert git_info_from_directory(git_repository)['commit'] == commit
+
+    def test_detached_head(self, git_repository):
+        commit = git(git_repository, 'rev-parse', 'HEAD')
+        git(git_repository, 'checkout', '-q', commit)
+        assert git_info_from_directory(git_repository)['commit'] == commit
+
+    def test_worktree(self, git_repository):
+        commit = git(git_repository, 'rev-parse', 'HEAD')
+        worktree = os.path.join(git_repository, 'worktree')
+        git(git_repository, 'worktree', 'add', '-q', '-b', 'other', worktree)
+        assert git_info_from_directory(worktree)['commit'] == commit
+
+    def test_lazy(self):
+        with tempfile.TemporaryDirectory() as directory:
+            git_info = LazyGitInfo(directory)
+            with pytest.raises(AbortError):
+                git_info['commit']
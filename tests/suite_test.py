@@ -1,8 +1,22 @@
 import pytest
 
 import os
+import sys
+import tempfile
 
-from hdat.suite import collect_suites, MetricsChecker
+import numpy as np
+
+from hdat.suite import Suite, collect_suites, collect_cases, invalidate_cases, MetricsChecker
+from hdat.util import AbortError
+
+
+class CountingSuite(Suite):
+    def __init__(self):
+        self.collect_count = 0
+
+    def collect(self):
+        self.collect_count += 1
+        return {'1': 1}
 
 
 class TestSuite:
@@ -12,6 +26,81 @@ class TestSuite:
         suites = collect_suites(test_path)
         assert suites.keys() == set(['BaseSuite', 'a', 'b'])
 
+    def test_collect_suites_cache(self, monkeypatch):
+        with tempfile.TemporaryDirectory() as directory:
+            module_filename = os.path.join(directory, 'lazy_hdat.py')
+            with open(module_filename, 'w') as module_file:
+                module_file.write('from hdat.suite import Suite\nclass LazySuite(Suite):\n    id = "lazy"\n')
+            cache_filename = os.path.join(directory, '.hdatcache', 'suites.json')
+            monkeypatch.syspath_prepend(directory)
+
+            assert list(collect_suites(directory, cache_filename)) == ['lazy']
+            assert os.path.exists(cache_filename)
+
+            del sys.modules['lazy_hdat']
+            suites = collect_suites(directory, cache_filename)
+            assert 'lazy' in suites and list(suites) == ['lazy']
+            assert 'lazy_hdat' not in sys.modules
+            assert suites['lazy'].id == 'lazy'
+            assert 'lazy_hdat' in sys.modules
+
+            del sys.modules['lazy_hdat']
+            with open(module_filename, 'a') as module_file:
+                module_file.write('class OtherSuite(Suite):\n    id = "other"\n')
+            assert set(collect_suites(directory, cache_filename)) == set(['lazy', 'other'])
+            del sys.modules['lazy_hdat']
+
+    def test_collect_suites_cache_helpers(self, monkeypatch):
+        with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as outside_directory:
+            helper_filename = os.path.join(directory, 'helpers.py')
+            outside_filename = os.path.join(outside_directory, 'outside.py')
+            for filename, suite_id in ((helper_filename, 'helper'), (outside_filename, 'outside')):
+                with open(filename, 'w') as helper_file:
+                    helper_file.write('from hdat.suite import Suite\nclass S(Suite):\n    id = "{}"\n'.format(suite_id))
+            with open(os.path.join(directory, 'uses_hdat.py'), 'w') as module_file:
+                module_file.write('from helpers import S as HelperSuite\nfrom outside import S as OutsideSuite\n')
+            cache_filename = os.path.join(directory, '.hdatcache', 'suites.json')
+            monkeypatch.syspath_prepend(directory)
+            monkeypatch.syspath_prepend(outside_directory)
+
+            def collect():
+                for module_name in ('uses_hdat', 'helpers', 'outside'):
+                    sys.modules.pop(module_name, None)
+                return collect_suites(directory, cache_filename)
+
+            assert set(collect()) == set(['helper', 'outside'])
+
+            # helpers within the directory are part of the cache key
+            with open(helper_filename, 'a') as helper_file:
+                helper_file.write('class T(Suite):\n    id = "new"\n')
+            with open(os.path.join(directory, 'uses_hdat.py'), 'a') as module_file:
+                module_file.write('from helpers import T\n')
+            assert set(collect()) == set(['helper', 'outside', 'new'])
+
+            # other changes are found when the suite is looked up
+            with open(outside_filename, 'w') as outside_file:
+                outside_file.write('from hdat.suite import Suite\nclass S(Suite):\n    id = "renamed"\n')
+            suites = collect()
+            with pytest.raises(AbortError):
+                suites['outside']
+            assert suites['renamed'].id == 'renamed'
+            assert set(collect()) == set(['helper', 'renamed', 'new'])
+            for module_name in ('uses_hdat', 'helpers', 'outside'):
+                sys.modules.pop(module_name, None)
+
+    def test_collect_cases_memoized(self):
+        suite = CountingSuite()
+        assert collect_cases(suite) == {'1': 1}
+        assert collect_cases(suite) is collect_cases(suite)
+        assert suite.collect_count == 1
+
+    def test_invalidate_cases(self):
+        suite = CountingSuite()
+        collect_cases(suite)
+        invalidate_cases(suite)
+        collect_cases(suite)
+        assert suite.collect_count == 2
+
     def test_metrics_checker_bad_keys(self):
         old = {'key1': 1, 'key3': 'value1'}
         new = {'key2': 1, 'key3': 'value2'}
@@ -103,3 +192,79 @@ class TestSuite:
         checker.custom('custom', lambda x, y: (x % 2 == 0 and y % 2 == 0, 'not even'))
         assert checker.match() is False and checker.result()[0] is False
         assert len(checker.msgs()) == 5
+
+    @pytest.mark.parametrize("method", ['is_close', 'is_exact', 'can_increase', 'can_decrease'])
+    def test_metrics_checker_bulk_matches_scalar(self, method):
+        old = {'m{}'.format(i): float(i) for i in range(100)}
+        new = {'m{}'.format(i): float(i) + (i % 3 - 1) * 0.5 for i in range(100)}
+        scalar_checker = MetricsChecker(old, new)
+        for metric in old:
+            getattr(scalar_checker, method)(metric)
+        bulk_checker = MetricsChecker(old, new)
+        getattr(bulk_checker, 'bulk_' + method)('m*')
+        assert bulk_checker.match() is scalar_checker.match() is False
+        # is_close messages list the tolerances given to it, which differ
+        assert sorted(msg.split(' within ')[0] for msg in bulk_checker.msgs()) == \
+            sorted(msg.split(' within ')[0] for msg in scalar_checker.msgs())
+
+    def test_metrics_checker_bulk_patterns(self):
+        old = {'region_1': 1.0, 'region_2': 2.0, 'other': 3.0}
+        new = {'region_1': 1.0, 'region_2': 2.0, 'other': 4.0}
+        checker = MetricsChecker(old, new)
+        checker.bulk_is_close(['region_*', 'missing'])
+        assert checker.result() == (True, [])
+        checker.bulk_is_close('other')
+        assert checker.match() is False
+
+    @pytest.mark.parametrize("method", ['bulk_is_close', 'bulk_is_exact', 'bulk_can_increase', 'bulk_can_decrease'])
+    def test_metrics_checker_bulk_mixed_types(self, method):
+        old = {'number': 1.0, 'label': 'x', 'other_label': 'x', 'missing': None}
+        new = {'number': 1.0, 'label': 'x', 'other_label': 'y', 'missing': None}
+        checker = MetricsChecker(old, new)
+        getattr(checker, method)('*')
+        assert checker.match() is False
+        assert len(checker.msgs()) == 1 and checker.msgs()[0].startswith('Metric other_label value y')
+
+    def test_metrics_checker_bulk_arrays(self):
+        old = {'slices': [1.0, 2.0, 3.0], 'shape': [1.0, 2.0]}
+        new = {'slices': [1.0, 2.5, 3.0], 'shape': [1.0]}
+        checker = MetricsChecker(old, new)
+        checker.bulk_is_close(['slices', 'shape'], abs_tol=0.1)
+        assert checker.match() is False
+        msgs = checker.msgs()
+        assert msgs[0] == 'Metric slices failed in 1 of 3 elements, e.g. at index (1,): ' + \
+            'value 2.5 was not close to golden value 2.0 within {\'rel_tol\': 1e-09, \'abs_tol\': 0.1}'
+        assert 'shape (1,)' in msgs[1]
+
+        checker = MetricsChecker(old, new)
+        checker.bulk_can_increase('slices')
+        assert checker.match() is True
+
+    def test_metrics_checker_array_metrics(self):
+        old = {'histogram': np.array([1.0, 2.0, 3.0]), 'labels': ['a', 'b']}
+        new = {'histogram': np.array([1.0, 2.0, 3.0 + 1e-7]), 'labels': ['a', 'c']}
+        checker = MetricsChecker(old, new)
+        checker.all_close('histogram')
+        checker.is_exact('histogram')
+        checker.is_exact('labels')
+        msgs = checker.msgs()
+        assert checker.match() is False
+        assert len(msgs) == 2
+        assert msgs[0].startswith('Metric histogram failed in 1 of 3 elements')
+        assert msgs[1].startswith('Metric labels value')
+
+    @pytest.mark.parametrize("old, new, expected", [
+        ([[1, 2], [3]], [[1, 2], [3]], True),
+        ([[1, 2], [3]], [[1, 2], [4]], False),
+        ([1, '1'], ['1', 1], False),
+        (['a', 'b'], ['a', 'b'], True),
+        ([1, None], [1, None], True),
+    ])
+    def test_metrics_checker_non_numeric_lists(self, old, new, expected):
+        checker = MetricsChecker({'m': old}, {'m': new})
+        checker.is_exact('m')
+        assert checker.result() == (expected, checker.msgs())
+        assert len(checker.msgs()) == (0 if expected else 1)
+        checker = MetricsChecker({'m': old, 'n': 1.0}, {'m': new, 'n': 1.0})
+        checker.bulk_is_exact('*')
+        assert checker.match() is expected